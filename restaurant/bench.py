@@ -0,0 +1,557 @@
+"""
+📏 قياسات أداء بوت المطعم (بدون Telegram أو MySQL حقيقيين)
+
+الاستخدام:
+    python3 bench.py intake --orders 200 --latency 0.05
+    python3 bench.py parser --iterations 20000
+    python3 bench.py clicks --orders 500
+    python3 bench.py webhook --updates 5000 --concurrency 50 [--recorded updates.json]
+    python3 bench.py startup --orders 2000 --changed 50 --latency 0.005
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+import restaurant
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "channel_messages_corpus.json")
+
+
+class FakeBot:
+    """بوت وهمي يحاكي زمن استجابة Telegram"""
+
+    def __init__(self, latency, bot_id=1):
+        self.id = bot_id
+        self.latency = latency
+        self._message_ids = iter(range(1, 10 ** 9))
+
+    async def _reply(self):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._reply()
+
+    async def send_location(self, chat_id, latitude, longitude, **kwargs):
+        return await self._reply()
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None, **kwargs):
+        return await self._reply()
+
+
+class FakeQuery:
+    """زر استعلام وهمي يكفي لمعالجات الأزرار"""
+
+    def __init__(self, data, chat_id, message_id, bot_id=1):
+        self.data = data
+        self.message = SimpleNamespace(chat_id=chat_id, message_id=message_id)
+        self._bot = SimpleNamespace(id=bot_id)
+
+    def get_bot(self):
+        return self._bot
+
+    async def answer(self, *args, **kwargs):
+        return None
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        return None
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def prepare_environment():
+    """عزل القياس عن قاعدة البيانات وحدود Telegram الحقيقية"""
+    logging.getLogger().setLevel(logging.WARNING)
+    restaurant.logger.setLevel(logging.WARNING)
+
+    tenant = restaurant.load_restaurant_config("Almalek")
+    restaurant.save_pending_orders = _noop
+    restaurant.telegram_limiter = restaurant.RateLimiter(
+        global_rate=1e9, private_rate=1e9, group_rate_per_min=1e9, group_burst=10 ** 6
+    )
+    tenant.locations.grace = 0.01
+    return tenant
+
+
+def make_context(tenant, latency):
+    return SimpleNamespace(bot=FakeBot(latency), user_data={}, bot_data={restaurant.TENANT_KEY: tenant})
+
+
+def make_order_post(tenant, message_id):
+    order_id = str(uuid.uuid4())
+    text = (
+        f"🛒 طلب جديد\n"
+        f"🔢 رقم الطلب: {message_id}\n"
+        f"🆔 معرف الطلب: {order_id}\n"
+        f"💰 المجموع: 25000 ل.س"
+    )
+    post = SimpleNamespace(
+        chat_id=tenant.channel_id,
+        message_id=message_id,
+        text=text,
+        location=None,
+        reply_to_message=None,
+    )
+    return SimpleNamespace(channel_post=post)
+
+
+async def run_intake(tenant, orders, latency, admission):
+    restaurant.order_admission = admission
+    tenant.orders = restaurant.OrderStore(tenant.restaurant_id, max_size=orders * 2, ttl=3600)
+
+    context = make_context(tenant, latency)
+    updates = [make_order_post(tenant, i * 2) for i in range(orders)]
+
+    restaurant.outbound.start()
+    start = time.perf_counter()
+    # نفس سلوك concurrent_updates(True): كل تحديث في مهمة مستقلة
+    await asyncio.gather(*(restaurant.channel_router.dispatch(u, context) for u in updates))
+    elapsed = time.perf_counter() - start
+    await restaurant.outbound.stop()
+
+    for task in list(restaurant.background_tasks):
+        task.cancel()
+    await asyncio.gather(*restaurant.background_tasks, return_exceptions=True)
+
+    assert len(tenant.orders) == orders, "لم تُحفظ كل الطلبات"
+    return orders / elapsed
+
+
+async def compare_intake(tenant, orders, latency):
+    # "قبل": القفل العام القديم كان يفرض 0.2 ثانية بين كل طلبين، أي ما يعادل دلوًا بمعدل 5/ثانية وسعة 1
+    before = await run_intake(tenant, orders, latency, restaurant.TokenBucket(5, 1))
+    after = await run_intake(tenant, orders, latency, None)
+    return before, after
+
+
+def bench_intake(args):
+    tenant = prepare_environment()
+    # حلقة أحداث واحدة: طوابير المرسل والمخزن مرتبطة بالحلقة التي أنشأتها
+    before, after = asyncio.run(compare_intake(tenant, args.orders, args.latency))
+
+    print(f"📥 استقبال {args.orders} طلب (زمن استجابة Telegram المحاكى {args.latency * 1000:.0f}ms):")
+    print(f"   قبل (قفل عام + 0.2 ثانية):  {before:8.1f} طلب/ثانية")
+    print(f"   بعد (تسلسل لكل طلب):        {after:8.1f} طلب/ثانية")
+
+
+# نسخة من دوال الاستخراج السابقة (قبل المحلل الموحد) للمقارنة فقط
+LEGACY_ORDER_ID_PATTERNS = [
+    r"معرف الطلب:?\s*[`\"']?([\w\-]+)[`\"']?",
+    r"🆔.*?[`\"']?([\w\-]+)[`\"']?",
+    r"order_id:?\s*[`\"']?([\w\-]+)[`\"']?"
+]
+
+LEGACY_ORDER_NUMBER_PATTERNS = [
+    r"رقم الطلب:?\s*[`\"']?(\d+)[`\"']?",
+    r"🔢.*?[`\"']?(\d+)[`\"']?",
+    r"order_number:?\s*[`\"']?(\d+)[`\"']?",
+    r"استلم طلبه رقم (\d+)",
+    r"تحضير الطلب رقم (\d+)"
+]
+
+
+def legacy_parse(text):
+    order_id = None
+    for pattern in LEGACY_ORDER_ID_PATTERNS:
+        match = re.search(pattern, text)
+        if match:
+            order_id = match.group(1)
+            break
+
+    order_number = None
+    for pattern in LEGACY_ORDER_NUMBER_PATTERNS:
+        match = re.search(pattern, text)
+        if match:
+            order_number = int(match.group(1))
+            break
+
+    rating = 0
+    match = re.search(r"⭐ \*التقييم:\* (⭐+) \((\d+)/5\)", text)
+    if match:
+        rating = int(match.group(2))
+    else:
+        match = re.search(r"تقييمه بـ (\⭐+)", text)
+        if match:
+            rating = len(match.group(1))
+
+    comment = None
+    match = re.search(r"💬 \*التعليق:\* (.+?)(?:\n|$)", text) or re.search(r"💬 التعليق: (.+?)(?:\n|$)", text)
+    if match:
+        comment = match.group(1).strip()
+
+    match = re.search(r"💬 سبب الإلغاء:\n(.+)", text, re.DOTALL)
+    reason = match.group(1).strip() if match else None
+
+    return order_id, order_number, rating, comment, reason
+
+
+def load_corpus():
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_corpus(corpus):
+    """التحقق من أن المحلل يطابق القيم المتوقعة لكل رسالة في المدوّنة"""
+    failures = 0
+    for sample in corpus:
+        parsed = restaurant.parse_channel_message(sample["text"])
+        for field, expected in sample["expected"].items():
+            actual = getattr(parsed, field)
+            if actual != expected:
+                failures += 1
+                print(f"❌ {sample['name']}: {field} = {actual!r} (المتوقع {expected!r})")
+    return failures
+
+
+def bench_parser(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    corpus = load_corpus()
+
+    failures = check_corpus(corpus)
+    if failures:
+        print(f"❌ {failures} حقل لا يطابق المدوّنة")
+        sys.exit(1)
+    print(f"✅ المدوّنة ({len(corpus)} رسالة) مطابقة للمحلل")
+
+    texts = [sample["text"] for sample in corpus]
+    total = args.iterations * len(texts)
+
+    def best_of(parse):
+        # أفضل زمن من عدة تكرارات لتقليل أثر الضجيج
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                for text in texts:
+                    parse(text)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    before = best_of(legacy_parse)
+    after = best_of(restaurant.parse_channel_message)
+
+    print(f"🧩 تحليل {total} رسالة:")
+    print(f"   قبل (دوال استخراج متعددة): {before / total * 1e6:8.2f} µs/رسالة")
+    print(f"   بعد (مسح واحد مُجمّع):      {after / total * 1e6:8.2f} µs/رسالة")
+
+
+# تسلسل ضغطات الكاشير على طلب واحد: تصفح الأزرار ثم اختيار الوقت مرتين
+CLICK_SEQUENCE = ("accept", "back", "reject", "back", "complain", "back", "accept", "time_30", "time_30")
+
+
+class UncachedKeyboardFactory(restaurant.KeyboardFactory):
+    """السلوك السابق: بناء قوائم الأزرار من جديد في كل ضغطة"""
+
+    def build(self, name, handle):
+        self.builds += 1
+        return restaurant.InlineKeyboardMarkup([
+            [restaurant.InlineKeyboardButton(label, callback_data=restaurant.encode_callback(action, handle))
+             for label, action in row]
+            for row in self.layouts[name]
+        ])
+
+
+async def run_clicks(tenant, orders, factory):
+    restaurant.keyboard_factory = factory
+    tenant.orders = restaurant.OrderStore(tenant.restaurant_id, max_size=orders * 2, ttl=3600)
+
+    context = make_context(tenant, 0)
+    updates = []
+    for i in range(orders):
+        record = restaurant.OrderRecord(str(uuid.uuid4()), "", message_id=i, order_number=i)
+        tenant.orders.put(record)
+        for action in CLICK_SEQUENCE:
+            query = FakeQuery(restaurant.encode_callback(action, record.handle), tenant.cashier_chat_id, i)
+            updates.append(SimpleNamespace(callback_query=query))
+
+    restaurant.callback_router.latency.clear()
+    restaurant.outbound.start()
+    start = time.perf_counter()
+    for update in updates:
+        await restaurant.callback_router.dispatch(update, context)
+    elapsed = time.perf_counter() - start
+    await restaurant.outbound.stop()
+    return len(updates) / elapsed
+
+
+async def compare_clicks(tenant, orders):
+    before = await run_clicks(tenant, orders, UncachedKeyboardFactory(restaurant.KEYBOARD_LAYOUTS, cache_size=0))
+    after = await run_clicks(tenant, orders, restaurant.KeyboardFactory(restaurant.KEYBOARD_LAYOUTS, restaurant.KEYBOARD_CACHE_SIZE))
+    return before, after
+
+
+def bench_clicks(args):
+    tenant = prepare_environment()
+    before, after = asyncio.run(compare_clicks(tenant, args.orders))
+
+    print(f"🖱️ {args.orders * len(CLICK_SEQUENCE)} ضغطة زر على {args.orders} طلب:")
+    print(f"   قبل (بناء الأزرار في كل ضغطة): {before:10.1f} ضغطة/ثانية")
+    print(f"   بعد (قوالب جاهزة + LRU):       {after:10.1f} ضغطة/ثانية")
+    print(f"   الزمن لكل إجراء: {restaurant.callback_router.stats()}")
+
+
+def synthesize_updates(tenant, count):
+    """تحديثات منشورات قناة من المدوّنة بصيغة Telegram الخام"""
+    texts = [sample["text"] for sample in load_corpus()]
+    return [
+        {
+            "update_id": i,
+            "channel_post": {
+                "message_id": i,
+                "date": 0,
+                "chat": {"id": tenant.channel_id, "type": "channel"},
+                "text": texts[i % len(texts)],
+            },
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+async def drain_updates(tenant, context, expected, concurrency=256):
+    """مستهلك بديل عن app.start(): يمرر التحديثات من الطابور إلى الموجّه بالتوازي كما يفعل PTB"""
+    slots = asyncio.Semaphore(concurrency)  # حد concurrent_updates(True) الافتراضي في PTB
+
+    async def process(update):
+        try:
+            await restaurant.channel_router.dispatch(update, context)
+        finally:
+            slots.release()
+
+    tasks = []
+    for _ in range(expected):
+        update = await tenant.app.update_queue.get()
+        await slots.acquire()
+        tasks.append(asyncio.create_task(process(update)))
+    await asyncio.gather(*tasks)
+
+
+async def run_webhook(tenant, raw_updates, concurrency, port):
+    import aiohttp
+    from telegram.request import HTTPXRequest
+
+    tenant.orders = restaurant.OrderStore(tenant.restaurant_id, max_size=len(raw_updates) * 2, ttl=3600)
+    tenant.app = restaurant.build_application(tenant, HTTPXRequest(), webhook=True)
+    server = restaurant.WebhookServer("127.0.0.1", port, f"http://127.0.0.1:{port}")
+    server.add(tenant, secret="bench-secret")
+    await server.start()
+    restaurant.outbound.start()
+
+    url = f"http://127.0.0.1:{port}{server.path_for(tenant)}"
+    headers = {restaurant.WEBHOOK_SECRET_HEADER: "bench-secret"}
+    pending = iter(raw_updates)
+    statuses = {}
+
+    async def client(session):
+        # عميل بديل عن Telegram: يرسل التحديثات المسجلة ويعيد ما رُفض بسبب امتلاء الطابور
+        for raw in pending:
+            while True:
+                async with session.post(url, json=raw, headers=headers) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                    if response.status != 503:
+                        break
+                await asyncio.sleep(0.01)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=raw_updates[0], headers={restaurant.WEBHOOK_SECRET_HEADER: "wrong"}) as response:
+            assert response.status == 403, "الرمز السري الخاطئ يجب أن يُرفض"
+
+        start = time.perf_counter()
+        consumer = asyncio.create_task(drain_updates(tenant, make_context(tenant, 0), len(raw_updates)))
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        await consumer
+        elapsed = time.perf_counter() - start
+
+    await server.stop()
+    await restaurant.outbound.stop()
+    for task in list(restaurant.background_tasks):
+        task.cancel()
+    await asyncio.gather(*restaurant.background_tasks, return_exceptions=True)
+    return len(raw_updates) / elapsed, statuses, server.stats()
+
+
+def bench_webhook(args):
+    tenant = prepare_environment()
+    if args.recorded:
+        with open(args.recorded, encoding="utf-8") as f:
+            raw_updates = json.load(f)
+    else:
+        raw_updates = synthesize_updates(tenant, args.updates)
+
+    rate, statuses, stats = asyncio.run(run_webhook(tenant, raw_updates, args.concurrency, args.port))
+    print(f"🌐 {len(raw_updates)} تحديث عبر webhook ({args.concurrency} اتصال متزامن، طابور {restaurant.UPDATE_QUEUE_MAXSIZE}):")
+    print(f"   {rate:10.1f} تحديث/ثانية | ردود HTTP: {statuses} | الخادم: {stats}")
+
+
+class FakePendingOrdersTable:
+    """جدول pending_orders وهمي يحاكي زمن الرحلة إلى MySQL لكل استعلام ولكل دفعة من المؤشر"""
+
+    def __init__(self, rows, latency):
+        self.rows = rows
+        self.latency = latency
+        self.round_trips = 0
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        yield self
+
+    def cursor(self, cursor_class=None):
+        return FakeStreamingCursor(self)
+
+
+class FakeStreamingCursor:
+    def __init__(self, table):
+        self.table = table
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def _round_trip(self):
+        self.table.round_trips += 1
+        await asyncio.sleep(self.table.latency)
+
+    async def execute(self, query, params=()):
+        await self._round_trip()
+        if query == "SELECT NOW()":
+            self._rows = [(datetime.datetime.now().replace(microsecond=0),)]
+        elif "updated_at >=" in query:
+            since = params[-1]
+            self._rows = sorted((r for r in self.table.rows if r["updated_at"] >= since), key=lambda r: r["updated_at"])
+        else:
+            live = [r for r in self.table.rows if r["status"] not in restaurant.TERMINAL_ORDER_STATUSES]
+            self._rows = sorted(live, key=lambda r: r["created_at"], reverse=True)[:params[-1]]
+
+    async def fetchone(self):
+        await self._round_trip()
+        return self._rows.pop(0) if self._rows else None
+
+    async def fetchmany(self, size):
+        await self._round_trip()
+        chunk, self._rows = self._rows[:size], self._rows[size:]
+        return chunk
+
+
+def synthesize_pending_orders(tenant, count):
+    now = datetime.datetime.now().replace(microsecond=0)
+    rows = []
+    for i in range(count):
+        created_at = now - datetime.timedelta(seconds=i * 5)
+        rows.append({
+            "order_id": str(uuid.uuid4()),
+            "order_number": i + 1,
+            "order_details": f"🛒 طلب جديد\n🔢 رقم الطلب: {i + 1}\n💰 المجموع: 25000 ل.س\n" + "🍔 وجبة\n" * 8,
+            "channel_message_id": i * 2,
+            "cashier_message_id": 10 ** 6 + i,
+            "location_latitude": 33.5 if i % 2 else None,
+            "location_longitude": 36.3 if i % 2 else None,
+            "status": restaurant.ORDER_STATUS_ACCEPTED if i % 3 else restaurant.ORDER_STATUS_PENDING,
+            "selected_time": "30" if i % 3 else None,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "callback_handle": count - i,
+        })
+    return rows
+
+
+async def run_startup(tenant, orders, changed, latency):
+    table = FakePendingOrdersTable(synthesize_pending_orders(tenant, orders), latency)
+    restaurant.get_db_connection = table.connection
+    snapshot_dir = tempfile.mkdtemp(prefix="order_snapshots_")
+    try:
+        snapshots = restaurant.OrderSnapshotter(snapshot_dir, interval=3600)
+
+        # "قبل": إعادة بناء كل الطلبات الحية من MySQL
+        table.round_trips = 0
+        store = restaurant.OrderStore(tenant.restaurant_id, max_size=orders, ttl=3600)
+        start = time.perf_counter()
+        await restaurant.load_pending_orders(store)
+        before = time.perf_counter() - start
+        before_trips = table.round_trips
+        await snapshots.write(store)
+
+        # تغييرات بعد اللقطة: جزء منها انتهى (يُخرج) والباقي تغيّر وقته
+        later = datetime.datetime.now() + datetime.timedelta(seconds=1)
+        for i, row in enumerate(table.rows[:changed]):
+            row["updated_at"] = later
+            row["status"] = restaurant.ORDER_STATUS_DELIVERED if i % 2 else restaurant.ORDER_STATUS_ACCEPTED
+            row["selected_time"] = "45"
+        expected = orders - len(range(1, changed, 2))
+
+        # "بعد": قراءة اللقطة ثم تطبيق ما تغيّر بعدها فقط
+        table.round_trips = 0
+        restored = restaurant.OrderStore(tenant.restaurant_id, max_size=orders, ttl=3600)
+        start = time.perf_counter()
+        loaded = await snapshots.restore(restored)
+        after = time.perf_counter() - start
+
+        assert loaded == expected, f"عدد الطلبات بعد الاستعادة {loaded} بدل {expected}"
+        assert restored.peek(table.rows[0]["order_id"]).selected_time == "45", "لم تُطبّق التغييرات بعد اللقطة"
+        return before, before_trips, after, table.round_trips, snapshots.stats()
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+
+def bench_startup(args):
+    tenant = prepare_environment()
+    before, before_trips, after, after_trips, stats = asyncio.run(
+        run_startup(tenant, args.orders, args.changed, args.latency)
+    )
+
+    print(f"♻️ تحميل {args.orders} طلب حي عند التشغيل ({args.changed} تغيّر بعد اللقطة، زمن رحلة MySQL {args.latency * 1000:.0f}ms):")
+    print(f"   قبل (تحميل كامل من MySQL):  {before * 1000:8.1f}ms | {before_trips} رحلة")
+    print(f"   بعد (لقطة mmap + التغييرات): {after * 1000:8.1f}ms | {after_trips} رحلة | حجم اللقطة {stats['last_bytes']} بايت")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياسات أداء بوت المطعم")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    intake = sub.add_parser("intake", help="معدل استقبال الطلبات من القناة")
+    intake.add_argument("--orders", type=int, default=200)
+    intake.add_argument("--latency", type=float, default=0.05, help="زمن استجابة Telegram بالثواني")
+    intake.set_defaults(func=bench_intake)
+
+    parser_bench = sub.add_parser("parser", help="سرعة وصحة تحليل رسائل القناة")
+    parser_bench.add_argument("--iterations", type=int, default=20000)
+    parser_bench.add_argument("--repeat", type=int, default=5)
+    parser_bench.set_defaults(func=bench_parser)
+
+    clicks = sub.add_parser("clicks", help="معدل معالجة أزرار الكاشير")
+    clicks.add_argument("--orders", type=int, default=500)
+    clicks.set_defaults(func=bench_clicks)
+
+    webhook = sub.add_parser("webhook", help="معدل استقبال التحديثات عبر خادم webhook المحلي")
+    webhook.add_argument("--updates", type=int, default=5000)
+    webhook.add_argument("--concurrency", type=int, default=50)
+    webhook.add_argument("--port", type=int, default=8765)
+    webhook.add_argument("--recorded", help="ملف JSON بقائمة تحديثات Telegram خام مسجلة")
+    webhook.set_defaults(func=bench_webhook)
+
+    startup = sub.add_parser("startup", help="زمن استعادة الطلبات الحية عند إعادة التشغيل")
+    startup.add_argument("--orders", type=int, default=2000)
+    startup.add_argument("--changed", type=int, default=50, help="طلبات تغيّرت بعد آخر لقطة")
+    startup.add_argument("--latency", type=float, default=0.005, help="زمن الرحلة إلى MySQL بالثواني")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,54 +10,234 @@ import datetime
 import aiomysql
 import pymysql
 import asyncio
-from asyncio import Lock
-import nest_asyncio
+import contextvars
+import heapq
+import weakref
+import random
+import itertools
+import hmac
+import secrets
+import signal
+import mmap
+import marshal
+import struct
+import zlib
 from telegram.error import TelegramError
 from telegram import ReplyKeyboardMarkup, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, CallbackContext
 from contextlib import asynccontextmanager
 from telegram.ext import ContextTypes
 from telegram.request import HTTPXRequest
-from collections import deque
-from telegram.error import NetworkError
+from collections import OrderedDict
+from telegram.error import NetworkError, RetryAfter, BadRequest, Forbidden, InvalidToken, ChatMigrated
 
+try:
+    import orjson  # ترميز JSON أسرع إن كان مثبتًا
+except ImportError:
+    orjson = None
 
 
-order_rate_lock = Lock()
-last_order_time = 0  # بالثواني
 
-location_queue = deque()
+# 🔹 إعدادات مخزن سجلات الرسائل المؤجل
+AUDIT_QUEUE_MAXSIZE = int(os.getenv("AUDIT_QUEUE_MAXSIZE", 5000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 100))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", 1.0))
 
-async def track_sent_message(message_id, order_id, source, destination, content):
-    """تتبع الرسائل المرسلة في قاعدة البيانات"""
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(
-                    """
-                    INSERT INTO message_tracking 
-                    (message_id, order_id, source, destination, content, sent_time) 
-                    VALUES (%s, %s, %s, %s, %s, NOW())
-                    """,
-                    (message_id, order_id, source, destination, content)
-                )
-            await conn.commit()
+
+class MessageAuditBuffer:
+    """مخزن مؤقت لسجلات message_tracking يُكتب على دفعات في الخلفية"""
+
+    INSERT_SQL = (
+        "INSERT INTO message_tracking "
+        "(message_id, order_id, source, destination, content, sent_time) VALUES "
+    )
+    ROW_PLACEHOLDER = "(%s, %s, %s, %s, %s, %s)"
+
+    def __init__(self, maxsize, batch_size, flush_interval):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._batch_ready = asyncio.Event()
+        self._task = None
+        self._inflight = None
+        self._held = None  # سجل أُخذ من الطابور وينتظر اكتمال دفعته
+
+    def enqueue(self, message_id, order_id, source, destination, content):
+        """إضافة سجل إلى الطابور دون انتظار قاعدة البيانات"""
+        row = (message_id, order_id, source, destination, content, datetime.datetime.now())
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"⚠️ طابور تتبع الرسائل ممتلئ، تم إسقاط {self.dropped} سجل حتى الآن.")
+            return False
+
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
         return True
-    except Exception as e:
-        logger.error(f"خطأ في تتبع الرسالة: {e}")
-        return False
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """إيقاف المهمة الخلفية وكتابة كل ما تبقى في الطابور"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._inflight is not None:
+            await self._inflight
+            self._inflight = None
+
+        # سجل أُلغيت المهمة أثناء انتظار دفعته: يُكتب أولاً حفاظًا على الترتيب
+        if self._held is not None:
+            held, self._held = self._held, None
+            await self._write([held] + self._drain(self.batch_size - 1))
+
+        while not self.queue.empty():
+            await self._write(self._drain(self.batch_size))
+
+        logger.info(f"📝 تم تفريغ سجلات تتبع الرسائل: {self.stats()}")
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize() + (self._held is not None),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def _drain(self, limit):
+        rows = []
+        while len(rows) < limit and not self.queue.empty():
+            rows.append(self.queue.get_nowait())
+        return rows
+
+    async def _run(self):
+        while True:
+            first = self._held = await self.queue.get()
+
+            # ⏳ انتظار اكتمال الدفعة أو انقضاء المهلة، أيهما أسبق
+            if self.queue.qsize() + 1 < self.batch_size:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = [first] + self._drain(self.batch_size - 1)
+            self._held = None
+            # 🛡️ حماية الكتابة الجارية من الإلغاء حتى لا تضيع الدفعة عند الإيقاف
+            self._inflight = asyncio.ensure_future(self._write(batch))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _write(self, rows):
+        if not rows:
+            return
+
+        sql = self.INSERT_SQL + ", ".join([self.ROW_PLACEHOLDER] * len(rows))
+        params = [value for row in rows for value in row]
+        try:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(sql, params)
+                await conn.commit()
+            self.written += len(rows)
+        except Exception as e:
+            self.failed += len(rows)
+            logger.error(f"❌ فشل في كتابة دفعة تتبع الرسائل ({len(rows)} سجل): {e}")
+
+
+audit_buffer = MessageAuditBuffer(
+    maxsize=AUDIT_QUEUE_MAXSIZE,
+    batch_size=AUDIT_BATCH_SIZE,
+    flush_interval=AUDIT_FLUSH_INTERVAL,
+)
+
+
+async def track_sent_message(message_id, order_id, source, destination, content):
+    """تتبع الرسائل المرسلة (تُكتب في قاعدة البيانات لاحقًا على دفعات)"""
+    return audit_buffer.enqueue(message_id, order_id, source, destination, content)
 
 
 
 # قفل التزامن للطلبات
-order_locks = {}
 order_queue = asyncio.Queue()
 
-async def get_order_lock(order_id):
-    """الحصول على قفل خاص بطلب معين"""
-    if order_id not in order_locks:
-        order_locks[order_id] = asyncio.Lock()
-    return order_locks[order_id]
+
+class _OrderLockEntry:
+    __slots__ = ("lock", "holders")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.holders = 0  # عدد من يحمل القفل أو ينتظره
+
+
+class OrderLockRegistry:
+    """سجل أقفال الطلبات: يُنشأ القفل عند أول طالب ويُحذف عند تحرير آخر حامل له"""
+
+    def __init__(self):
+        self._entries = {}
+
+        # 📊 مقاييس التنافس على الأقفال
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def acquire(self, order_id):
+        entry = self._entries.get(order_id)
+        if entry is None:
+            entry = self._entries[order_id] = _OrderLockEntry()
+        entry.holders += 1
+
+        try:
+            contended = entry.lock.locked()
+            start = time.monotonic()
+            async with entry.lock:
+                waited = time.monotonic() - start
+                self.acquisitions += 1
+                self.total_wait += waited
+                if contended:
+                    self.contended += 1
+                if waited > self.max_wait:
+                    self.max_wait = waited
+                yield
+        finally:
+            entry.holders -= 1
+            if entry.holders == 0 and self._entries.get(order_id) is entry:
+                del self._entries[order_id]
+
+    def stats(self):
+        return {
+            "active": len(self._entries),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "avg_wait": self.total_wait / self.acquisitions if self.acquisitions else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+order_locks = OrderLockRegistry()
+
+
+def order_lock(order_id):
+    """قفل تزامن خاص بطلب معين: async with order_lock(order_id)"""
+    return order_locks.acquire(order_id)
 
 
 # دالة لإضافة طلب إلى قائمة الانتظار
@@ -77,51 +257,451 @@ async def process_order_queue():
         await asyncio.sleep(0.1)
 
 
+# 🔹 إعدادات محدد معدل الإرسال (حدود Telegram)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))  # رسالة/ثانية لكل البوت
+TG_PRIVATE_CHAT_RATE = float(os.getenv("TG_PRIVATE_CHAT_RATE", 1))  # رسالة/ثانية لكل محادثة خاصة
+TG_GROUP_CHAT_RATE_PER_MIN = float(os.getenv("TG_GROUP_CHAT_RATE_PER_MIN", 20))  # رسالة/دقيقة لكل مجموعة أو قناة
+TG_GROUP_CHAT_BURST = int(os.getenv("TG_GROUP_CHAT_BURST", 3))
+
+
 # محدد معدل الطلبات
-# محدد معدل الطلبات
-class RateLimiter:
-    def __init__(self, max_calls, period):
-        self.max_calls = max_calls
-        self.period = period
-        self.calls = deque()
+class TokenBucket:
+    """دلو رموز يخدم المنتظرين بترتيب وصولهم (FIFO)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # asyncio.Lock يوقظ المنتظرين بترتيب وصولهم، فلا يتجاوز أحدٌ من سبقه
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+    def try_acquire(self):
+        """أخذ رمز دون انتظار؛ يُرجع 0 عند النجاح أو المدة المقدرة حتى يتوفر رمز"""
+        self._refill(time.monotonic())
+        if self._lock.locked():
+            # منتظرون سابقون عبر acquire لهم الأولوية
+            return max((1 - self.tokens) / self.rate, 1 / self.rate)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
 
     async def acquire(self):
-        now = time.time()
-        while self.calls and self.calls[0] < now - self.period:
-            self.calls.popleft()
-        if len(self.calls) >= self.max_calls:
-            wait_time = self.calls[0] + self.period - now
-            await asyncio.sleep(wait_time)
-        self.calls.append(time.time())
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-telegram_limiter = RateLimiter(max_calls=30, period=1)
+
+# (bot_id, chat_id) حجز الموزّع رمزه للمهمة التي ينفذها العامل الحالي
+reserved_chat_token = contextvars.ContextVar("reserved_chat_token", default=None)
+
+
+class RateLimiter:
+    """محدد معدل هرمي: دلو عام لكل بوت + دلو لكل (بوت، chat_id)؛ Telegram يطبق حدوده على كل بوت على حدة"""
+
+    MAX_IDLE_BUCKETS = 1000
+
+    def __init__(self, global_rate, private_rate, group_rate_per_min, group_burst):
+        self.global_rate = global_rate
+        self.global_buckets = {}  # bot_id -> دلو
+        self.private_rate = private_rate
+        self.group_rate = group_rate_per_min / 60
+        self.group_burst = group_burst
+        self.chat_buckets = {}  # (bot_id, chat_id) -> دلو
+
+        # 📊 مقاييس زمن الانتظار
+        self.acquired = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _global_bucket(self, bot_id):
+        bucket = self.global_buckets.get(bot_id)
+        if bucket is None:
+            bucket = self.global_buckets[bot_id] = TokenBucket(self.global_rate, self.global_rate)
+        return bucket
+
+    def _chat_bucket(self, bot_id, chat_id):
+        key = (bot_id, chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_IDLE_BUCKETS:
+                self._prune_idle()
+            # المعرفات السالبة تعني مجموعة أو قناة
+            if int(chat_id) < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, 1)
+            self.chat_buckets[key] = bucket
+        return bucket
+
+    def _prune_idle(self):
+        now = time.monotonic()
+        for key in [k for k, b in self.chat_buckets.items() if b.is_idle(now)]:
+            del self.chat_buckets[key]
+
+    def reserve_chat(self, bot_id, chat_id):
+        """حجز رمز الوجهة مسبقًا (للموزّع)؛ يُرجع 0 عند النجاح أو المدة حتى يتوفر رمز"""
+        return self._chat_bucket(bot_id, chat_id).try_acquire()
+
+    async def acquire(self, bot_id, chat_id=None):
+        start = time.monotonic()
+
+        if chat_id is not None:
+            if reserved_chat_token.get() == (bot_id, chat_id):
+                # الموزّع حجز رمز هذه الوجهة قبل تسليم المهمة للعامل: يُستهلك مرة واحدة فقط
+                reserved_chat_token.set(None)
+            else:
+                await self._chat_bucket(bot_id, chat_id).acquire()
+        await self._global_bucket(bot_id).acquire()
+
+        waited = time.monotonic() - start
+        self.acquired += 1
+        self.total_wait += waited
+        if waited > 0.001:
+            self.delayed += 1
+        if waited > self.max_wait:
+            self.max_wait = waited
+
+    def stats(self):
+        return {
+            "acquired": self.acquired,
+            "delayed": self.delayed,
+            "avg_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait": self.max_wait,
+            "bots": len(self.global_buckets),
+            "chats": len(self.chat_buckets),
+        }
+
+
+telegram_limiter = RateLimiter(
+    global_rate=TG_GLOBAL_RATE,
+    private_rate=TG_PRIVATE_CHAT_RATE,
+    group_rate_per_min=TG_GROUP_CHAT_RATE_PER_MIN,
+    group_burst=TG_GROUP_CHAT_BURST,
+)
+
+# 🚦 حد قبول عام اختياري للطلبات الجديدة (0 = بدون حد)؛ الترتيب مضمون لكل طلب عبر order_lock
+ORDER_ADMISSION_RATE = float(os.getenv("ORDER_ADMISSION_RATE", 0))  # طلب/ثانية
+ORDER_ADMISSION_BURST = int(os.getenv("ORDER_ADMISSION_BURST", 10))
+
+order_admission = TokenBucket(ORDER_ADMISSION_RATE, ORDER_ADMISSION_BURST) if ORDER_ADMISSION_RATE > 0 else None
 
 async def send_message_with_rate_limit(bot, chat_id, text, **kwargs):
-    await telegram_limiter.acquire()
+    await telegram_limiter.acquire(bot.id, chat_id)
     return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
 
 
+async def edit_reply_markup_with_rate_limit(bot, chat_id, message_id, reply_markup=None):
+    await telegram_limiter.acquire(bot.id, chat_id)
+    return await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+
+
+async def send_location_with_rate_limit(bot, chat_id, latitude, longitude, **kwargs):
+    await telegram_limiter.acquire(bot.id, chat_id)
+    return await bot.send_location(chat_id=chat_id, latitude=latitude, longitude=longitude, **kwargs)
+
+
+async def edit_query_reply_markup(query, reply_markup=None):
+    """تعديل أزرار رسالة زر الاستعلام مع احترام حدود المعدل"""
+    await telegram_limiter.acquire(query.get_bot().id, query.message.chat_id)
+    return await query.edit_message_reply_markup(reply_markup=reply_markup)
+
+
+# 🔹 إعدادات سياسة إعادة المحاولة وقاطع الدائرة
+SEND_RETRY_BASE_DELAY = float(os.getenv("SEND_RETRY_BASE_DELAY", 0.5))
+SEND_RETRY_MAX_DELAY = float(os.getenv("SEND_RETRY_MAX_DELAY", 8))
+SEND_RETRY_AFTER_JITTER = float(os.getenv("SEND_RETRY_AFTER_JITTER", 0.5))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+
+# تصنيفات أخطاء الإرسال
+ERROR_FLOOD = "flood"          # RetryAfter: ننتظر المدة التي يحددها Telegram بالضبط
+ERROR_TRANSIENT = "transient"  # أخطاء شبكة مؤقتة: تصاعد زمني مع عشوائية
+ERROR_PERMANENT = "permanent"  # أخطاء لن تنجح مهما أعدنا (BadRequest, Forbidden...)
+
+
+class MessageDeliveryError(Exception):
+    """فشل نهائي في إرسال رسالة إلى Telegram"""
+
+
+class CircuitOpenError(MessageDeliveryError):
+    """قاطع الدائرة مفتوح لهذه الوجهة، نرفض الإرسال فورًا"""
+
+
+def classify_send_error(error):
+    # ⚠️ BadRequest مشتق من NetworkError في مكتبة telegram لذلك نفحصه أولاً
+    if isinstance(error, RetryAfter):
+        return ERROR_FLOOD
+    if isinstance(error, (BadRequest, Forbidden, InvalidToken, ChatMigrated)):
+        return ERROR_PERMANENT
+    if isinstance(error, TelegramError):
+        return ERROR_TRANSIENT
+    return ERROR_PERMANENT
+
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        delay = delay.total_seconds()
+    return float(delay)
+
+
+class CircuitBreaker:
+    """قاطع دائرة لكل وجهة: يفتح بعد عدد من الإخفاقات المتتالية ويسمح بمحاولة تجريبية بعد المهلة"""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        # نصف مفتوح: نسمح بمحاولة تجريبية واحدة فقط
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+circuit_breakers = {}  # (bot_id, chat_id) -> قاطع: إخفاقات بوت مطعم لا توقف إرسال بوت آخر للوجهة نفسها
+
+def get_circuit_breaker(bot_id, chat_id):
+    key = (bot_id, chat_id)
+    breaker = circuit_breakers.get(key)
+    if breaker is None:
+        breaker = circuit_breakers[key] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+    return breaker
+
+
 # دالة لإرسال رسالة مع إعادة المحاولة + Rate Limiting
 async def send_message_with_retry(bot, chat_id, text, order_id=None, max_retries=5, **kwargs):
-    message_id = str(uuid.uuid4())
+    breaker = get_circuit_breaker(bot.id, chat_id)
+
+    # ✅ إزالة أي مفاتيح غير مدعومة
+    kwargs.pop("message_id", None)
 
     for attempt in range(max_retries):
+        if not breaker.allow():
+            raise CircuitOpenError(f"⛔️ قاطع الدائرة مفتوح للوجهة {chat_id}، لن نحاول الإرسال الآن.")
+
         try:
             # ✅ التحكم بمعدل الإرسال
-            await telegram_limiter.acquire()
-
-            # ✅ إزالة أي مفاتيح غير مدعومة
-            kwargs.pop("message_id", None)
+            await telegram_limiter.acquire(bot.id, chat_id)
 
             # ✅ إرسال الرسالة
             sent_message = await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            breaker.record_success()
             return sent_message
 
         except Exception as e:
-            logger.error(f"فشل في إرسال الرسالة (المحاولة {attempt+1}/{max_retries}): {e}")
-            await asyncio.sleep(0.5 * (2 ** attempt))  # تصاعد زمني
+            error_class = classify_send_error(e)
+
+            if error_class == ERROR_PERMANENT:
+                # الوجهة وصلت إلى Telegram لكن الطلب نفسه مرفوض، فلا نعدّها عطلاً في الوجهة
+                breaker.record_success()
+                logger.error(f"❌ خطأ نهائي في إرسال الرسالة إلى {chat_id} (order_id={order_id}): {e}")
+                raise MessageDeliveryError(f"رفض Telegram الرسالة: {e}") from e
+
+            if error_class == ERROR_FLOOD:
+                breaker.record_success()
+                delay = retry_after_seconds(e) + random.uniform(0, SEND_RETRY_AFTER_JITTER)
+                logger.warning(f"🚦 تجاوز حد الإرسال للوجهة {chat_id}، انتظار {delay:.2f} ثانية (المحاولة {attempt+1}/{max_retries})")
+            else:
+                breaker.record_failure()
+                # تصاعد زمني مع عشوائية كاملة حتى لا تتزامن المحاولات
+                delay = random.uniform(0, min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * (2 ** attempt)))
+                logger.error(f"فشل في إرسال الرسالة (المحاولة {attempt+1}/{max_retries}): {e}")
+
+            if attempt + 1 < max_retries:
+                await asyncio.sleep(delay)
+
+    raise MessageDeliveryError(f"فشلت جميع المحاولات لإرسال الرسالة.")
+
+
+# 🔹 أولويات الإرسال: الأصغر يُرسل أولاً
+PRIORITY_CRITICAL = 0  # طلب جديد، قبول، رفض
+PRIORITY_NORMAL = 1    # تأكيدات الكاشير، الشكاوى، الإلغاء
+PRIORITY_INFO = 2      # التقييمات، التذكيرات، الاستفسارات
+
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 8))
+
+
+class OutboundDispatcher:
+    """موزّع مركزي للرسائل الصادرة: مسار أولويات لكل وجهة + مجموعة عمّال تُرسل بالتوازي
+
+    كل دوال الإرسال المجدولة تأخذ (bot, chat_id) أولاً. تنتظر المهمة في مسار وجهتها حتى يتوفر
+    رمز في دلوها، ثم تنتقل إلى طابور العمّال؛ فلا يحجز ازدحام وجهة محدودة المعدل (الكاشير)
+    العمّالَ عن وجهات أخرى رموزها متاحة.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()  # مهام حُجز رمز وجهتها وتنتظر عاملاً
+        self._lanes = {}  # (bot_id, chat_id) -> كومة مهام بانتظار رمز الوجهة
+        self._timers = {}  # (bot_id, chat_id) -> موعد إعادة المحاولة
+        self._sequence = itertools.count()
+        self._tasks = []
+        self._pending = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    def submit(self, priority, send, bot, chat_id, *args, **kwargs):
+        """جدولة مهمة إرسال/تعديل وإرجاع Future بنتيجتها"""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        key = (bot.id, chat_id)
+        # الرقم التسلسلي يحفظ ترتيب الوصول داخل الأولوية نفسها
+        job = (priority, next(self._sequence), key, send, (bot, chat_id) + args, kwargs, future)
+        heapq.heappush(self._lanes.setdefault(key, []), job)
+        self._pending += 1
+        self._drained.clear()
+        self._pump(key)
+        return future
+
+    def _pump(self, key):
+        """نقل مهام الوجهة إلى طابور العمّال ما دام في دلوها رموز"""
+        lane = self._lanes.get(key)
+        while lane:
+            delay = telegram_limiter.reserve_chat(*key)
+            if delay > 0:
+                if key not in self._timers:
+                    self._timers[key] = asyncio.get_running_loop().call_later(delay, self._wake, key)
+                return
+            self.queue.put_nowait(heapq.heappop(lane))
+        self._lanes.pop(key, None)
+
+    def _wake(self, key):
+        self._timers.pop(key, None)
+        self._pump(key)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
 
-    raise Exception(f"فشلت جميع المحاولات لإرسال الرسالة.")
+    async def stop(self, timeout=None):
+        """انتظار إرسال كل المهام المجدولة ثم إيقاف العمّال"""
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ انتهت مهلة تفريغ طابور الإرسال، بقي {self._pending} رسالة.")
+
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        # ما لم يُرسل ضمن المهلة يُلغى حتى لا يبقى من ينتظر نتيجته معلقًا
+        leftovers = [job for lane in self._lanes.values() for job in lane]
+        while not self.queue.empty():
+            leftovers.append(self.queue.get_nowait())
+        for job in leftovers:
+            job[-1].cancel()
+        self._lanes.clear()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "pending": self._pending,
+            "ready": self.queue.qsize(),
+            "waiting_lanes": len(self._lanes),
+        }
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"❌ فشلت مهمة إرسال من الموزّع: {future.exception()}")
+
+    async def _worker(self):
+        while True:
+            _, _, key, send, args, kwargs, future = await self.queue.get()
+            try:
+                if not future.cancelled():
+                    # رمز الوجهة محجوز مسبقًا؛ يبقى الدلو العام للبوت فقط
+                    reserved_chat_token.set(key)
+                    result = await send(*args, **kwargs)
+                    if not future.done():
+                        future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                reserved_chat_token.set(None)
+                self.queue.task_done()
+                self._pending -= 1
+                if not self._pending:
+                    self._drained.set()
+
+
+outbound = OutboundDispatcher(workers=OUTBOUND_WORKERS)
+
+
+def dispatch_message(bot, chat_id, text, priority=PRIORITY_NORMAL, order_id=None, destination=None, **kwargs):
+    """جدولة رسالة عبر الموزّع مع تسجيلها في سجل التتبع"""
+    if destination:
+        audit_buffer.enqueue(str(uuid.uuid4()), order_id or "unknown", "restaurant_bot", destination, text)
+    return outbound.submit(priority, send_message_with_retry, bot, chat_id, text, order_id=order_id, **kwargs)
+
+
+def dispatch_edit_reply_markup(bot, chat_id, message_id, reply_markup=None, priority=PRIORITY_NORMAL):
+    """جدولة تعديل أزرار رسالة عبر الموزّع"""
+    return outbound.submit(priority, edit_reply_markup_with_rate_limit, bot, chat_id, message_id, reply_markup)
+
+
+# 🔹 المهام الخلفية المتتبعة (بدل create_task بدون مرجع)
+background_tasks = set()
+
+
+def _on_background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"❌ مهمة خلفية انتهت بخطأ: {task.exception()}")
+
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
 
 
 async def start_order_queue_processor():
@@ -137,11 +717,12 @@ async def start_order_queue_processor():
 
 
 
-# دالة لتحديث حالة الطلب في قاعدة البيانات المشتركة
-async def update_order_status(order_id, status, bot_type):
+# دالة لتحديث حالة الطلب في جدول order_status المشترك بين بوت الزبائن وبوت المطعم
+# (كانت تحمل اسم update_order_status نفسه فتحجبها دالة جدول orders المعرّفة لاحقًا)
+async def sync_shared_order_status(order_id, status, bot_type):
     async with get_db_connection() as conn:
         async with conn.cursor() as cursor:
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
             # تحديث الحالة وتوقيت آخر مزامنة حسب نوع البوت
             if bot_type == "user":
@@ -167,21 +748,73 @@ async def update_order_status(order_id, status, bot_type):
 # ✅ مسار قاعدة البيانات
 DB_PATH = "restaurant_orders.db"
 
-@asynccontextmanager
-async def get_db_connection():
-    conn = await aiomysql.connect(
+# 🔹 مجمع اتصالات مشترك على مستوى العملية (يُنشأ مرة واحدة في run_bot)
+db_pool = None
+_db_conn_last_used = weakref.WeakKeyDictionary()
+
+
+async def init_db_pool():
+    """إنشاء مجمع اتصالات MySQL المشترك"""
+    global db_pool
+    if db_pool is not None:
+        return db_pool
+
+    db_pool = await aiomysql.create_pool(
         host=DB_HOST,
         user=DB_USER,
         password=DB_PASSWORD,
         db=DB_NAME,
         port=DB_PORT,
         charset='utf8mb4',
-        autocommit=False
+        autocommit=False,
+        minsize=DB_POOL_MINSIZE,
+        maxsize=DB_POOL_MAXSIZE,
+        pool_recycle=DB_POOL_RECYCLE,
     )
+    logger.info(f"✅ تم إنشاء مجمع اتصالات قاعدة البيانات (min={DB_POOL_MINSIZE}, max={DB_POOL_MAXSIZE})")
+    return db_pool
+
+
+async def close_db_pool():
+    """إغلاق مجمع الاتصالات بانتظار إعادة جميع الاتصالات المستخدمة"""
+    global db_pool
+    if db_pool is None:
+        return
+
+    pool, db_pool = db_pool, None
+    pool.close()
+    await pool.wait_closed()
+    logger.info("🛑 تم إغلاق مجمع اتصالات قاعدة البيانات.")
+
+
+@asynccontextmanager
+async def get_db_connection():
+    """استعارة اتصال من المجمع المشترك وإعادته بعد الاستخدام"""
+    pool = db_pool or await init_db_pool()
+
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"⏳ انتهت مهلة انتظار اتصال من المجمع ({DB_POOL_ACQUIRE_TIMEOUT} ثانية)")
+        raise
+
     try:
+        # ✅ فحص الاتصالات الخاملة لفترة طويلة قبل استخدامها (قد يكون الخادم أغلقها)
+        last_used = _db_conn_last_used.get(conn, 0)
+        if time.monotonic() - last_used > DB_POOL_PING_IDLE:
+            await conn.ping(reconnect=True)
+
         yield conn
     finally:
-        conn.close()
+        try:
+            # aiomysql يغلق أي اتصال يُعاد وهو داخل معاملة مفتوحة، لذلك نتراجع عن أي معاملة غير مؤكدة
+            if not conn.closed and conn.get_transaction_status():
+                await conn.rollback()
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر إنهاء المعاملة قبل إعادة الاتصال للمجمع: {e}")
+            conn.close()
+        _db_conn_last_used[conn] = time.monotonic()
+        pool.release(conn)
 
         
 async def initialize_database():
@@ -242,22 +875,51 @@ logger = logging.getLogger(__name__)
 
 
 
-if len(sys.argv) < 2:
-    print("❌ يرجى تمرير اسم ملف الإعداد: مثال ➜ python3 restaurant.py Almalek")
-    sys.exit(1)
+# 🔹 إعدادات المطعم (تُحمّل من config/<اسم المطعم>.json عند التشغيل)
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+
+TENANT_KEY = "tenant"  # مفتاح المطعم داخل context.bot_data
+
+
+class RestaurantTenant:
+    """مطعم واحد: إعداده وحالته الخاصة، بينما مجمع قاعدة البيانات والمرسل مشتركان بين المطاعم"""
+
+    def __init__(self, key, config):
+        self.key = key
+        self.token = config["token"]
+        self.channel_id = config["channel_id"]
+        self.cashier_chat_id = config["cashier_id"]
+        self.complaints_chat_id = config["complaints_channel_id"]
+        self.restaurant_id = config["restaurant_id"]
+        self.restaurant_name = config["restaurant_name"]
+
+        # 🧾 حالة خاصة بالمطعم: الطلبات الحية وأرقام callback، وربط المواقع برسائل قناته
+        self.orders = OrderStore(self.restaurant_id, max_size=ORDER_STORE_MAX_SIZE, ttl=ORDER_STORE_TTL)
+        self.locations = LocationCorrelator(grace=LOCATION_GRACE_SECONDS)
+        self.app = None
+
+
+def load_restaurant_config(restaurant_key):
+    """تحميل ملف إعداد مطعم واحد"""
+    with open(os.path.join(CONFIG_DIR, f"{restaurant_key}.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    return RestaurantTenant(restaurant_key, config)
+
+
+def load_all_restaurant_configs():
+    """تحميل كل ملفات config/*.json لتشغيلها في عملية واحدة"""
+    keys = sorted(name[:-len(".json")] for name in os.listdir(CONFIG_DIR) if name.endswith(".json"))
+    tenants = [load_restaurant_config(key) for key in keys]
 
-restaurant_key = sys.argv[1]
-CONFIG_FILE = f"config/{restaurant_key}.json"
+    restaurant_ids = [tenant.restaurant_id for tenant in tenants]
+    if len(set(restaurant_ids)) != len(restaurant_ids):
+        raise ValueError(f"❌ معرف مطعم مكرر في ملفات الإعداد: {restaurant_ids}")
+    return tenants
 
-with open(CONFIG_FILE, encoding="utf-8") as f:
-    config = json.load(f)
 
-TOKEN = config["token"]
-CHANNEL_ID = config["channel_id"]
-CASHIER_CHAT_ID = config["cashier_id"]
-RESTAURANT_COMPLAINTS_CHAT_ID = config["complaints_channel_id"]
-RESTAURANT_ID = config["restaurant_id"]
-RESTAURANT_NAME = config["restaurant_name"]
+def tenant_of(context):
+    """المطعم الذي وصل التحديث عبر بوته"""
+    return context.bot_data[TENANT_KEY]
 
 
 
@@ -270,83 +932,997 @@ DB_USER = "botuser"
 DB_PASSWORD = "strongpassword123"
 DB_NAME = "telegram_bot"
 
+# إعدادات مجمع الاتصالات (يمكن تعديلها عبر متغيرات البيئة)
+DB_POOL_MINSIZE = int(os.getenv("DB_POOL_MINSIZE", 2))
+DB_POOL_MAXSIZE = int(os.getenv("DB_POOL_MAXSIZE", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 3600))  # إعادة تدوير الاتصالات الأقدم من ساعة
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", 60))  # فحص الاتصال إذا بقي خاملاً أكثر من دقيقة
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 10))
+
 
 
 # 🔹 إدارة الطلبات المؤقتة
-pending_orders = {}
+ORDER_STORE_MAX_SIZE = int(os.getenv("ORDER_STORE_MAX_SIZE", 2000))
+ORDER_STORE_TTL = float(os.getenv("ORDER_STORE_TTL", 6 * 3600))  # ثوانٍ منذ آخر استخدام
+ORDER_STORE_SWEEP_INTERVAL = float(os.getenv("ORDER_STORE_SWEEP_INTERVAL", 300))
+ORDER_HYDRATE_MAX_AGE = float(os.getenv("ORDER_HYDRATE_MAX_AGE", 24 * 3600))  # أقدم طلب يُحمَّل عند التشغيل (ثوانٍ)
+ORDER_HYDRATE_CHUNK_SIZE = int(os.getenv("ORDER_HYDRATE_CHUNK_SIZE", 500))
+PENDING_WRITE_BATCH_SIZE = int(os.getenv("PENDING_WRITE_BATCH_SIZE", 200))
+PENDING_WRITE_MAX_STALENESS = float(os.getenv("PENDING_WRITE_MAX_STALENESS", 2.0))  # أقصى تأخير لحفظ تغيير غير نهائي
+
+# حالات الطلب
+ORDER_STATUS_PENDING = "pending"
+ORDER_STATUS_ACCEPTED = "accepted"
+ORDER_STATUS_OUT_FOR_DELIVERY = "out_for_delivery"
+ORDER_STATUS_DELIVERED = "delivered"
+ORDER_STATUS_RATED = "rated"
+ORDER_STATUS_CANCELLED = "cancelled"
+ORDER_STATUS_REJECTED = "rejected"
+
+TERMINAL_ORDER_STATUSES = (
+    ORDER_STATUS_DELIVERED,
+    ORDER_STATUS_RATED,
+    ORDER_STATUS_CANCELLED,
+    ORDER_STATUS_REJECTED,
+)
+
 pending_locations = {}
 
 
-# حفظ الطلب المؤقت في قاعدة البيانات
-async def save_pending_order(order_id, order_details, channel_message_id, cashier_message_id, location=None):
+class OrderRecord:
+    """سجل طلب مضغوط في الذاكرة"""
+
+    __slots__ = (
+        "order_id",
+        "order_number",
+        "order_details",
+        "channel_message_id",
+        "message_id",
+        "location",
+        "selected_time",
+        "status",
+        "created_at",
+        "touched_at",
+        "handle",
+    )
+
+    def __init__(self, order_id, order_details, channel_message_id=None, message_id=None,
+                 location=None, selected_time=None, status=ORDER_STATUS_PENDING, created_at=None,
+                 order_number=None, handle=None):
+        self.order_id = order_id
+        self.order_number = order_number  # يُستخرج مرة واحدة عند الاستقبال
+        self.handle = handle  # رقم قصير يمثل الطلب داخل callback_data
+        self.order_details = order_details
+        self.channel_message_id = channel_message_id
+        self.message_id = message_id  # معرف رسالة الطلب عند الكاشير
+        self.location = location
+        self.selected_time = selected_time
+        self.status = status
+        self.created_at = created_at or time.time()
+        self.touched_at = time.monotonic()
+
+
+class OrderStore:
+    """مخزن الطلبات الحية: حد أقصى للحجم (LRU) مع انتهاء صلاحية وإخراج عند الحالة النهائية"""
+
+    def __init__(self, restaurant_id, max_size, ttl):
+        self.restaurant_id = restaurant_id
+        self.max_size = max_size
+        self.ttl = ttl
+        self._orders = OrderedDict()
+        # 🔎 فهارس ثانوية: رقم الطلب / رقم رسالة الكاشير / رقم callback -> order_id
+        self._by_number = {}
+        self._by_message_id = {}
+        self._by_handle = {}
+        self._last_handle = 0
+        self._sweeper = None
+
+        # 📊 مقاييس
+        self.evicted = 0
+        self.spilled = 0
+        self.db_loads = 0
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def values(self):
+        return list(self._orders.values())
+
+    def peek(self, order_id):
+        """قراءة الطلب من الذاكرة فقط"""
+        record = self._orders.get(order_id)
+        if record is not None:
+            record.touched_at = time.monotonic()
+            self._orders.move_to_end(order_id)
+        return record
+
+    def find_by_number(self, order_number):
+        """البحث عن طلب حي برقمه دون المرور على كل الطلبات"""
+        order_id = self._by_number.get(order_number)
+        return self.peek(order_id) if order_id is not None else None
+
+    def find_by_message_id(self, message_id):
+        """البحث عن طلب حي برقم رسالته عند الكاشير"""
+        order_id = self._by_message_id.get(message_id)
+        return self.peek(order_id) if order_id is not None else None
+
+    def reserve_handle(self):
+        """حجز رقم callback جديد قبل بناء أزرار الطلب"""
+        self._last_handle += 1
+        return self._last_handle
+
+    def seed_handles(self, last_handle):
+        """متابعة الترقيم بعد آخر رقم محفوظ حتى لا تشير أزرار قديمة إلى طلب جديد"""
+        self._last_handle = max(self._last_handle, last_handle or 0)
+
+    async def get_by_handle(self, handle):
+        """قراءة الطلب برقم callback من الذاكرة، أو من قاعدة البيانات إذا أُخرج منها"""
+        order_id = self._by_handle.get(handle)
+        if order_id is not None:
+            return self.peek(order_id)
+
+        order_id = pending_order_writer.find_by_handle(self.restaurant_id, handle)
+        if order_id is not None and not await self._flush_pending(order_id):
+            return None
+        record = await fetch_pending_order_by_handle(self.restaurant_id, handle)
+        if record is not None:
+            self.db_loads += 1
+            self.put(record)
+        return record
+
+    async def get(self, order_id):
+        """قراءة الطلب من الذاكرة، أو من قاعدة البيانات إذا أُخرج منها سابقًا"""
+        record = self.peek(order_id)
+        if record is not None or not order_id:
+            return record
+
+        if not await self._flush_pending(order_id):
+            return None
+        record = await fetch_pending_order(order_id)
+        if record is not None:
+            self.db_loads += 1
+            self.put(record)
+        return record
+
+    async def _flush_pending(self, order_id):
+        """كتابة أي حالة معلقة للطلب قبل قراءته من قاعدة البيانات حتى لا نقرأ صفًا أقدم منها"""
+        try:
+            await pending_order_writer.flush_order(order_id)
+            return True
+        except Exception as e:
+            logger.error(f"❌ تعذر حفظ الحالة المعلقة للطلب {order_id} قبل تحميله: {e}")
+            return False
+
+    def put(self, record):
+        previous = self._orders.get(record.order_id)
+        if previous is not None:
+            self._unindex(previous)
+            if record.handle is None:
+                record.handle = previous.handle
+        if record.handle is None:
+            record.handle = self.reserve_handle()
+        else:
+            self.seed_handles(record.handle)
+
+        self._orders[record.order_id] = record
+        self._orders.move_to_end(record.order_id)
+        record.touched_at = time.monotonic()
+        self._index(record)
+
+        # 💾 تجاوز الحد الأقصى: نكتب الأقدم استخدامًا في MySQL ونخرجه من الذاكرة
+        while len(self._orders) > self.max_size:
+            _, oldest = self._orders.popitem(last=False)
+            self._unindex(oldest)
+            self.spilled += 1
+            self.persist(oldest)
+
+    def hydrate(self, record):
+        """إدخال طلب محمّل عند التشغيل في الطرف الأبرد من LRU دون إخراج غيره؛ يُرجع False عند امتلاء المخزن"""
+        if record.order_id in self._orders:
+            return True
+        if len(self._orders) >= self.max_size:
+            return False
+        if record.handle is None:
+            record.handle = self.reserve_handle()
+        else:
+            self.seed_handles(record.handle)
+
+        self._orders[record.order_id] = record
+        self._orders.move_to_end(record.order_id, last=False)
+        self._index(record)
+        return True
+
+    def discard(self, order_id):
+        """إخراج طلب من الذاكرة دون حفظه (حالته في قاعدة البيانات أحدث)"""
+        record = self._orders.pop(order_id, None)
+        if record is not None:
+            self._unindex(record)
+        return record
+
+    def _index(self, record):
+        if record.order_number is not None:
+            self._by_number[record.order_number] = record.order_id
+        if record.message_id is not None:
+            self._by_message_id[record.message_id] = record.order_id
+        self._by_handle[record.handle] = record.order_id
+
+    def _unindex(self, record):
+        # لا نحذف المدخل إذا صار يشير إلى طلب أحدث بنفس الرقم
+        if self._by_number.get(record.order_number) == record.order_id:
+            del self._by_number[record.order_number]
+        if self._by_message_id.get(record.message_id) == record.order_id:
+            del self._by_message_id[record.message_id]
+        if self._by_handle.get(record.handle) == record.order_id:
+            del self._by_handle[record.handle]
+
+    async def finish(self, order_id, status):
+        """نقل الطلب إلى حالة نهائية: حفظ الحالة في قاعدة البيانات وإخراجه من الذاكرة"""
+        record = self._orders.pop(order_id, None)
+        if record is None:
+            # قد تكون للطلب كتابة معلقة منذ إخراجه من الذاكرة: تُكتب أولاً حتى لا تُرجع حالته بعد التحديث
+            await pending_order_writer.flush_order(order_id)
+            await update_pending_order_status(order_id, status)
+            return None
+
+        self._unindex(record)
+        record.status = status
+        self.evicted += 1
+        await pending_order_writer.write_now(record, self.restaurant_id)
+        return record
+
+    def persist(self, record):
+        """تسجيل آخر حالة للطلب لتُكتب ضمن الدفعة التالية"""
+        pending_order_writer.mark(record, self.restaurant_id)
+
+    def evict_expired(self):
+        deadline = time.monotonic() - self.ttl
+        expired = [r for r in self._orders.values() if r.touched_at < deadline]
+        for record in expired:
+            del self._orders[record.order_id]
+            self._unindex(record)
+            self.evicted += 1
+            self.persist(record)
+        return len(expired)
+
+    def start(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        """إيقاف التنظيف الدوري وتسجيل الحالة الحالية لكل الطلبات الحية (يكتبها pending_order_writer.stop)"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+        for record in self.values():
+            self.persist(record)
+
+    def stats(self):
+        return {
+            "size": len(self._orders),
+            "indexed_numbers": len(self._by_number),
+            "indexed_messages": len(self._by_message_id),
+            "last_handle": self._last_handle,
+            "evicted": self.evicted,
+            "spilled": self.spilled,
+            "db_loads": self.db_loads,
+        }
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(ORDER_STORE_SWEEP_INTERVAL)
+            expired = self.evict_expired()
+            if expired:
+                logger.info(f"🧹 تم إخراج {expired} طلب منتهي الصلاحية من الذاكرة ({self.stats()})")
+
+
+async def ensure_column(cursor, table, column, definition):
+    """إضافة عمود إلى جدول موجود إذا لم يكن موجودًا (MySQL لا يدعم ADD COLUMN IF NOT EXISTS)"""
+    await cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column)
+    )
+    (exists,) = await cursor.fetchone()
+    if not exists:
+        await cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"🛠️ تمت إضافة العمود {table}.{column}")
+
+
+async def ensure_index(cursor, table, index_name, columns):
+    await cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table, index_name)
+    )
+    (exists,) = await cursor.fetchone()
+    if not exists:
+        await cursor.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
+        logger.info(f"🛠️ تم إنشاء الفهرس {index_name} على {table}")
+
+
+async def migrate_pending_orders_table():
+    """التأكد من أن جدول pending_orders يحتوي أعمدة الحالة والتوقيت"""
     async with get_db_connection() as conn:
         async with conn.cursor() as cursor:
-            if location:
-                latitude, longitude = location
-                await cursor.execute(
-                    "INSERT INTO pending_orders (order_id, order_details, channel_message_id, cashier_message_id, location_latitude, location_longitude) "
-                    "VALUES (%s, %s, %s, %s, %s, %s) "
-                    "ON DUPLICATE KEY UPDATE order_details = %s, channel_message_id = %s, cashier_message_id = %s, location_latitude = %s, location_longitude = %s",
-                    (order_id, order_details, channel_message_id, cashier_message_id, latitude, longitude,
-                     order_details, channel_message_id, cashier_message_id, latitude, longitude)
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS pending_orders (
+                    order_id VARCHAR(255) PRIMARY KEY,
+                    order_details TEXT,
+                    channel_message_id BIGINT,
+                    cashier_message_id BIGINT,
+                    location_latitude DOUBLE,
+                    location_longitude DOUBLE
                 )
-            else:
+            """)
+            await ensure_column(cursor, "pending_orders", "restaurant_id", "INT NULL")
+            await ensure_column(cursor, "pending_orders", "status", "VARCHAR(32) NOT NULL DEFAULT 'pending'")
+            await ensure_column(cursor, "pending_orders", "selected_time", "VARCHAR(8) NULL")
+            await ensure_column(cursor, "pending_orders", "created_at", "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+            await ensure_column(
+                cursor, "pending_orders", "updated_at",
+                "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"
+            )
+            await ensure_column(cursor, "pending_orders", "order_number", "INT NULL")
+            await ensure_index(cursor, "pending_orders", "idx_pending_orders_status", "restaurant_id, status, created_at")
+            await ensure_column(cursor, "pending_orders", "callback_handle", "BIGINT NULL")
+            await ensure_index(cursor, "pending_orders", "idx_pending_orders_number", "restaurant_id, order_number")
+            await ensure_index(cursor, "pending_orders", "idx_pending_orders_handle", "restaurant_id, callback_handle")
+            await ensure_index(cursor, "pending_orders", "idx_pending_orders_updated", "restaurant_id, updated_at")
+        await conn.commit()
+
+
+# حفظ الطلبات المؤقتة في قاعدة البيانات (upsert متعدد الصفوف)
+PENDING_ORDER_UPSERT_SQL = (
+    "INSERT INTO pending_orders (order_id, restaurant_id, order_number, order_details, channel_message_id, "
+    "cashier_message_id, location_latitude, location_longitude, status, selected_time, callback_handle) VALUES "
+)
+PENDING_ORDER_ROW_PLACEHOLDER = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+# الموقع ورقم الطلب ورقم callback لا تُستبدل بقيمة فارغة إذا كانت محفوظة مسبقًا
+PENDING_ORDER_UPSERT_UPDATE = (
+    " ON DUPLICATE KEY UPDATE order_number = COALESCE(VALUES(order_number), order_number), "
+    "order_details = VALUES(order_details), channel_message_id = VALUES(channel_message_id), "
+    "cashier_message_id = VALUES(cashier_message_id), "
+    "location_latitude = COALESCE(VALUES(location_latitude), location_latitude), "
+    "location_longitude = COALESCE(VALUES(location_longitude), location_longitude), "
+    "status = VALUES(status), selected_time = VALUES(selected_time), "
+    "callback_handle = COALESCE(VALUES(callback_handle), callback_handle)"
+)
+
+
+def pending_order_row(record, restaurant_id):
+    latitude, longitude = record.location or (None, None)
+    return (
+        record.order_id, restaurant_id, record.order_number, record.order_details, record.channel_message_id,
+        record.message_id, latitude, longitude, record.status, record.selected_time, record.handle,
+    )
+
+
+async def save_pending_orders(rows):
+    """كتابة دفعة من صفوف pending_orders في استعلام واحد"""
+    sql = PENDING_ORDER_UPSERT_SQL + ", ".join([PENDING_ORDER_ROW_PLACEHOLDER] * len(rows)) + PENDING_ORDER_UPSERT_UPDATE
+    params = [value for row in rows for value in row]
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+        await conn.commit()
+
+
+class PendingOrderWriter:
+    """دمج كتابات pending_orders: آخر حالة لكل طلب فقط، تُكتب على دفعات خلال مهلة تقادم محددة"""
+
+    def __init__(self, batch_size, max_staleness):
+        self.batch_size = batch_size
+        self.max_staleness = max_staleness
+        self._dirty = {}  # order_id -> آخر صف للطلب، بترتيب أول تغيير
+        self._dirty_event = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        # 🔒 الكتابات متسلسلة: لا تسبق دفعةٌ قديمة الكتابةَ المتزامنة لحالة نهائية
+        self._lock = asyncio.Lock()
+        self._task = None
+
+        # 📊 مقاييس
+        self.marked = 0
+        self.coalesced = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def mark(self, record, restaurant_id):
+        """تسجيل آخر حالة للطلب دون انتظار قاعدة البيانات"""
+        if record.order_id in self._dirty:
+            self.coalesced += 1
+        self._dirty[record.order_id] = pending_order_row(record, restaurant_id)
+        self.marked += 1
+        self._dirty_event.set()
+        if len(self._dirty) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def write_now(self, record, restaurant_id):
+        """كتابة متزامنة لحالة نهائية: تعود بعد حفظها في قاعدة البيانات"""
+        async with self._lock:
+            self._dirty.pop(record.order_id, None)
+            await self._save([pending_order_row(record, restaurant_id)])
+
+    def find_by_handle(self, restaurant_id, handle):
+        """order_id لصف معلق بهذا الرقم (مسار نادر: طلب أُخرج من الذاكرة ولم يُكتب بعد)"""
+        for order_id, row in self._dirty.items():
+            if row[10] == handle and row[1] == restaurant_id:
+                return order_id
+        return None
+
+    async def flush_order(self, order_id):
+        async with self._lock:
+            row = self._dirty.pop(order_id, None)
+            if row is not None:
+                await self._save([row])
+
+    async def flush(self):
+        """كتابة كل ما هو معلق الآن؛ الدفعات الفاشلة تبقى لمحاولة لاحقة"""
+        for _ in range(-(-len(self._dirty) // self.batch_size)):
+            try:
+                await self._flush_batch()
+            except Exception as e:
+                logger.error(f"❌ فشل في كتابة دفعة الطلبات المؤقتة: {e}")
+
+    async def _flush_batch(self):
+        async with self._lock:
+            rows = [self._dirty.pop(order_id) for order_id in list(itertools.islice(self._dirty, self.batch_size))]
+            if rows:
+                await self._save(rows)
+
+    async def _save(self, rows):
+        try:
+            await save_pending_orders(rows)
+        except BaseException:
+            # إعادة الصفوف للمحاولة التالية ما لم تحل محلها حالة أحدث
+            self.failed += len(rows)
+            for row in rows:
+                self._dirty.setdefault(row[0], row)
+            self._dirty_event.set()
+            raise
+        self.written += len(rows)
+        self.batches += 1
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """إيقاف المهمة الخلفية وكتابة كل الحالات المعلقة"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        await self.flush()
+        logger.info(f"💾 تم تفريغ كتابات الطلبات المؤقتة: {self.stats()}")
+
+    def stats(self):
+        return {
+            "pending": len(self._dirty),
+            "marked": self.marked,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
+
+    async def _run(self):
+        while True:
+            await self._dirty_event.wait()
+
+            # ⏳ اكتمال الدفعة أو انقضاء مهلة التقادم، أيهما أسبق
+            if len(self._dirty) < self.batch_size:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.max_staleness)
+                except asyncio.TimeoutError:
+                    pass
+
+            self._dirty_event.clear()
+            failed = self.failed
+            await self.flush()
+            if self.failed > failed:
+                await asyncio.sleep(self.max_staleness)  # قاعدة البيانات متعثرة: لا نعيد المحاولة فورًا
+
+
+pending_order_writer = PendingOrderWriter(PENDING_WRITE_BATCH_SIZE, PENDING_WRITE_MAX_STALENESS)
+
+
+async def update_pending_order_status(order_id, status):
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "UPDATE pending_orders SET status = %s WHERE order_id = %s",
+                (status, order_id)
+            )
+        await conn.commit()
+
+
+def order_record_from_row(row):
+    """بناء OrderRecord من صف pending_orders (DictCursor)"""
+    location = None
+    if row["location_latitude"] is not None and row["location_longitude"] is not None:
+        location = (row["location_latitude"], row["location_longitude"])
+
+    created_at = row.get("created_at")
+    order_number = row.get("order_number")
+    if order_number is None:
+        # صفوف قديمة قبل إضافة العمود: نستخرج الرقم من نص الطلب مرة واحدة
+        order_number = extract_order_number(row["order_details"] or "")
+
+    return OrderRecord(
+        order_id=row["order_id"],
+        order_number=order_number,
+        order_details=row["order_details"],
+        channel_message_id=row["channel_message_id"],
+        message_id=row["cashier_message_id"],
+        location=location,
+        selected_time=row.get("selected_time"),
+        status=row.get("status") or ORDER_STATUS_PENDING,
+        created_at=created_at.timestamp() if created_at else None,
+        handle=row.get("callback_handle"),
+    )
+
+
+PENDING_ORDER_COLUMNS = (
+    "order_id, order_number, order_details, channel_message_id, cashier_message_id, "
+    "location_latitude, location_longitude, status, selected_time, created_at, callback_handle"
+)
+
+
+async def _fetch_one_pending_order(condition, params, label):
+    placeholders = ", ".join(["%s"] * len(TERMINAL_ORDER_STATUSES))
+    try:
+        async with get_db_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
                 await cursor.execute(
-                    "INSERT INTO pending_orders (order_id, order_details, channel_message_id, cashier_message_id) "
-                    "VALUES (%s, %s, %s, %s) "
-                    "ON DUPLICATE KEY UPDATE order_details = %s, channel_message_id = %s, cashier_message_id = %s",
-                    (order_id, order_details, channel_message_id, cashier_message_id,
-                     order_details, channel_message_id, cashier_message_id)
+                    f"SELECT {PENDING_ORDER_COLUMNS} FROM pending_orders "
+                    f"WHERE {condition} AND status NOT IN ({placeholders})",
+                    (*params, *TERMINAL_ORDER_STATUSES)
                 )
-        await conn.commit()
+                row = await cursor.fetchone()
+    except Exception as e:
+        logger.error(f"❌ خطأ أثناء تحميل الطلب {label} من قاعدة البيانات: {e}")
+        return None
+
+    return order_record_from_row(row) if row else None
+
+
+async def fetch_pending_order(order_id):
+    """تحميل طلب غير منتهٍ واحد من قاعدة البيانات"""
+    return await _fetch_one_pending_order("order_id = %s", (order_id,), order_id)
+
+
+async def fetch_pending_order_by_handle(restaurant_id, handle):
+    """تحميل طلب غير منتهٍ برقم callback الخاص به"""
+    return await _fetch_one_pending_order(
+        "restaurant_id = %s AND callback_handle = %s", (restaurant_id, handle), f"#{handle}"
+    )
+
+
+async def load_last_callback_handle(restaurant_id):
+    """آخر رقم callback مستخدم لهذا المطعم، ليتابع المخزن الترقيم بعده"""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT MAX(callback_handle) FROM pending_orders WHERE restaurant_id = %s",
+                (restaurant_id,)
+            )
+            (last_handle,) = await cursor.fetchone()
+    return last_handle or 0
 
 
 # استرجاع الطلبات المؤقتة من قاعدة البيانات عند بدء تشغيل البوت
-async def load_pending_orders():
+async def load_pending_orders(store, max_age=ORDER_HYDRATE_MAX_AGE, chunk_size=ORDER_HYDRATE_CHUNK_SIZE):
+    """تحميل الطلبات الحية الحديثة تدريجيًا عبر مؤشر من جهة الخادم؛ الأقدم منها يُحمَّل عند أول استخدام"""
+    placeholders = ", ".join(["%s"] * len(TERMINAL_ORDER_STATUSES))
+    loaded = 0
+    async with get_db_connection() as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cursor:
+            # ✅ غير المنتهية فقط، ضمن مهلة العمر، والأحدث أولاً حتى سعة المخزن
+            await cursor.execute(
+                f"SELECT {PENDING_ORDER_COLUMNS} FROM pending_orders "
+                f"WHERE restaurant_id = %s AND status NOT IN ({placeholders}) "
+                f"AND created_at >= NOW() - INTERVAL %s SECOND "
+                f"ORDER BY created_at DESC LIMIT %s",
+                (store.restaurant_id, *TERMINAL_ORDER_STATUSES, int(max_age), store.max_size)
+            )
+            full = False
+            while not full:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                # الصفوف تصل من الأحدث إلى الأقدم، فيُدخل كل منها في الطرف الأبرد من LRU
+                for row in rows:
+                    if not store.hydrate(order_record_from_row(row)):
+                        full = True
+                        break
+                    loaded += 1
+    return loaded
+
+
+async def replay_pending_order_changes(store, since, chunk_size=ORDER_HYDRATE_CHUNK_SIZE):
+    """تطبيق صفوف pending_orders المعدلة منذ اللقطة: المنتهية تُخرج من الذاكرة والبقية تُحدَّث"""
+    changed = 0
+    async with get_db_connection() as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cursor:
+            await cursor.execute(
+                f"SELECT {PENDING_ORDER_COLUMNS} FROM pending_orders "
+                f"WHERE restaurant_id = %s AND updated_at >= %s ORDER BY updated_at",
+                (store.restaurant_id, since)
+            )
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    record = order_record_from_row(row)
+                    if record.status in TERMINAL_ORDER_STATUSES:
+                        store.discard(record.order_id)
+                    else:
+                        store.put(record)
+                    changed += 1
+    return changed
+
+
+async def fetch_db_now():
+    """الوقت الحالي حسب MySQL، ليُقارن مباشرة مع updated_at"""
     async with get_db_connection() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("SELECT * FROM pending_orders")
-            rows = await cursor.fetchall()
+            await cursor.execute("SELECT NOW()")
+            (now,) = await cursor.fetchone()
+    return now
+
+
+# 💾 لقطة ثنائية لحالة الطلبات الحية: التشغيل يقرأها بدل إعادة البناء الكامل من MySQL
+ORDER_SNAPSHOT_DIR = os.getenv(
+    "ORDER_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "order_snapshots")
+)  # فارغ = معطّل
+ORDER_SNAPSHOT_INTERVAL = float(os.getenv("ORDER_SNAPSHOT_INTERVAL", 60))
+ORDER_SNAPSHOT_MAGIC = b"RSNP"
+ORDER_SNAPSHOT_VERSION = 1
+# الرأس: العلامة، الإصدار، المطعم، العلامة المائية (وقت MySQL عند الكتابة)، عدد الطلبات، CRC32 للبيانات
+ORDER_SNAPSHOT_HEADER = struct.Struct("<4sHqdII")
+
+
+def order_snapshot_row(record):
+    latitude, longitude = record.location or (None, None)
+    return (
+        record.order_id, record.order_number, record.order_details, record.channel_message_id,
+        record.message_id, latitude, longitude, record.selected_time, record.status,
+        record.created_at, record.handle,
+    )
 
-            for row in rows:
-                order_id = row[0]
-                order_details = row[1]
-                channel_message_id = row[2]
-                cashier_message_id = row[3]
 
-                pending_orders[order_id] = {
-                    "order_details": order_details,
-                    "channel_message_id": channel_message_id,
-                    "message_id": cashier_message_id
-                }
+def order_record_from_snapshot(row):
+    (order_id, order_number, order_details, channel_message_id, message_id, latitude, longitude,
+     selected_time, status, created_at, handle) = row
+    return OrderRecord(
+        order_id=order_id,
+        order_number=order_number,
+        order_details=order_details,
+        channel_message_id=channel_message_id,
+        message_id=message_id,
+        location=(latitude, longitude) if latitude is not None and longitude is not None else None,
+        selected_time=selected_time,
+        status=status,
+        created_at=created_at,
+        handle=handle,
+    )
+
+
+class OrderSnapshotter:
+    """كتابة لقطة دورية ذرية لكل مخزن طلبات، وتحميلها عبر mmap عند التشغيل ثم تطبيق ما تغيّر بعدها"""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self.stores = []
+        self._task = None
+
+        # 📊 مقاييس
+        self.written = 0
+        self.restored = 0
+        self.replayed = 0
+        self.failed = 0
+        self.last_bytes = 0
+
+    def path_for(self, store):
+        return os.path.join(self.directory, f"orders-{store.restaurant_id}.snap")
+
+    async def write(self, store):
+        # العلامة المائية تُؤخذ قبل قراءة الذاكرة: أي تغيير بعدها يُعاد من MySQL عند التحميل
+        watermark = await fetch_db_now()
+        rows = [order_snapshot_row(record) for record in reversed(store.values())]  # الأحدث استخدامًا أولاً
+        payload = marshal.dumps(rows)
+        header = ORDER_SNAPSHOT_HEADER.pack(
+            ORDER_SNAPSHOT_MAGIC, ORDER_SNAPSHOT_VERSION, store.restaurant_id,
+            watermark.timestamp(), len(rows), zlib.crc32(payload)
+        )
+        await asyncio.to_thread(self._write_file, self.path_for(store), header, payload)
+        self.written += 1
+        self.last_bytes = len(header) + len(payload)
+
+    def _write_file(self, path, header, payload):
+        # كتابة ملف مؤقت ثم استبداله: القارئ يرى اللقطة القديمة أو الجديدة كاملة فقط
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def read(self, store):
+        """قراءة اللقطة؛ يُرجع (العلامة المائية، الصفوف) أو None إذا كانت مفقودة أو غير صالحة"""
+        path = self.path_for(store)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, version, restaurant_id, watermark, count, checksum = ORDER_SNAPSHOT_HEADER.unpack_from(mm)
+                if magic != ORDER_SNAPSHOT_MAGIC or version != ORDER_SNAPSHOT_VERSION:
+                    raise ValueError("صيغة غير معروفة")
+                if restaurant_id != store.restaurant_id:
+                    raise ValueError(f"اللقطة تخص المطعم {restaurant_id}")
+                payload = memoryview(mm)[ORDER_SNAPSHOT_HEADER.size:]
+                try:
+                    if zlib.crc32(payload) != checksum:
+                        raise ValueError("المجموع الاختباري غير مطابق")
+                    rows = marshal.loads(payload)
+                finally:
+                    payload.release()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, TypeError, struct.error) as e:
+            self.failed += 1
+            logger.warning(f"⚠️ تجاهل لقطة الطلبات {path}: {e}")
+            return None
+
+        if len(rows) != count:
+            self.failed += 1
+            logger.warning(f"⚠️ تجاهل لقطة الطلبات {path}: عدد الطلبات غير مطابق")
+            return None
+        return datetime.datetime.fromtimestamp(watermark), rows
+
+    async def restore(self, store, max_age=ORDER_HYDRATE_MAX_AGE):
+        """تحميل اللقطة ثم تغييرات MySQL بعدها؛ يُرجع عدد الطلبات المحمّلة أو None للرجوع إلى التحميل الكامل"""
+        if not self.directory:
+            return None
+        snapshot = self.read(store)
+        if snapshot is None:
+            return None
+
+        watermark, rows = snapshot
+        cutoff = time.time() - max_age
+        for row in rows:
+            record = order_record_from_snapshot(row)
+            if record.created_at < cutoff:
+                continue
+            if not store.hydrate(record):
+                break
+        self.restored += 1
+        self.replayed += await replay_pending_order_changes(store, watermark)
+        return len(store)
+
+    async def write_all(self):
+        for store in self.stores:
+            try:
+                await self.write(store)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ فشل كتابة لقطة طلبات المطعم {store.restaurant_id}: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.write_all()
+
+    def start(self):
+        if self.directory and self._task is None:
+            self._task = asyncio.create_task(self._loop())
 
-                if row[4] and row[5]:
-                    pending_orders[order_id]["location"] = (row[4], row[5])
+    async def stop(self):
+        """إيقاف الكتابة الدورية وكتابة لقطة أخيرة بعد حفظ الطلبات"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.directory:
+            await self.write_all()
 
+    def stats(self):
+        return {
+            "written": self.written,
+            "restored": self.restored,
+            "replayed": self.replayed,
+            "failed": self.failed,
+            "last_bytes": self.last_bytes,
+        }
 
 
+order_snapshots = OrderSnapshotter(ORDER_SNAPSHOT_DIR, ORDER_SNAPSHOT_INTERVAL)
 
 
+# 🔹 حالة المحادثة: ذاكرة LRU لكل مستخدم مع كتابة مؤجلة على دفعات
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", 10000))
+CONVERSATION_BATCH_SIZE = int(os.getenv("CONVERSATION_BATCH_SIZE", 200))
+CONVERSATION_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", 2.0))
 
 
+def encode_state(state_data):
+    if orjson is not None:
+        return orjson.dumps(state_data, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(state_data, ensure_ascii=False)
 
 
+def decode_state(payload):
+    return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+
+async def load_conversation_state(user_id):
+    """قراءة حالة المحادثة المرمّزة من قاعدة البيانات؛ "{}" إذا لم تكن موجودة"""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT state_data FROM conversation_states WHERE user_id = %s",
+                (user_id,)
+            )
+            result = await cursor.fetchone()
+    return result[0] if result and result[0] else "{}"
+
+
+async def save_conversation_states(rows):
+    """كتابة دفعة من (user_id, state_data) دون حذف الصف وإعادة إدخاله كما يفعل REPLACE"""
+    sql = (
+        "INSERT INTO conversation_states (user_id, state_data) VALUES "
+        + ", ".join(["(%s, %s)"] * len(rows))
+        + " ON DUPLICATE KEY UPDATE state_data = VALUES(state_data)"
+    )
+    params = [value for row in rows for value in row]
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+        await conn.commit()
+
+
+class ConversationStateCache:
+    """حالة المحادثة لكل مستخدم في الذاكرة (LRU)، والتغييرات تُكتب لاحقًا على دفعات"""
+
+    def __init__(self, max_size, batch_size, flush_interval):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # نخزن النص المرمّز: كل قراءة تُرجع نسخة مستقلة كما كانت تفعل القراءة من قاعدة البيانات
+        self._states = OrderedDict()  # user_id -> JSON
+        self._dirty = {}  # user_id -> JSON بانتظار الكتابة (يبقى حتى بعد الإخراج من LRU)
+        self._dirty_event = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+        # 📊 مقاييس
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+
+    def _remember(self, user_id, payload):
+        self._states[user_id] = payload
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    async def get(self, user_id):
+        payload = self._states.get(user_id)
+        if payload is not None:
+            self.hits += 1
+            self._states.move_to_end(user_id)
+            return decode_state(payload)
+
+        self.misses += 1
+        payload = self._dirty.get(user_id)
+        if payload is None:
+            payload = await load_conversation_state(user_id)
+            # قد تُحفظ حالة أحدث أثناء انتظار قاعدة البيانات
+            payload = self._states.get(user_id) or self._dirty.get(user_id) or payload
+        self._remember(user_id, payload)
+        return decode_state(payload)
+
+    def save(self, user_id, state_data):
+        """تحديث الحالة في الذاكرة وتأجيل كتابتها"""
+        payload = encode_state(state_data)
+        self._remember(user_id, payload)
+        if user_id in self._dirty:
+            self.coalesced += 1
+        self._dirty[user_id] = payload
+        self._dirty_event.set()
+        if len(self._dirty) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        """كتابة كل التغييرات المعلقة الآن؛ الدفعات الفاشلة تبقى لمحاولة لاحقة"""
+        for _ in range(-(-len(self._dirty) // self.batch_size)):
+            async with self._lock:
+                rows = [(user_id, self._dirty.pop(user_id))
+                        for user_id in list(itertools.islice(self._dirty, self.batch_size))]
+                if not rows:
+                    return
+                try:
+                    await save_conversation_states(rows)
+                    self.written += len(rows)
+                except BaseException as e:
+                    # إعادة الحالات للمحاولة التالية ما لم تحل محلها حالة أحدث (وكذلك عند الإلغاء أثناء الكتابة)
+                    self.failed += len(rows)
+                    for user_id, payload in rows:
+                        self._dirty.setdefault(user_id, payload)
+                    if not isinstance(e, Exception):
+                        raise
+                    logger.error(f"❌ فشل في كتابة دفعة حالات المحادثة ({len(rows)} مستخدم): {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """إيقاف المهمة الخلفية وكتابة كل التغييرات المعلقة"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        await self.flush()
+        logger.info(f"💬 تم تفريغ حالات المحادثة: {self.stats()}")
+
+    def stats(self):
+        return {
+            "size": len(self._states),
+            "pending": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "failed": self.failed,
+            "codec": "orjson" if orjson is not None else "json",
+        }
+
+    async def _run(self):
+        while True:
+            await self._dirty_event.wait()
+
+            # ⏳ اكتمال الدفعة أو انقضاء المهلة، أيهما أسبق
+            if len(self._dirty) < self.batch_size:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            self._dirty_event.clear()
+            failed = self.failed
+            await self.flush()
+            if self.failed > failed:
+                await asyncio.sleep(self.flush_interval)  # قاعدة البيانات متعثرة: لا نعيد المحاولة فورًا
+
+
+conversation_states = ConversationStateCache(
+    max_size=CONVERSATION_CACHE_SIZE,
+    batch_size=CONVERSATION_BATCH_SIZE,
+    flush_interval=CONVERSATION_FLUSH_INTERVAL,
+)
+
 
 # دالة حفظ حالة المحادثة الموحدة
 async def save_conversation_state(user_id, state_data):
-    """حفظ حالة المحادثة في قاعدة البيانات"""
+    """حفظ حالة المحادثة (تُكتب في قاعدة البيانات ضمن الدفعة التالية)"""
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                # تحويل البيانات إلى JSON
-                json_data = json.dumps(state_data, ensure_ascii=False)
-
-                # استخدام REPLACE INTO لإضافة أو تحديث البيانات
-                await cursor.execute(
-                    "REPLACE INTO conversation_states (user_id, state_data) VALUES (%s, %s)",
-                    (user_id, json_data)
-                )
-            await conn.commit()
+        conversation_states.save(user_id, state_data)
         return True
     except Exception as e:
         logger.error(f"خطأ في حفظ حالة المحادثة: {e}")
@@ -354,20 +1930,9 @@ async def save_conversation_state(user_id, state_data):
 
 # دالة استرجاع حالة المحادثة الموحدة
 async def get_conversation_state(user_id):
-    """استرجاع حالة المحادثة من قاعدة البيانات"""
+    """استرجاع حالة المحادثة من الذاكرة، أو من قاعدة البيانات عند أول قراءة"""
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(
-                    "SELECT state_data FROM conversation_states WHERE user_id = %s",
-                    (user_id,)
-                )
-                result = await cursor.fetchone()
-
-                if not result:
-                    return {}
-
-                return json.loads(result[0])
+        return await conversation_states.get(user_id)
     except Exception as e:
         logger.error(f"خطأ في استرجاع حالة المحادثة: {e}")
         return {}
@@ -382,10 +1947,18 @@ async def create_order(user_id, restaurant_id, items, total_price):
             async with conn.cursor() as cursor:
                 # إنشاء الطلب الرئيسي
                 await cursor.execute(
-                    "INSERT INTO orders (order_id, user_id, restaurant_id, total_price) VALUES (%s, %s, %s, %s)",
+                    "INSERT INTO orders (order_id, user_id, restaurant_id, total_price, timestamp) "
+                    "VALUES (%s, %s, %s, %s, NOW())",
                     (order_id, user_id, restaurant_id, total_price)
                 )
 
+                # 📊 تحديث ملخص اليوم ضمن نفس المعاملة
+                await cursor.execute(
+                    "INSERT INTO daily_revenue (restaurant_id, day, order_count, revenue) VALUES (%s, CURDATE(), 1, %s) "
+                    "ON DUPLICATE KEY UPDATE order_count = order_count + 1, revenue = revenue + VALUES(revenue)",
+                    (restaurant_id, total_price or 0)
+                )
+
                 # إضافة عناصر الطلب
                 for item in items:
                     await cursor.execute(
@@ -394,6 +1967,7 @@ async def create_order(user_id, restaurant_id, items, total_price):
                     )
 
             await conn.commit()
+        revenue_rollup.record_order(restaurant_id, total_price or 0)
         return order_id
     except Exception as e:
         logger.error(f"خطأ في إنشاء طلب جديد: {e}")
@@ -469,76 +2043,173 @@ def create_rating_response_message(order_id, order_number, rating, comment=None)
     return message
 
 
-# دوال استخراج المعلومات من الرسائل
-def extract_order_id(text):
-    """استخراج معرف الطلب من النص"""
-    # أولاً نحاول المطابقة مع التنسيق Markdown
-    match = re.search(r"🆔 \*معرف الطلب:\* `([^`]+)`", text)
-    if match:
-        return match.group(1)
+# 🧩 محلل رسائل القناة: تعبير نمطي واحد مُجمّع يمسح النص مرة واحدة ويستخرج كل الحقول
+CHANNEL_KIND_ORDER = "order"
+CHANNEL_KIND_REMINDER = "reminder"
+CHANNEL_KIND_TIME_LEFT = "time_left"
+CHANNEL_KIND_DELIVERED = "delivered"
+CHANNEL_KIND_CANCELLATION_REPORT = "cancellation_report"
+CHANNEL_KIND_CANCELLATION = "cancellation"
+CHANNEL_KIND_RATING = "rating"
+CHANNEL_KIND_IGNORED = "ignored"
+CHANNEL_KIND_LOCATION = "location"
+
+_FIELD_SEPARATORS = r"[:*\s`\"']*"
+
+# كل فرع يبدأ بحرف ثابت مختلف، والفروع التي تشترك بأول حرف مُجمّعة داخله،
+# فيُجرَّب عند كل موضع فرع واحد فقط. العلامات السابقة للحقل (استلم/🚫/قام ب) تُفحص بنظرة للخلف.
+_CHANNEL_MESSAGE_BRANCHES = (
+    # 🆔 *معرف الطلب:* `uuid` | معرف الطلب: uuid | order_id: uuid
+    rf"(?P<id_label>معرف الطلب|order_id){_FIELD_SEPARATORS}(?P<order_id>[\w\-]+)",
+    rf"🆔{_FIELD_SEPARATORS}(?P<order_id_tag>[\w\-]{{8,}})",
+    # 🔢 *رقم الطلب:* `12` | رقم الطلب: 12 | order_number: 12
+    rf"(?P<number_label>رقم الطلب|order_number){_FIELD_SEPARATORS}(?P<order_number>\d+)",
+    rf"🔢{_FIELD_SEPARATORS}(?P<order_number_tag>\d+)",
+    # ✅ الزبون استلم طلبه رقم 12
+    r"طلبه(?P<received>(?<=استلم طلبه))? رقم\s*(?P<received_number>\d+)",
+    r"ت(?:"
+    # 🚫 تم إلغاء الطلب رقم 12
+    r"(?P<cancelled>م إلغاء الطلب)(?P<cancel_flag>(?<=🚫 تم إلغاء الطلب))?(?: رقم\s*(?P<cancelled_number>\d+))?"
+    # وقام بتقييمه بـ ⭐⭐⭐
+    r"|قييمه بـ(?P<rated>(?<=قام بتقييمه بـ))?\s*(?P<stars>[⭐\ufe0f]*)"
+    r"|(?P<reminder>ذكير من الزبون))",
+    # كم يتبقى لتحضير الطلب رقم 12
+    r"الطلب رقم\s*(?P<ref_number>\d+)",
+    r"(?P<time_left>كم يتبقى)",
+    # ⭐ *التقييم:* ⭐⭐⭐ (3/5)
+    r"⭐ \*التقييم:\* [⭐\ufe0f]+ \((?P<score>\d+)/5\)",
+    # سبب الإلغاء يمتد حتى نهاية الرسالة، لذا نحفظ موضعه فقط ونكمل المسح
+    r"💬 (?:\*?التعليق:\*?[ \t]*(?P<comment>[^\n]+)|(?P<reason>سبب الإلغاء:)(?P<reason_body>\n)?)",
+)
 
-    # ثم نحاول استخراج المعرف بالتنسيق العادي - ويجب أن يشمل الشرطة `-`
-    match = re.search(r"معرف الطلب:\s*[`\"']?([\w\d\-]{8,})[`\"']?", text)
-    if match:
-        return match.group(1)
+# ⚡ الأحرف التي يمكن أن يبدأ بها أي فرع؛ تتيح للمحرك تخطي بقية النص دون تجربة الفروع
+_CHANNEL_MESSAGE_STARTS = "مo🆔ر🔢طتاك⭐💬"
 
+CHANNEL_MESSAGE_PATTERN = re.compile(
+    rf"(?=[{_CHANNEL_MESSAGE_STARTS}])(?:" + "|".join(_CHANNEL_MESSAGE_BRANCHES) + ")"
+)
+
+class ParsedChannelMessage:
+    """نتيجة تحليل رسالة القناة"""
+
+    __slots__ = (
+        "kind", "order_id", "order_number", "rating", "stars", "comment", "cancellation_reason",
+    )
+
+    def __init__(self, kind, order_id=None, order_number=None, rating=0, stars=None,
+                 comment=None, cancellation_reason=None):
+        self.kind = kind
+        self.order_id = order_id
+        self.order_number = order_number
+        self.rating = rating
+        self.stars = stars
+        self.comment = comment
+        self.cancellation_reason = cancellation_reason
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"ParsedChannelMessage({fields})"
+
+
+def _first_group(found, *names):
+    """قيمة أول مجموعة موجودة من الأسماء المعطاة (بترتيب الأولوية)"""
+    for name in names:
+        match = found.get(name)
+        if match is not None:
+            return match.group(name)
     return None
 
 
+def _id_on_received_line(text, received):
+    """مثل فلتر المعالج القديم "استلم طلبه رقم .*معرف الطلب": المعرّف على السطر نفسه فقط،
+    أما "معرف الطلب" في سطر لاحق فرسالة تقييم عادية"""
+    line_end = text.find("\n", received.end())
+    return "معرف الطلب" in text[received.end():line_end if line_end != -1 else len(text)]
+
+
+def parse_channel_message(text):
+    """مسح نص رسالة القناة مرة واحدة واستخراج نوعها وكل حقولها"""
+    text = text or ""
+
+    # آخر مجموعة مُطابَقة تحدد الفرع (والحقل)، ونحتفظ بأول ظهور لكل منها
+    # كما كانت تفعل دوال الاستخراج القديمة؛ قراءة المجموعات تؤجَّل لما يلزم فقط
+    found = {}
+    for match in CHANNEL_MESSAGE_PATTERN.finditer(text):
+        found.setdefault(match.lastgroup, match)
+
+    order_id = _first_group(found, "order_id", "order_id_tag")
+    order_number = _first_group(
+        found, "order_number", "order_number_tag", "received_number", "cancelled_number", "ref_number"
+    )
+
+    stars = _first_group(found, "stars") or None
+    score = _first_group(found, "score")
+    if score is not None:
+        rating = int(score)
+    else:
+        rating = stars.count("⭐") if stars else 0
+
+    comment = _first_group(found, "comment")
+    reason_match = found.get("reason_body")
+    reason = text[reason_match.end():].strip() if reason_match is not None else None
+
+    received = found.get("received_number")
+    cancelled = found.get("cancelled_number")
+    rated = found.get("stars")
+
+    # نفس ترتيب أولوية معالجات القناة
+    if "reminder" in found:
+        kind = CHANNEL_KIND_REMINDER
+    elif "time_left" in found and "ref_number" in found:
+        kind = CHANNEL_KIND_TIME_LEFT
+    elif received is not None and received.group("received") is not None and _id_on_received_line(text, received):
+        kind = CHANNEL_KIND_DELIVERED
+    elif "reason" in found or reason_match is not None:
+        kind = CHANNEL_KIND_CANCELLATION_REPORT
+    elif cancelled is not None and cancelled.group("cancel_flag") is not None:
+        kind = CHANNEL_KIND_CANCELLATION
+    elif rated is not None and rated.group("rated") is not None:
+        kind = CHANNEL_KIND_RATING
+    elif cancelled is not None or "cancelled" in found or "cancel_flag" in found:
+        kind = CHANNEL_KIND_IGNORED
+    else:
+        kind = CHANNEL_KIND_ORDER
+
+    return ParsedChannelMessage(
+        kind,
+        order_id,
+        int(order_number) if order_number is not None else None,
+        rating,
+        stars,
+        comment.strip() if comment else None,
+        reason,
+    )
+
+
+# دوال الاستخراج القديمة: أغلفة رقيقة فوق المحلل الموحد
+def extract_order_id(text):
+    """استخراج معرف الطلب من النص"""
+    return parse_channel_message(text).order_id
+
+
 def extract_order_number(text):
     """استخراج رقم الطلب من النص"""
-    # محاولة استخراج رقم الطلب بالتنسيق الجديد
-    match = re.search(r"🔢 \*رقم الطلب:\* `(\d+)`", text)
-    if match:
-        return int(match.group(1))
-    
-    # محاولة استخراج رقم الطلب بالتنسيق القديم
-    match = re.search(r"رقم الطلب:?\s*[`\"']?(\d+)[`\"']?", text)
-    if match:
-        return int(match.group(1))
-    
-    # محاولة استخراج رقم الطلب من نص آخر
-    match = re.search(r"طلبه رقم (\d+)", text)
-    if match:
-        return int(match.group(1))
-    
-    return None
+    return parse_channel_message(text).order_number
+
 
 def extract_rating(text):
     """استخراج التقييم من النص"""
-    # محاولة استخراج التقييم بالتنسيق الجديد
-    match = re.search(r"⭐ \*التقييم:\* (⭐+) \((\d+)/5\)", text)
-    if match:
-        return int(match.group(2))
-    
-    # محاولة استخراج التقييم بالتنسيق القديم
-    match = re.search(r"تقييمه بـ (\⭐+)", text)
-    if match:
-        return len(match.group(1))
-    
-    return 0
+    return parse_channel_message(text).rating
+
 
 def extract_comment(text):
     """استخراج التعليق من النص"""
-    # محاولة استخراج التعليق بالتنسيق الجديد
-    match = re.search(r"💬 \*التعليق:\* (.+?)(?:\n|$)", text)
-    if match:
-        return match.group(1).strip()
-    
-    # محاولة استخراج التعليق بالتنسيق القديم
-    match = re.search(r"💬 التعليق: (.+?)(?:\n|$)", text)
-    if match:
-        return match.group(1).strip()
-    
-    return None
+    return parse_channel_message(text).comment
 
 
-
-
-# ✅ دالة تحليل النجوم (يمكن حذفها لاحقًا إن لم تُستخدم)
 def extract_stars(text: str) -> str:
-    match = re.search(r"تقييمه بـ (\⭐+)", text)
-    return match.group(1) if match else "⭐️"
+    """استخراج نجوم التقييم كما كتبها الزبون"""
+    return parse_channel_message(text).stars or "⭐️"
 
 
 
@@ -562,25 +2233,196 @@ main_menu_keyboard = ReplyKeyboardMarkup(
 )
 
 
+# ⌨️ قوالب أزرار سير الطلب: التخطيط يُبنى مرة واحدة، ولكل طلب يُستبدل رمزه فقط في callback_data
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", 512))
+
+DELIVERY_TIME_OPTIONS = ("5", "10", "15", "20", "25", "30", "35", "40", "45", "50", "60", "75", "90")
+
+# 🔑 callback_data المختصر: حرف واحد للإجراء + رقم الطلب القصير (مثل "a42" أو "3417")
+# الحرف يُفك بجدول ثابت إلى (الإجراء، الوسيط)، فلا حاجة لتقسيم النص ولا لإدراج UUID كامل
+CALLBACK_ACTIONS = {
+    "a": ("accept", None),
+    "r": ("reject", None),
+    "x": ("confirmreject", None),
+    "b": ("back", None),
+    "c": ("complain", None),
+    "y": ("ready", None),
+    "1": ("report_delivery", None),
+    "2": ("report_phone", None),
+    "3": ("report_location", None),
+    "4": ("report_other", None),
+    "d": ("select_delivery", None),  # يتبعه ".<ترتيب الدليفري>"
+    "0": ("time", "0"),  # رجوع من قائمة الدليفري قبل اختيار أي وقت
+    "z": ("time", "90+"),
+    **{code: ("time", t) for code, t in zip("ABCDEFGHIJKLM", DELIVERY_TIME_OPTIONS)},
+}
+
+# مفتاح الزر في القوالب -> حرف الإجراء ("accept" أو "time_30" مثلاً)
+CALLBACK_ACTION_CODES = {
+    (f"time_{arg}" if action == "time" else action): code
+    for code, (action, arg) in CALLBACK_ACTIONS.items()
+}
+
+# الصيغة القديمة (قبل الترميز المختصر) تبقى مقبولة للأزرار المرسلة سابقًا
+LEGACY_CALLBACK_PATTERN = re.compile(
+    r"^(?:select_delivery\|(?P<sd_order>.+)\|(?P<index>\d+)"
+    r"|time_(?P<time>\d+\+?)_(?P<t_order>.+)"
+    r"|(?P<action>accept|reject|confirmreject|back|complain|ready|report_(?:delivery|phone|location|other))_(?P<order>.+))$"
+)
+
+
+def encode_callback(action_key, handle, index=None):
+    data = CALLBACK_ACTION_CODES[action_key] + str(handle)
+    return data if index is None else f"{data}.{index}"
+
+
+def parse_callback_data(data):
+    """فك callback_data إلى (الإجراء، رمز الطلب، الوسيط)
+
+    رمز الطلب رقم callback (int) للصيغة المختصرة، أو order_id (str) للصيغة القديمة.
+    """
+    entry = CALLBACK_ACTIONS.get(data[:1])
+    if entry is not None and data[1:2].isdigit():
+        try:
+            return entry[0], int(data[1:]), entry[1]
+        except ValueError:
+            # زر اختيار الدليفري فقط يحمل ترتيبًا بعد الرقم
+            handle, _, index = data[1:].partition(".")
+            return entry[0], int(handle), index
+
+    match = LEGACY_CALLBACK_PATTERN.match(data)
+    if match is None:
+        return None
+    if match.group("sd_order") is not None:
+        return "select_delivery", match.group("sd_order"), match.group("index")
+    if match.group("t_order") is not None:
+        return "time", match.group("t_order"), match.group("time")
+    return match.group("action"), match.group("order"), None
+
+
+async def resolve_callback_order(orders, order_token, query):
+    """إيجاد الطلب الحي لزر مضغوط، مع الرجوع إلى رسالة الكاشير التي ضُغط زرها"""
+    message_id = query.message.message_id
+    if isinstance(order_token, int):
+        order = await orders.get_by_handle(order_token)
+    else:
+        order = await orders.get(order_token)
+
+    # كل أزرار الطلب على رسالته عند الكاشير: رقم callback أُعيد استخدامه بعد توقف مفاجئ
+    # قد يشير إلى طلب آخر، فلا نقبل طلبًا لا تطابق رسالته الرسالة المضغوطة
+    if order is not None and order.message_id is not None and order.message_id != message_id:
+        logger.warning(f"⚠️ الزر {order_token} يشير إلى الطلب {order.order_id} من رسالة أخرى ({message_id}).")
+        order = None
+    return order or orders.find_by_message_id(message_id)
+
+
+# كل زر: (النص، مفتاح الإجراء)؛ رقم الطلب يُلحق بحرف الإجراء عند البناء
+KEYBOARD_LAYOUTS = {
+    "order_actions": (
+        (("✅ قبول الطلب", "accept"),),
+        (("❌ رفض الطلب", "reject"),),
+        (("🚨 شكوى عن الزبون أو الطلب", "complain"),),
+    ),
+    "time_picker": tuple(
+        ((f"{t} دقيقة", f"time_{t}"),) for t in DELIVERY_TIME_OPTIONS
+    ) + (
+        (("📌 أكثر من 90 دقيقة", "time_90+"),),
+        (("🔙 رجوع", "back"),),
+    ),
+    "confirm_reject": (
+        (("⚠️ تأكيد الرفض", "confirmreject"),),
+        (("🔙 رجوع", "back"),),
+    ),
+    "complaint_reasons": (
+        (("🚪 وصل الديليفري ولم يجد الزبون", "report_delivery"),),
+        (("📞 رقم الهاتف غير صحيح", "report_phone"),),
+        (("📍 معلومات الموقع غير دقيقة", "report_location"),),
+        (("❓ مشكلة أخرى", "report_other"),),
+        (("🔙 رجوع", "back"),),
+    ),
+    "complain_only": (
+        (("🚨 شكوى عن الزبون أو الطلب", "complain"),),
+    ),
+}
+
+
+def _time_selected_layout(selected_time):
+    """أزرار الوقت مع تمييز الوقت المختار، ثم جاهز ليطلع والشكوى"""
+    rows = tuple(
+        ((f"✅ {t} دقيقة" if t == selected_time else f"{t} دقيقة", f"time_{t}"),)
+        for t in DELIVERY_TIME_OPTIONS
+    )
+    more = "✅ 📌 أكثر من 90 دقيقة" if selected_time == "90+" else "📌 أكثر من 90 دقيقة"
+    return rows + (
+        ((more, "time_90+"),),
+        (("🚗 جاهز ليطلع", "ready"),),
+        (("🚨 شكوى عن الزبون أو الطلب", "complain"),),
+    )
+
+
+# حالة لكل وقت ممكن، وحالة بلا تمييز لأي قيمة أخرى
+KEYBOARD_LAYOUTS.update(
+    {f"time_selected:{t}": _time_selected_layout(t) for t in DELIVERY_TIME_OPTIONS + ("90+",)}
+)
+KEYBOARD_LAYOUTS["time_selected:"] = _time_selected_layout(None)
+
+
+class KeyboardFactory:
+    """بناء InlineKeyboardMarkup من القوالب الثابتة مع ذاكرة LRU للوحات الجاهزة لكل طلب (حسب رقم callback)"""
+
+    def __init__(self, layouts, cache_size):
+        self.layouts = layouts
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (اسم القالب، رمز الطلب) -> InlineKeyboardMarkup
+
+        # 📊 مقاييس
+        self.hits = 0
+        self.builds = 0
+
+    def build(self, name, handle):
+        key = (name, handle)
+        markup = self._cache.get(key)
+        if markup is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return markup
+
+        self.builds += 1
+        markup = InlineKeyboardMarkup(tuple(
+            tuple(InlineKeyboardButton(label, callback_data=encode_callback(action, handle)) for label, action in row)
+            for row in self.layouts[name]
+        ))
+        self._cache[key] = markup
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return markup
+
+    def time_selected(self, handle, selected_time):
+        name = f"time_selected:{selected_time}"
+        if name not in self.layouts:
+            name = "time_selected:"
+        return self.build(name, handle)
+
+    def stats(self):
+        return {"size": len(self._cache), "hits": self.hits, "builds": self.builds}
+
+
+keyboard_factory = KeyboardFactory(KEYBOARD_LAYOUTS, cache_size=KEYBOARD_CACHE_SIZE)
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(context)
     user_id = update.effective_user.id
 
     # مثال: استخرج restaurant_id من ملف config أو السياق (حسب البنية عندك)
-    restaurant_id = RESTAURANT_ID  # تأكد أنه تم تخزينه مسبقًا
+    restaurant_id = tenant.restaurant_id  # تأكد أنه تم تخزينه مسبقًا
 
     if not restaurant_id:
         await update.message.reply_text("⚠️ معرف المطعم غير معروف. أعد تشغيل البوت.")
         return
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(
-                    "SELECT COUNT(*) FROM delivery_persons WHERE restaurant_id = %s", (restaurant_id,)
-                )
-                result = await cursor.fetchone()
-                delivery_count = result[0] if result else 0
+        delivery_count = len(await delivery_roster.get(restaurant_id))
 
         if delivery_count == 0:
             await update.message.reply_text(
@@ -603,28 +2445,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ✅ استقبال طلب من القناة
 # ✅ استقبال طلب من القناة
-async def handle_channel_order(update: Update, context: CallbackContext):
+async def handle_channel_order(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
 
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
-
-    # تجاهل رسائل التقييم أو الإلغاء
-    if "استلم طلبه رقم" in text and "قام بتقييمه بـ" in text:
-        logger.info("ℹ️ تم تجاهل رسالة التقييم، ليست طلبًا جديدًا.")
-        return
-
-    if text.startswith("🚫 تم إلغاء الطلب رقم") or "تم إلغاء الطلب" in text:
-        logger.info("⛔️ تم تجاهل رسالة إلغاء الطلب (ليست طلبًا جديدًا).")
-        return
-
     logger.info(f"📥 استلم البوت طلبًا جديدًا من القناة: {text}")
 
-    # استخراج المعرف ورقم الطلب
-    order_id = extract_order_id(text)
-    order_number = extract_order_number(text)
+    order_id = parsed.order_id
+    order_number = parsed.order_number
 
     if not order_id:
         logger.warning("⚠️ لم يتم العثور على معرف الطلب في الرسالة!")
@@ -632,513 +2464,632 @@ async def handle_channel_order(update: Update, context: CallbackContext):
 
     logger.info(f"🔍 تم استخراج معرف الطلب: {order_id} | رقم الطلب: {order_number or 'غير معروف'}")
 
-    global last_order_time
-    async with order_rate_lock:
-        now = time.time()
-        elapsed = now - last_order_time
-        if elapsed < 0.2:
-            wait_time = 0.2 - elapsed
-            logger.debug(f"⏳ انتظار {wait_time:.3f} ثانية لحماية الترتيب.")
-            await asyncio.sleep(wait_time)
-        last_order_time = time.time()
-
-    # 🔐 الحصول على قفل تزامن خاص بهذا الطلب
-    lock = await get_order_lock(order_id)
+    # 🚦 لا يوجد قفل عام: الطلبات المستقلة تُعالج بالتوازي، ويبقى حد القبول العام اختياريًا
+    if order_admission is not None:
+        await order_admission.acquire()
 
     # 🔒 منع التداخل عند معالجة الطلب نفسه
-    async with lock:
-        # 👇 تعديل هنا: انتظار وصول الموقع لمدة 2 ثانية
-        location = None
-        wait_time = 2  # انتظار ثانيتين كحد أقصى
-        wait_interval = 0.2  # فحص كل 0.2 ثانية
-        
-        # انتظار وصول الموقع
-        for _ in range(int(wait_time / wait_interval)):
-            if location_queue:
-                location = location_queue.popleft()
-                logger.info(f"✅ تم استلام الموقع للطلب: {order_id}")
-                break
-            await asyncio.sleep(wait_interval)
-        
-        message_text = text + ("\n\n📍 *تم إرفاق الموقع الجغرافي*" if location else "")
+    async with order_lock(order_id):
+        # 📍 تسجيل الطلب لدى مُنسّق المواقع (قد يكون موقعه قد وصل قبله)
+        location_future = tenant.locations.expect(message.message_id, order_id)
 
-        keyboard = [
-            [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"accept_{order_id}")],
-            [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"reject_{order_id}")],
-            [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        handle = tenant.orders.reserve_handle()
+        reply_markup = keyboard_factory.build("order_actions", handle)
 
         try:
-            # 👇 تعديل هنا: إرسال الموقع أولاً (إن وُجد)
-            if location:
-                latitude, longitude = location
-                await context.bot.send_location(
-                    chat_id=CASHIER_CHAT_ID,
-                    latitude=latitude,
-                    longitude=longitude
-                )
-                logger.info(f"✅ تم إرسال الموقع للكاشير (order_id={order_id})")
-            
             # 1. بناء النص
-            text_to_send = f"🆕 *طلب جديد من القناة:*\n\n{message_text}\n\n📌 *معرف الطلب:* `{order_id}`"
-    
-            # 2. إنشاء معرف تتبع
-            message_id = str(uuid.uuid4())
+            text_to_send = f"🆕 *طلب جديد من القناة:*\n\n{text}\n\n📌 *معرف الطلب:* `{order_id}`"
     
-            # 3. تتبع الرسالة
-            await track_sent_message(
-                message_id=message_id,
+            # 2. إرسال الطلب فورًا دون انتظار الموقع، وانتظار message_id الخاص به
+            sent_message = await dispatch_message(
+                context.bot,
+                tenant.cashier_chat_id,
+                text_to_send,
+                priority=PRIORITY_CRITICAL,
                 order_id=order_id,
-                source="restaurant_bot",
                 destination="cashier",
-                content=text_to_send
-            )
-    
-            # 5. إرسال الرسالة بعد الموقع
-            sent_message = await send_message_with_retry(
-                bot=context.bot,
-                chat_id=CASHIER_CHAT_ID,
-                text=text_to_send,
-                order_id=order_id,
-                message_id=message_id,
                 parse_mode="Markdown",
                 reply_markup=reply_markup
             )
     
             logger.info(f"✅ تم إرسال الطلب إلى الكاشير (order_id={order_id})")
     
-            # 6. حفظ الطلب مؤقتًا
-            pending_orders[order_id] = {
-                "order_details": message_text,
-                "channel_message_id": message.message_id,
-                "message_id": sent_message.message_id
-            }
-    
-            # 7. حفظ الطلب في قاعدة البيانات
-            await save_pending_order(order_id, message_text, message.message_id, sent_message.message_id, location)
+            # 3. حفظ الطلب مؤقتًا
+            record = OrderRecord(
+                order_id=order_id,
+                order_number=order_number,
+                order_details=text,
+                channel_message_id=message.message_id,
+                message_id=sent_message.message_id,
+                handle=handle
+            )
+            tenant.orders.put(record)
     
+            # 4. حفظ الطلب في قاعدة البيانات
+            tenant.orders.persist(record)
+
         except Exception as e:
             logger.error(f"❌ خطأ أثناء إرسال الطلب إلى الكاشير: {e}")
+            tenant.locations.forget(message.message_id)
+            return
 
-       
+    # 5. إرسال الموقع للكاشير عند وصوله (ردًا على رسالة الطلب)
+    spawn_background(forward_order_location(tenant, context.bot, record, message.message_id, location_future))
 
-# متغير عالمي لتخزين آخر موقع تم استلامه
-last_received_location = None
-last_location_time = 0
 
-location_rate_lock = asyncio.Lock()
+# 🔹 ربط رسائل الموقع بالطلبات
+LOCATION_GRACE_SECONDS = float(os.getenv("LOCATION_GRACE_SECONDS", 15))
 
-# ✅ تخزين الموقع فقط بدون إرسال
-async def handle_channel_location(update: Update, context: CallbackContext):
-    global last_location_time
-
-    async with location_rate_lock:
-        now = time.time()
-        elapsed = now - last_location_time
-        if elapsed < 0.2:
-            wait_time = 0.2 - elapsed
-            logger.debug(f"⏳ انتظار {wait_time:.3f} ثانية قبل معالجة الموقع.")
-            await asyncio.sleep(wait_time)
-        last_location_time = time.time()
 
-    message = update.channel_post
+class LocationCorrelator:
+    """ربط رسائل الموقع في القناة بالطلبات عبر رقم رسالة القناة بدل طابور FIFO"""
+
+    def __init__(self, grace):
+        self.grace = grace
+        self._waiting = {}  # رقم رسالة الطلب في القناة -> (order_id, future)
+        self._orphans = {}  # رقم رسالة الموقع في القناة -> (location, reply_to, وقت الوصول)
+
+        # 📊 مقاييس
+        self.paired = 0
+        self.unpaired = 0
+
+    def _purge_orphans(self, now):
+        for message_id in [m for m, (_, _, t) in self._orphans.items() if now - t > self.grace]:
+            del self._orphans[message_id]
+            self.unpaired += 1
+            logger.warning(f"⚠️ انتهت مهلة السماح لموقع لم يُربط بأي طلب (رسالة {message_id}).")
+
+    # ⚠️ التخمين بالتجاور (رقم رسالة ±1) آمن فقط حين لا يوجد إلا مرشح واحد؛
+    # مع أكثر من طلب ينتظر قد يكون الموقع لأي منها، فلا نربطه بدل أن نرسله لطلب خاطئ
+    def _claim_orphan(self, order_message_id):
+        # الأولوية لموقع أُرسل ردًا على الطلب
+        for message_id, (_, reply_to, _) in self._orphans.items():
+            if reply_to == order_message_id:
+                return self._orphans.pop(message_id)[0]
+        # ثم لموقع ملاصق، بشرط ألا ينتظر طلب آخر وألا يوجد موقع آخر بلا رد
+        unreplied = [m for m, (_, reply_to, _) in self._orphans.items() if reply_to is None]
+        if not self._waiting and len(unreplied) == 1 and abs(unreplied[0] - order_message_id) == 1:
+            return self._orphans.pop(unreplied[0])[0]
+        return None
 
-    if not message or message.chat_id != CHANNEL_ID:
+    def expect(self, order_message_id, order_id):
+        """تسجيل طلب جديد وإرجاع Future يكتمل بموقعه عند وصوله"""
+        self._purge_orphans(time.monotonic())
+        future = asyncio.get_running_loop().create_future()
+
+        location = self._claim_orphan(order_message_id)
+        if location is not None:
+            self.paired += 1
+            future.set_result(location)
+        else:
+            self._waiting[order_message_id] = (order_id, future)
+        return future
+
+    def offer(self, location_message_id, location, reply_to=None):
+        """تسليم موقع وصل للقناة؛ يُرجع order_id إذا رُبط بطلب ينتظره"""
+        now = time.monotonic()
+        self._purge_orphans(now)
+
+        if reply_to:
+            order_message_id = reply_to
+        elif len(self._waiting) == 1:
+            # طلب واحد فقط ينتظر ولم يُنشر بينهما شيء آخر
+            order_message_id = next(iter(self._waiting))
+            if abs(order_message_id - location_message_id) != 1:
+                order_message_id = None
+        else:
+            order_message_id = None
+
+        entry = self._waiting.pop(order_message_id, None) if order_message_id is not None else None
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(location)
+            self.paired += 1
+            return entry[0]
+
+        if reply_to or not self._waiting:
+            # لم يصل طلبه بعد: نحتفظ به خلال مهلة السماح
+            self._orphans[location_message_id] = (location, reply_to, now)
+        else:
+            self.unpaired += 1
+            logger.warning(
+                f"⚠️ موقع بلا رد (رسالة {location_message_id}) مع {len(self._waiting)} طلب ينتظر؛ "
+                f"لا يمكن ربطه بطلب بعينه فلن يُرسل للكاشير."
+            )
+        return None
+
+    # "لا موقع" يُبلَّغ بنتيجة None لا بإلغاء الـ Future، فيبقى CancelledError خاصًا بإلغاء المهمة نفسها
+    def forget(self, order_message_id):
+        entry = self._waiting.pop(order_message_id, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(None)
+
+    def release_all(self):
+        """إنهاء انتظار كل الطلبات فورًا (عند الإيقاف لن يصل موقع جديد)"""
+        for _, future in self._waiting.values():
+            if not future.done():
+                future.set_result(None)
+
+    async def wait(self, order_message_id, future):
+        """انتظار موقع الطلب حتى نهاية مهلة السماح؛ يُرجع None إذا لم يصل"""
+        try:
+            return await asyncio.wait_for(future, timeout=self.grace)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._waiting.pop(order_message_id, None)
+
+    def stats(self):
+        return {
+            "waiting": len(self._waiting),
+            "orphans": len(self._orphans),
+            "paired": self.paired,
+            "unpaired": self.unpaired,
+        }
+
+
+async def forward_order_location(tenant, bot, record, order_message_id, location_future):
+    """إرسال موقع الطلب للكاشير عند وصوله، ردًا على رسالة الطلب"""
+    location = await tenant.locations.wait(order_message_id, location_future)
+    if location is None:
+        logger.info(f"ℹ️ لم يصل موقع للطلب {record.order_id} خلال مهلة السماح.")
         return
 
-    if not message.location:
+    async with order_lock(record.order_id):
+        # رُفض الطلب أو أُلغي خلال مهلة السماح: لا نرسل موقعه ولا نعيد حفظه
+        if record.status in TERMINAL_ORDER_STATUSES:
+            logger.info(f"ℹ️ تجاهل موقع الطلب {record.order_id} لأنه انتهى ({record.status}).")
+            return
+        record.location = location
+        record.order_details = (record.order_details or "") + "\n\n📍 *تم إرفاق الموقع الجغرافي*"
+
+    latitude, longitude = location
+    await outbound.submit(
+        PRIORITY_CRITICAL,
+        send_location_with_rate_limit,
+        bot,
+        tenant.cashier_chat_id,
+        latitude,
+        longitude,
+        reply_to_message_id=record.message_id,
+        allow_sending_without_reply=True
+    )
+    logger.info(f"✅ تم إرسال الموقع للكاشير (order_id={record.order_id})")
+
+    tenant.orders.persist(record)
+
+
+# ✅ تخزين الموقع فقط بدون إرسال
+async def handle_channel_location(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
+    message = update.channel_post
+
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     latitude = message.location.latitude
     longitude = message.location.longitude
     logger.info(f"📍 تم استلام موقع: {latitude}, {longitude}")
 
-    # ✅ حفظ الموقع في قائمة الانتظار
-    location_queue.append((latitude, longitude))
-
-    # ✅ حفظه مؤقتًا في الطلب الأخير إن وجد
-    last_order_id = max(pending_orders.keys(), default=None)
-    if last_order_id:
-        pending_orders[last_order_id]["location"] = (latitude, longitude)
-        logger.info(f"📍 تم ربط الموقع مؤقتًا بالطلب الأخير: {last_order_id}")
+    # ✅ ربط الموقع بطلبه عبر رقم رسالة القناة (أو الرسالة التي يرد عليها)
+    reply_to = message.reply_to_message.message_id if message.reply_to_message else None
+    order_id = tenant.locations.offer(message.message_id, (latitude, longitude), reply_to)
+    if order_id:
+        logger.info(f"📍 تم ربط الموقع بالطلب: {order_id}")
     else:
-        logger.warning("⚠️ لا يوجد طلبات حالية لربط الموقع بها.")
+        logger.info("📍 لم يُربط الموقع بطلب بعد.")
+
+
+
+
+
+# 🔘 أزرار سير الطلب: كل إجراء معالج مسجل باحتياجاته، والتجهيز المشترك يتم مرة واحدة في الموجّه
+CALLBACK_SLOW_SECONDS = float(os.getenv("CALLBACK_SLOW_SECONDS", 1.0))
 
+COMPLAINT_REASONS = {
+    "report_delivery": "🚪 وصل الديليفري ولم يجد الزبون",
+    "report_phone": "📞 رقم الهاتف غير صحيح",
+    "report_location": "📍 معلومات الموقع غير دقيقة",
+    "report_other": "❓ شكوى أخرى من الكاشير",
+}
 
 
+async def handle_accept_button(query, context, order, arg):
+    logger.info("✅ قبول الطلب - عرض أزرار الوقت")
+    await edit_query_reply_markup(query, reply_markup=keyboard_factory.build("time_picker", order.handle))
 
 
-async def button(update: Update, context: CallbackContext):
-    query = update.callback_query
-    data = query.data
-    logger.info(f"📩 تم الضغط على زر: {data}")
+async def handle_time_selection(query, context, order, time_selected):
+    tenant = tenant_of(context)
+    order_id = order.order_id
+    current_time = order.selected_time
 
+    try:
+        # ✅ أزرار الوقت مع تمييز المختار (قالب جاهز لكل وقت)
+        await edit_query_reply_markup(query, reply_markup=keyboard_factory.time_selected(order.handle, time_selected))
+
+        # ✅ إذا لم يتغير الوقت لا ترسل شيء جديد
+        if time_selected == current_time:
+            logger.info("🟡 تم اختيار نفس وقت التوصيل السابق. لا حاجة للإرسال.")
+            return
+
+        # ✅ حفظ الوقت الجديد
+        order.selected_time = time_selected
+        order.status = ORDER_STATUS_ACCEPTED
+        tenant.orders.persist(order)
+
+        # إرسال إشعار القبول
+        accept_message = create_order_accepted_message(order_id, order.order_number, time_selected)
+
+        channel_sent = dispatch_message(
+            context.bot,
+            tenant.channel_id,
+            accept_message,
+            priority=PRIORITY_CRITICAL,
+            order_id=order_id,
+            destination="channel",
+            parse_mode="Markdown"
+        )
+
+        confirm_text = (
+            f"✅ تم قبول الطلب\n\n"
+            f"🔢 رقم الطلب: {order.order_number}\n"
+            f"🆔 معرف الطلب: {order_id}\n\n"
+            f"⏱️ وقت التوصيل المتوقع: {time_selected} دقيقة"
+        )
+        cashier_sent = dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            confirm_text,
+            priority=PRIORITY_CRITICAL,
+            order_id=order_id,
+            destination="cashier"
+        )
+
+        # ✅ الوجهتان تُرسلان بالتوازي، وننتظرهما معًا لتسجيل أي فشل في إشعار القبول
+        await asyncio.gather(channel_sent, cashier_sent)
+
+        logger.info(f"✅ تم تحديث وقت الطلب: {time_selected} دقيقة (order_id={order_id})")
+
+    except Exception as e:
+        logger.error(f"❌ فشل في إرسال إشعار القبول: {e}")
+
+
+async def handle_reject_button(query, context, order, arg):
+    await edit_query_reply_markup(query, reply_markup=keyboard_factory.build("confirm_reject", order.handle))
+
+
+async def handle_confirm_reject_button(query, context, order, arg):
+    tenant = tenant_of(context)
+    await edit_query_reply_markup(query, reply_markup=None)
+    reject_msg = create_order_rejected_message(
+        order_id=order.order_id,
+        order_number=order.order_number,
+        reason="قد تكون معلومات المستخدم غير مكتملة أو غير واضحة."
+    )
+    dispatch_message(
+        context.bot,
+        tenant.channel_id,
+        reject_msg,
+        priority=PRIORITY_CRITICAL,
+        order_id=order.order_id,
+        parse_mode="Markdown"
+    )
+    await tenant.orders.finish(order.order_id, ORDER_STATUS_REJECTED)
+
+
+async def handle_back_button(query, context, order, arg):
+    await edit_query_reply_markup(query, reply_markup=keyboard_factory.build("order_actions", order.handle))
+
+
+async def handle_ready_button(query, context, order, arg):
+    delivery_persons = await get_all_delivery_persons(tenant_of(context).restaurant_id)
+    if not delivery_persons:
+        await query.answer("⚠️ لا يوجد دليفري مسجل حالياً.", show_alert=True)
+        return
     await query.answer()
 
+    # ✅ حفظ قائمة الدليفري في user_data
+    context.user_data[f"delivery_choice_{order.order_id}"] = delivery_persons
+
+    keyboard = [
+        [InlineKeyboardButton(f"{dp['name']} ({dp['phone']})", callback_data=encode_callback("select_delivery", order.handle, i))]
+        for i, dp in enumerate(delivery_persons)
+    ]
+
+    back_time = order.selected_time or "0"
+    if f"time_{back_time}" not in CALLBACK_ACTION_CODES:
+        back_time = "0"
+    keyboard.append([
+        InlineKeyboardButton("🔙 رجوع", callback_data=encode_callback(f"time_{back_time}", order.handle))
+    ])
+
+    await edit_query_reply_markup(query, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def handle_select_delivery_button(query, context, order, index):
+    tenant = tenant_of(context)
+    order_id = order.order_id
+    delivery_list = context.user_data.get(f"delivery_choice_{order_id}", [])
     try:
-        # ✅ تحليل خاص لأزرار اختيار الدليفري
-        if data.startswith("select_delivery|"):
-            parts = data.split("|")
-            if len(parts) != 3:
-                logger.warning("⚠️ بيانات الدليفري غير صالحة.")
-                return
-        
-            _, order_id, index = parts
-        
-            delivery_list = context.user_data.get(f"delivery_choice_{order_id}", [])
-            try:
-                delivery = delivery_list[int(index)]
-                delivery_name = delivery["name"]
-                delivery_phone = delivery["phone"]
-            except (IndexError, ValueError):
-                await query.answer("⚠️ لم يتم العثور على بيانات الدليفري.", show_alert=True)
-                return
+        delivery = delivery_list[int(index)]
+        delivery_name = delivery["name"]
+        delivery_phone = delivery["phone"]
+    except (IndexError, ValueError):
+        await query.answer("⚠️ لم يتم العثور على بيانات الدليفري.", show_alert=True)
+        return
+    await query.answer()
 
+    order.status = ORDER_STATUS_OUT_FOR_DELIVERY
+    tenant.orders.persist(order)
+    logger.info(f"✅ تم اختيار دليفري: {delivery_name} ({delivery_phone})")
+    await edit_query_reply_markup(query, reply_markup=keyboard_factory.build("complain_only", order.handle))
 
-            if order_id not in pending_orders:
-                logger.warning(f"⚠️ الطلب غير موجود ضمن pending_orders: {order_id}")
-                await query.answer("⚠️ الطلب لم يعد متاحاً.", show_alert=True)
-                return
+    confirm_text = (
+        f"🚗 *الطلب أصبح جاهزًا للتوصيل!*\n"
+        f"🧑‍💼 *الدليفري:* {delivery_name} ({delivery_phone})\n"
+        f"🆔 *معرف الطلب:* `{order_id}`"
+    )
 
-            logger.info(f"✅ تم اختيار دليفري: {delivery_name} ({delivery_phone})")
-            await query.edit_message_reply_markup(
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")]
-                ])
-            )
+    # 📤 الكاشير والقناة وجهتان مستقلتان، فيُرسل لهما بالتوازي عبر الموزّع
+    for chat_id, destination in ((tenant.cashier_chat_id, "cashier"), (tenant.channel_id, "channel")):
+        dispatch_message(
+            context.bot,
+            chat_id,
+            confirm_text,
+            priority=PRIORITY_NORMAL,
+            order_id=order_id,
+            destination=destination,
+            parse_mode="Markdown"
+        )
 
 
-            confirm_text = (
-                f"🚗 *الطلب أصبح جاهزًا للتوصيل!*\n"
-                f"🧑‍💼 *الدليفري:* {delivery_name} ({delivery_phone})\n"
-                f"🆔 *معرف الطلب:* `{order_id}`"
-            )
+async def handle_complain_button(query, context, order, arg):
+    await edit_query_reply_markup(query, reply_markup=keyboard_factory.build("complaint_reasons", order.handle))
 
-            message_id_1 = str(uuid.uuid4())
-            await track_sent_message(message_id_1, order_id, "restaurant_bot", "cashier", confirm_text)
-            await send_message_with_retry(
-                bot=context.bot,
-                chat_id=CASHIER_CHAT_ID,
-                text=confirm_text,
-                order_id=order_id,
-                message_id=message_id_1,
-                parse_mode="Markdown"
-            )
 
-            message_id_2 = str(uuid.uuid4())
-            await track_sent_message(message_id_2, order_id, "restaurant_bot", "channel", confirm_text)
-            await send_message_with_retry(
-                bot=context.bot,
-                chat_id=CHANNEL_ID,
-                text=confirm_text,
+def make_report_handler(report_type):
+    reason_text = COMPLAINT_REASONS[report_type]
+
+    async def handle_report_button(query, context, order, arg):
+        tenant = tenant_of(context)
+        order_id = order.order_id
+        complaint_text = (
+            f"📣 *شكوى من الكاشير على الطلب:*\n"
+            f"📌 معرف الطلب: `{order_id}`\n"
+            f"📍 السبب: {reason_text}\n\n"
+            f"📝 *تفاصيل الطلب:*\n\n{order.order_details or ''}"
+        )
+        for chat_id in (tenant.complaints_chat_id, tenant.channel_id):
+            dispatch_message(
+                context.bot,
+                chat_id,
+                complaint_text,
+                priority=PRIORITY_NORMAL,
                 order_id=order_id,
-                message_id=message_id_2,
                 parse_mode="Markdown"
             )
-            return  # 🛑 توقف هنا، لا تحلل باقي الزر
 
-        # ✅ تحليل الأزرار العادية (التي تستخدم "_")
-        parts = data.split("_")
-        if len(parts) < 2:
-            logger.warning("⚠️ البيانات غير صالحة داخل callback_data.")
-            return
+        await edit_query_reply_markup(query, reply_markup=None)
+        dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            "📨 تم إرسال الشكوى وإلغاء الطلب. سيتواصل معكم فريق الدعم إذا لزم الأمر.",
+            priority=PRIORITY_NORMAL,
+            order_id=order_id
+        )
+        await tenant.orders.finish(order_id, ORDER_STATUS_CANCELLED)
 
-        action = parts[0]
-        if action == "report":
-            report_type = f"{parts[0]}_{parts[1]}"
-            order_id = "_".join(parts[2:])
-        else:
-            report_type = None
-            order_id = "_".join(parts[1:])
+    return handle_report_button
 
-        logger.debug(f"🔍 تحليل callback_data: action={action}, order_id={order_id}, report_type={report_type}")
 
-        if order_id not in pending_orders:
-            logger.warning(f"⚠️ الطلب غير موجود ضمن pending_orders: {order_id}")
-            await query.answer("⚠️ الطلب لم يعد متاحاً.", show_alert=True)
-            return
+class CallbackRoute:
+    """إجراء زر مسجل: المعالج مع ما يحتاجه من تجهيز مسبق"""
 
-        lock = await get_order_lock(order_id)
-        async with lock:
-            order_info = pending_orders[order_id]
-            message_id = order_info.get("message_id")
-            order_details = order_info.get("order_details", "")
-            order_number = extract_order_number(order_details)
-
-            if action == "accept":
-                logger.info("✅ قبول الطلب - عرض أزرار الوقت")
-                keyboard = [
-                    [InlineKeyboardButton(f"{t} دقيقة", callback_data=f"time_{t}_{order_id}")]
-                    for t in [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90]
-                ]
-                keyboard.append([InlineKeyboardButton("📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
-                keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")])
-                await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+    __slots__ = ("handler", "needs_order", "locked", "answers")
 
-            elif action.startswith("time"):
-                selected_time = action.replace("time_", "")
-                order_info["selected_time"] = selected_time
-                logger.info(f"⏱️ تم اختيار وقت التوصيل: {selected_time}")
-
-                # ✅ أزرار الوقت
-                time_options = [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90]
-                keyboard = []
-                for t in time_options:
-                    label = f"{t} دقيقة"
-                    if str(t) == selected_time:
-                        label = f"✅ {label}"
-                    keyboard.append([InlineKeyboardButton(label, callback_data=f"time_{t}_{order_id}")])
-                if selected_time == "90+":
-                    keyboard.append([InlineKeyboardButton("✅ 📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
-                else:
-                    keyboard.append([InlineKeyboardButton("📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
-                keyboard.append([InlineKeyboardButton("🚗 جاهز ليطلع", callback_data=f"ready_{order_id}")])
-                keyboard.append([InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")])
-
-                await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-
-                # رسالة التأكيد
-                confirm_text = (
-                    f"✅ تم قبول الطلب\n\n"
-                    f"🔢 رقم الطلب: {order_number}\n"
-                    f"🆔 معرف الطلب: {order_id}\n\n"
-                    f"⏱️ وقت التوصيل المتوقع: {selected_time} دقيقة"
-                )
-                await context.bot.send_message(chat_id=CASHIER_CHAT_ID, text=confirm_text)
-
-            elif action == "reject":
-                await query.edit_message_reply_markup(
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("⚠️ تأكيد الرفض", callback_data=f"confirmreject_{order_id}")],
-                        [InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")]
-                    ])
-                )
+    def __init__(self, handler, needs_order=True, locked=True, answers=False):
+        self.handler = handler
+        self.needs_order = needs_order  # إيجاد الطلب الحي قبل الاستدعاء
+        self.locked = locked            # تنفيذ المعالج تحت قفل الطلب
+        self.answers = answers          # المعالج يرد على الاستعلام بنفسه (مثلاً بتنبيه)
 
-            elif action == "confirmreject":
-                await query.edit_message_reply_markup(reply_markup=None)
-                reject_msg = create_order_rejected_message(
-                    order_id=order_id,
-                    order_number=order_number,
-                    reason="قد تكون معلومات المستخدم غير مكتملة أو غير واضحة."
-                )
-                await send_message_with_retry(
-                    bot=context.bot,
-                    chat_id=CHANNEL_ID,
-                    text=reject_msg,
-                    order_id=order_id,
-                    message_id=str(uuid.uuid4()),
-                    parse_mode="Markdown"
-                )
 
+class CallbackRouter:
+    """فك callback_data مرة واحدة، تجهيز الطلب والقفل والرد حسب الإجراء، ثم التوجيه عبر جدول مع قياس الزمن"""
 
-            elif action == "back":
-                await query.edit_message_reply_markup(
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"accept_{order_id}")],
-                        [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"reject_{order_id}")],
-                        [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")]
-                    ])
-                )
+    def __init__(self, slow_threshold):
+        self.slow_threshold = slow_threshold
+        self.routes = {}
+        self.latency = {}  # الإجراء -> [العدد، مجموع الزمن، أقصى زمن]
+        self.invalid = 0
 
-            elif action == "ready":
-                delivery_persons = await get_all_delivery_persons()
-                if not delivery_persons:
-                    await query.answer("⚠️ لا يوجد دليفري مسجل حالياً.", show_alert=True)
-                    return
-            
-                # ✅ حفظ قائمة الدليفري في user_data
-                context.user_data[f"delivery_choice_{order_id}"] = delivery_persons
-            
-                keyboard = []
-                for i, dp in enumerate(delivery_persons):  # ✅ استخدم enumerate
-                    name, phone = dp["name"], dp["phone"]
-                    callback_data = f"select_delivery|{order_id}|{i}"
-                    keyboard.append([InlineKeyboardButton(f"{name} ({phone})", callback_data=callback_data)])
-            
-                keyboard.append([
-                    InlineKeyboardButton("🔙 رجوع", callback_data=f"time_{order_info.get('selected_time', '0')}_{order_id}")
-                ])
-            
-                await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-
-
-            elif action == "complain":
-                await query.edit_message_reply_markup(
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🚪 وصل الديليفري ولم يجد الزبون", callback_data=f"report_delivery_{order_id}")],
-                        [InlineKeyboardButton("📞 رقم الهاتف غير صحيح", callback_data=f"report_phone_{order_id}")],
-                        [InlineKeyboardButton("📍 معلومات الموقع غير دقيقة", callback_data=f"report_location_{order_id}")],
-                        [InlineKeyboardButton("❓ مشكلة أخرى", callback_data=f"report_other_{order_id}")],
-                        [InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")]
-                    ])
-                )
+    def register(self, action, handler, **needs):
+        self.routes[action] = CallbackRoute(handler, **needs)
 
-            elif report_type:
-                reason_map = {
-                    "report_delivery": "🚪 وصل الديليفري ولم يجد الزبون",
-                    "report_phone": "📞 رقم الهاتف غير صحيح",
-                    "report_location": "📍 معلومات الموقع غير دقيقة",
-                    "report_other": "❓ شكوى أخرى من الكاشير"
-                }
-                reason_text = reason_map.get(report_type, "شكوى غير معروفة")
-                complaint_text = (
-                    f"📣 *شكوى من الكاشير على الطلب:*\n"
-                    f"📌 معرف الطلب: `{order_id}`\n"
-                    f"📍 السبب: {reason_text}\n\n"
-                    f"📝 *تفاصيل الطلب:*\n\n{order_details}"
-                )
-                await send_message_with_retry(
-                    bot=context.bot,
-                    chat_id=RESTAURANT_COMPLAINTS_CHAT_ID,
-                    text=complaint_text,
-                    order_id=order_id,
-                    message_id=str(uuid.uuid4()),
-                    parse_mode="Markdown"
-                )
-                await send_message_with_retry(
-                    bot=context.bot,
-                    chat_id=CHANNEL_ID,
-                    text=complaint_text,
-                    order_id=order_id,
-                    message_id=str(uuid.uuid4()),
-                    parse_mode="Markdown"
-                )
+    async def dispatch(self, update: Update, context: CallbackContext):
+        query = update.callback_query
+        logger.info(f"📩 تم الضغط على زر: {query.data}")
 
+        parsed = parse_callback_data(query.data or "")
+        route = self.routes.get(parsed[0]) if parsed is not None else None
+        if route is None:
+            self.invalid += 1
+            logger.warning("⚠️ البيانات غير صالحة داخل callback_data.")
+            await query.answer()
+            return
 
-                await query.edit_message_reply_markup(reply_markup=None)
-                await context.bot.send_message(
-                    chat_id=CASHIER_CHAT_ID,
-                    text="📨 تم إرسال الشكوى وإلغاء الطلب. سيتواصل معكم فريق الدعم إذا لزم الأمر."
-                )
+        action, order_token, arg = parsed
+        start = time.perf_counter()
+        try:
+            await self._run(route, query, context, order_token, arg)
+        except Exception as e:
+            logger.exception(f"❌ استثناء غير متوقع في معالج الزر {action}: {e}")
+        finally:
+            self._record(action, time.perf_counter() - start)
+
+    async def _run(self, route, query, context, order_token, arg):
+        order = None
+        if route.needs_order:
+            # 🔎 إن لم يُعرف الطلب نرجع إلى رسالة الكاشير التي ضُغط زرها
+            order = await resolve_callback_order(tenant_of(context).orders, order_token, query)
+            if order is None:
+                logger.warning(f"⚠️ الطلب غير موجود ضمن الطلبات الحية: {order_token}")
+                await query.answer("⚠️ الطلب لم يعد متاحاً.", show_alert=True)
+                return
 
-    except Exception as e:
-        logger.exception(f"❌ استثناء غير متوقع في button handler: {e}")
+        if not route.answers:
+            await query.answer()
 
+        if route.locked and order is not None:
+            async with order_lock(order.order_id):
+                await route.handler(query, context, order, arg)
+        else:
+            await route.handler(query, context, order, arg)
 
+    def _record(self, action, elapsed):
+        entry = self.latency.get(action)
+        if entry is None:
+            entry = self.latency[action] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+        if elapsed > self.slow_threshold:
+            logger.warning(f"🐢 معالجة الزر {action} استغرقت {elapsed:.2f} ثانية")
 
-async def handle_time_selection(update: Update, context: CallbackContext):
-    query = update.callback_query
-    await query.answer()
+    def stats(self):
+        result = {
+            action: {"count": count, "avg_ms": round(total / count * 1000, 2), "max_ms": round(peak * 1000, 2)}
+            for action, (count, total, peak) in self.latency.items()
+        }
+        result["invalid"] = self.invalid
+        return result
 
-    match = re.match(r"time_(\d+\+?)_(.+)", query.data)
-    if not match:
-        return
 
-    time_selected, order_id = match.groups()
+callback_router = CallbackRouter(slow_threshold=CALLBACK_SLOW_SECONDS)
+callback_router.register("accept", handle_accept_button)
+callback_router.register("time", handle_time_selection)
+callback_router.register("reject", handle_reject_button)
+callback_router.register("confirmreject", handle_confirm_reject_button)
+callback_router.register("back", handle_back_button)
+callback_router.register("ready", handle_ready_button, answers=True)
+callback_router.register("select_delivery", handle_select_delivery_button, answers=True)
+callback_router.register("complain", handle_complain_button)
+for _report_type in COMPLAINT_REASONS:
+    callback_router.register(_report_type, make_report_handler(_report_type))
 
-    if order_id not in pending_orders:
-        await query.answer("⚠️ الطلب غير متاح حالياً.", show_alert=True)
-        return
 
-    lock = await get_order_lock(order_id)
+def generate_time_keyboard(handle, selected_time):
+    return keyboard_factory.time_selected(handle, selected_time).inline_keyboard
 
-    async with lock:
-        order_info = pending_orders[order_id]
-        current_time = order_info.get("selected_time")
-        message_id = order_info.get("message_id")
-        order_details = order_info.get("order_details", "")
-        order_number = extract_order_number(order_details)
 
-        try:
-            # ✅ توليد أزرار الوقت مع تمييز المختار
-            time_options = [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90]
-            keyboard = []
-
-            for t in time_options:
-                label = f"{t} دقيقة"
-                if str(t) == time_selected:
-                    label = f"✅ {label}"
-                keyboard.append([InlineKeyboardButton(label, callback_data=f"time_{t}_{order_id}")])
-
-            if time_selected == "90+":
-                keyboard.append([InlineKeyboardButton("✅ 📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
-            else:
-                keyboard.append([InlineKeyboardButton("📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
 
-            keyboard.append([InlineKeyboardButton("🚗 جاهز ليطلع", callback_data=f"ready_{order_id}")])
-            keyboard.append([InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")])
 
-            await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+# 🚚 قائمة الدليفري لكل مطعم في الذاكرة
+DELIVERY_ROSTER_REFRESH_INTERVAL = float(os.getenv("DELIVERY_ROSTER_REFRESH_INTERVAL", 300))
 
-            # ✅ إذا لم يتغير الوقت لا ترسل شيء جديد
-            if time_selected == current_time:
-                logger.info("🟡 تم اختيار نفس وقت التوصيل السابق. لا حاجة للإرسال.")
-                return
 
-            # ✅ حفظ الوقت الجديد
-            order_info["selected_time"] = time_selected
+class DeliveryRoster:
+    """قائمة الدليفري لكل مطعم: تُحمّل مرة واحدة، وتُحدَّث مباشرة عند الإضافة والحذف
 
-            # إرسال إشعار القبول
-            accept_message = create_order_accepted_message(order_id, order_number, time_selected)
+    كل قائمة tuple غير قابلة للتعديل تُستبدل عند الكتابة، فالنسخ المحفوظة في user_data
+    (لاختيار الدليفري بالترتيب) تبقى ثابتة.
+    """
 
-            message_id_channel = str(uuid.uuid4())
-            await track_sent_message(message_id_channel, order_id, "restaurant_bot", "channel", accept_message)
-            await send_message_with_retry(
-                bot=context.bot,
-                chat_id=CHANNEL_ID,
-                text=accept_message,
-                order_id=order_id,
-                message_id=message_id_channel,
-                parse_mode="Markdown"
-            )
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._rosters = {}  # restaurant_id -> tuple({"name", "phone"})
+        self._versions = {}  # يزداد مع كل كتابة، لرفض تحديث دوري تزامن معها
+        self._task = None
 
-            confirm_text = (
-                f"✅ تم قبول الطلب\n\n"
-                f"🔢 رقم الطلب: {order_number}\n"
-                f"🆔 معرف الطلب: {order_id}\n\n"
-                f"⏱️ وقت التوصيل المتوقع: {time_selected} دقيقة"
-            )
-            message_id_cashier = str(uuid.uuid4())
-            await track_sent_message(message_id_cashier, order_id, "restaurant_bot", "cashier", confirm_text)
-            await send_message_with_retry(
-                bot=context.bot,
-                chat_id=CASHIER_CHAT_ID,
-                text=confirm_text,
-                order_id=order_id,
-                message_id=message_id_cashier
-            )
+        # 📊 مقاييس
+        self.hits = 0
+        self.loads = 0
+
+    async def _load(self, restaurant_id):
+        version = self._versions.get(restaurant_id, 0)
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT name, phone FROM delivery_persons WHERE restaurant_id = %s ORDER BY id",
+                    (restaurant_id,)
+                )
+                rows = await cursor.fetchall()
 
-            logger.info(f"✅ تم تحديث وقت الطلب: {time_selected} دقيقة (order_id={order_id})")
+        roster = tuple({"name": name, "phone": phone} for name, phone in rows)
+        self.loads += 1
+        if self._versions.get(restaurant_id, 0) == version:
+            self._rosters[restaurant_id] = roster
+        return self._rosters.get(restaurant_id, roster)
 
-        except Exception as e:
-            logger.error(f"❌ فشل في إرسال إشعار القبول: {e}")
+    async def get(self, restaurant_id):
+        roster = self._rosters.get(restaurant_id)
+        if roster is not None:
+            self.hits += 1
+            return roster
+        return await self._load(restaurant_id)
+
+    async def add(self, restaurant_id, name, phone):
+        async with get_db_connection() as db:
+            async with db.cursor() as cursor:
+                await cursor.execute(
+                    "INSERT INTO delivery_persons (restaurant_id, name, phone) VALUES (%s, %s, %s)",
+                    (restaurant_id, name, phone)
+                )
+            await db.commit()
 
+        self._versions[restaurant_id] = self._versions.get(restaurant_id, 0) + 1
+        if restaurant_id in self._rosters:
+            self._rosters[restaurant_id] += ({"name": name, "phone": phone},)
 
+    async def remove(self, restaurant_id, name):
+        async with get_db_connection() as db:
+            async with db.cursor() as cursor:
+                await cursor.execute(
+                    "DELETE FROM delivery_persons WHERE restaurant_id = %s AND name = %s",
+                    (restaurant_id, name)
+                )
+            await db.commit()
 
-def generate_time_keyboard(order_id, selected_time):
-    time_options = [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90]
-    keyboard = []
-    for t in time_options:
-        label = f"{t} دقيقة"
-        if str(t) == selected_time:
-            label = f"✅ {label}"
-        keyboard.append([InlineKeyboardButton(label, callback_data=f"time_{t}_{order_id}")])
+        self._versions[restaurant_id] = self._versions.get(restaurant_id, 0) + 1
+        if restaurant_id in self._rosters:
+            self._rosters[restaurant_id] = tuple(
+                person for person in self._rosters[restaurant_id] if person["name"] != name
+            )
 
-    if selected_time == "90+":
-        keyboard.append([InlineKeyboardButton("✅ 📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
-    else:
-        keyboard.append([InlineKeyboardButton("📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
 
-    keyboard.append([InlineKeyboardButton("🚗 جاهز ليطلع", callback_data=f"ready_{order_id}")])
-    keyboard.append([InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")])
-    return keyboard
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
 
+    def stats(self):
+        return {"restaurants": len(self._rosters), "hits": self.hits, "loads": self.loads}
 
+    async def _refresh_loop(self):
+        # التقاط التعديلات التي تمت خارج البوت (لوحة الإدارة أو قاعدة البيانات مباشرة)
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for restaurant_id in list(self._rosters):
+                try:
+                    await self._load(restaurant_id)
+                except Exception as e:
+                    logger.error(f"❌ فشل تحديث قائمة الدليفري للمطعم {restaurant_id}: {e}")
 
 
-async def get_all_delivery_persons():
-    """🔍 جلب جميع أسماء وأرقام الدليفري من قاعدة البيانات"""
+delivery_roster = DeliveryRoster(refresh_interval=DELIVERY_ROSTER_REFRESH_INTERVAL)
+
+
+async def get_all_delivery_persons(restaurant_id):
+    """🔍 أسماء وأرقام دليفري المطعم (من الذاكرة)"""
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT name, phone FROM delivery_persons")
-                rows = await cursor.fetchall()
-                return [{"name": row[0], "phone": row[1]} for row in rows]
+        return await delivery_roster.get(restaurant_id)
     except Exception as e:
         logger.error(f"❌ خطأ أثناء جلب قائمة الدليفري: {e}")
-        return []
+        return ()
 
 
 
@@ -1146,40 +3097,30 @@ async def get_all_delivery_persons():
 
 
 # 🔔 إعادة إرسال التذكير كما هو
-async def handle_channel_reminder(update: Update, context: CallbackContext):
+async def handle_channel_reminder(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
     logger.info(f"📡 تم استلام رسالة من القناة: chat_id={message.chat_id} | النص: {text}")
 
-    if "تذكير من الزبون" not in text:
-        return
-
     logger.info(f"📥 استلم البوت تذكيرًا جديدًا: {text}")
 
     try:
         reminder_text = f"🔔 *تذكير من الزبون!*\n\n{text}"
-        message_id = str(uuid.uuid4())
 
         # اختياري: محاولة استخراج order_id إذا وُجد
-        order_id = extract_order_id(text)
+        order_id = parsed.order_id
 
-        await track_sent_message(
-            message_id=message_id,
+        await dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            reminder_text,
+            priority=PRIORITY_INFO,
             order_id=order_id or "unknown",
-            source="restaurant_bot",
             destination="cashier",
-            content=reminder_text
-        )
-
-        await send_message_with_retry(
-            bot=context.bot,
-            chat_id=CASHIER_CHAT_ID,
-            text=reminder_text,
-            order_id=order_id or "unknown",
-            message_id=message_id,
             parse_mode="Markdown"
         )
 
@@ -1193,8 +3134,9 @@ async def handle_channel_reminder(update: Update, context: CallbackContext):
 
 # 🔔 إعادة إرسال التذكير بصيغة أخرى (إن رغبت بفصلها)
 async def handle_reminder_message(update: Update, context: CallbackContext):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
@@ -1204,23 +3146,15 @@ async def handle_reminder_message(update: Update, context: CallbackContext):
         return
 
     try:
-        message_id = str(uuid.uuid4())
-        order_id = extract_order_id(text)
-
-        await track_sent_message(
-            message_id=message_id,
-            order_id=order_id or "unknown",
-            source="restaurant_bot",
-            destination="cashier",
-            content=text
-        )
+        order_id = parse_channel_message(text).order_id
 
-        await send_message_with_retry(
-            bot=context.bot,
-            chat_id=CASHIER_CHAT_ID,
-            text=text,
+        await dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            text,
+            priority=PRIORITY_INFO,
             order_id=order_id or "unknown",
-            message_id=message_id
+            destination="cashier"
         )
 
         logger.info("✅ تم إعادة إرسال التذكير للكاشير.")
@@ -1233,31 +3167,41 @@ async def handle_reminder_message(update: Update, context: CallbackContext):
 
 
 # ⏳ استفسار "كم يتبقى؟"
-async def handle_time_left_question(update: Update, context: CallbackContext):
+async def handle_time_left_question(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
     logger.info(f"📡 تم استلام رسالة من القناة: chat_id={message.chat_id} | النص: {text}")
 
-    if "كم يتبقى" not in text or "الطلب رقم" not in text:
-        return
-
     logger.info("📥 تم استلام استفسار عن المدة المتبقية للطلب...")
 
-    order_number = extract_order_number(text)
+    order_number = parsed.order_number
     if not order_number:
         logger.warning("⚠️ لم يتم العثور على رقم الطلب في الاستفسار.")
         return
 
+    # 🔎 إن كان الطلب حيًا نرسل الاستفسار ردًا على رسالته عند الكاشير مباشرة
+    order = tenant.orders.find_by_number(order_number)
+    # إن حذف الكاشير رسالة الطلب يُرسل الاستفسار رسالةً عادية بدل أن يرفضه Telegram
+    reply_kwargs = (
+        {"reply_to_message_id": order.message_id, "allow_sending_without_reply": True}
+        if order and order.message_id else {}
+    )
+
     try:
-        await context.bot.send_message(
-            chat_id=CASHIER_CHAT_ID,
-            text=(
+        await dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            (
                 f"⏳ الزبون عم يسأل كم باقي لطلبه رقم {order_number}؟\n"
                 f"🔁 ارجع لرسالة الطلب واختر الوقت من الأزرار المرفقة تحتها 🙏"
-            )
+            ),
+            priority=PRIORITY_INFO,
+            order_id=order.order_id if order else None,
+            **reply_kwargs
         )
         logger.info(f"✅ تم إرسال إشعار المدة للكاشير (طلب رقم {order_number}).")
 
@@ -1268,57 +3212,51 @@ async def handle_time_left_question(update: Update, context: CallbackContext):
 
 # ⭐ استلام التقييم من الزبون
 async def handle_rating_feedback(update: Update, context: CallbackContext):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
     logger.info(f"📩 استلمنا إشعار تقييم من الزبون: {text}")
 
-    match = re.search(r"رقم (\d+)", text)
-    if not match:
+    order_number = parse_channel_message(text).order_number
+    if not order_number:
         logger.warning("⚠️ لم يتم العثور على رقم الطلب في إشعار التقييم!")
         return
 
-    order_number = match.group(1)
+    order = tenant.orders.find_by_number(order_number)
+    if order is None:
+        logger.warning(f"⚠️ لا يوجد طلب حي بالرقم: {order_number}")
+        return
+
+    order_id = order.order_id
+    message_id = order.message_id
+    if not message_id:
+        logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
+        return
+    try:
+        await dispatch_edit_reply_markup(context.bot, tenant.cashier_chat_id, message_id, priority=PRIORITY_INFO)
+        logger.info(f"✅ تم إزالة الأزرار من رسالة الطلب رقم: {order_number}")
+        await tenant.orders.finish(order_id, ORDER_STATUS_RATED)
+    except Exception as e:
+        logger.error(f"❌ فشل في إزالة الأزرار: {e}")
 
-    for order_id, data in pending_orders.items():
-        if f"رقم الطلب:* `{order_number}`" in data["order_details"]:
-            message_id = data.get("message_id")
-            if not message_id:
-                logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
-                return
-            try:
-                await context.bot.edit_message_reply_markup(
-                    chat_id=CASHIER_CHAT_ID,
-                    message_id=message_id,
-                    reply_markup=None
-                )
-                logger.info(f"✅ تم إزالة الأزرار من رسالة الطلب رقم: {order_number}")
-            except Exception as e:
-                logger.error(f"❌ فشل في إزالة الأزرار: {e}")
-           
 
 
 
 # ✅ استلام التقييم من الزبون
-async def handle_order_delivered_rating(update: Update, context: CallbackContext):
+async def handle_order_delivered_rating(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
     logger.info(f"📩 محتوى رسالة القناة (لتقييم الطلب): {text}")
 
-    if "استلم طلبه رقم" not in text or "معرف الطلب" not in text:
-        logger.info("ℹ️ تم تجاهل رسالة التقييم، ليست كاملة.")
-        return
-
-    order_number_match = re.search(r"طلبه رقم\s*(\d+)", text)
-    order_number = order_number_match.group(1) if order_number_match else None
-
-    order_id_match = re.search(r"معرف الطلب:\s*(\w+)", text)
-    order_id = order_id_match.group(1) if order_id_match else None
+    order_number = parsed.order_number
+    order_id = parsed.order_id
 
     if not order_number or not order_id:
         logger.warning("⚠️ لم يتم استخراج رقم الطلب أو معرف الطلب من رسالة التقييم.")
@@ -1326,93 +3264,81 @@ async def handle_order_delivered_rating(update: Update, context: CallbackContext
 
     logger.info(f"🔍 تم استلام تقييم لطلب رقم: {order_number} - معرف الطلب: {order_id}")
 
-    order_data = pending_orders.get(order_id)
+    order_data = await tenant.orders.get(order_id)
     if not order_data:
         logger.warning(f"⚠️ لم يتم العثور على الطلب بمعرف: {order_id}")
         return
 
-    message_id = order_data.get("message_id")
+    message_id = order_data.message_id
     if not message_id:
         logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
         return
 
     try:
-        await context.bot.edit_message_reply_markup(
-            chat_id=CASHIER_CHAT_ID,
-            message_id=message_id,
-            reply_markup=None
-        )
-        logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
+        buttons_removed = dispatch_edit_reply_markup(context.bot, tenant.cashier_chat_id, message_id, priority=PRIORITY_INFO)
 
-        stars = extract_stars(text)
+        stars = parsed.stars or "⭐️"
 
         # 1. إعداد النص
         message_text = f"✅ الزبون استلم طلبه رقم {order_number} وقام بتقييمه بـ {stars}"
-        
-        # 2. توليد معرف فريد وتتبع الرسالة
-        message_id = str(uuid.uuid4())
-        await track_sent_message(
-            message_id=message_id,
-            order_id=order_id,  # تأكد من توفر order_id أو استخرجه من النص
-            source="restaurant_bot",
-            destination="cashier",
-            content=message_text
-        )
-        
-        # 3. إرسال الرسالة مع retry وتحديد message_id
-        await send_message_with_retry(
-            bot=context.bot,
-            chat_id=CASHIER_CHAT_ID,
-            text=message_text,
+
+        # 2. إرسال الرسالة عبر الموزّع مع تتبعها
+        notice_sent = dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            message_text,
+            priority=PRIORITY_INFO,
             order_id=order_id,
-            message_id=message_id
+            destination="cashier"
         )
 
+        await asyncio.gather(buttons_removed, notice_sent)
+        logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
+
+        # ✅ الطلب وصل للزبون: حالة نهائية
+        await tenant.orders.finish(order_id, ORDER_STATUS_DELIVERED)
 
     except Exception as e:
         logger.error(f"❌ خطأ أثناء إزالة الأزرار أو إرسال إشعار: {e}")
     
 
 
-async def handle_report_cancellation_notice(update: Update, context: CallbackContext):
+async def handle_report_cancellation_notice(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
     logger.info(f"📩 تم استلام إشعار إلغاء مع تقرير: {text}")
 
-    # 🧠 استخراج رقم ومعرف الطلب
-    order_id = extract_order_id(text)
-    order_number = extract_order_number(text)
+    # 🧠 رقم ومعرف الطلب وسبب الإلغاء من تحليل الموجّه
+    order_id = parsed.order_id
+    order_number = parsed.order_number
 
-    if not order_id or not order_number:
+    if not order_id and not order_number:
         logger.warning("⚠️ لم يتم العثور على رقم الطلب أو معرف الطلب في الرسالة.")
         return
 
-    order_data = pending_orders.get(order_id)
+    # 🔎 المعرف أولاً، ثم فهرس رقم الطلب إن غاب المعرف عن الرسالة
+    order_data = await tenant.orders.get(order_id) if order_id else tenant.orders.find_by_number(order_number)
     if not order_data:
-        logger.warning(f"⚠️ الطلب غير موجود في pending_orders: {order_id}")
+        logger.warning(f"⚠️ الطلب غير موجود ضمن الطلبات الحية: {order_id or order_number}")
         return
+    order_id = order_data.order_id
+    order_number = order_number or order_data.order_number
 
-    cashier_message_id = order_data.get("message_id")
+    cashier_message_id = order_data.message_id
     if not cashier_message_id:
         logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
         return
 
-    # 🔍 استخراج سبب الإلغاء الحقيقي من نص الرسالة
-    import re
-    reason_match = re.search(r"💬 سبب الإلغاء:\n(.+)", text, re.DOTALL)
-    reason = reason_match.group(1).strip() if reason_match else "لم يُذكر سبب واضح."
+    # 🔍 سبب الإلغاء الحقيقي كما ورد في نص الرسالة
+    reason = parsed.cancellation_reason or "لم يُذكر سبب واضح."
 
     try:
         # 1. حذف الأزرار
-        await context.bot.edit_message_reply_markup(
-            chat_id=CASHIER_CHAT_ID,
-            message_id=cashier_message_id,
-            reply_markup=None
-        )
-        logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
+        buttons_removed = dispatch_edit_reply_markup(context.bot, tenant.cashier_chat_id, cashier_message_id)
 
         # 2. تجهيز نص الرسالة
         message_text = (
@@ -1422,26 +3348,22 @@ async def handle_report_cancellation_notice(update: Update, context: CallbackCon
             f"📞 يمكنكم التواصل مع الزبون عبر رقم الهاتف المرفق في الطلب."
         )
 
-        # 3. تتبع الرسالة
-        message_id = str(uuid.uuid4())
-        await track_sent_message(
-            message_id=message_id,
+        # 3. إرسال إلى الكاشير مع تتبع الرسالة
+        notice_sent = dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            message_text,
+            priority=PRIORITY_NORMAL,
             order_id=order_id,
-            source="restaurant_bot",
             destination="cashier",
-            content=message_text
-        )
-
-        # 4. إرسال إلى الكاشير
-        await send_message_with_retry(
-            bot=context.bot,
-            chat_id=CASHIER_CHAT_ID,
-            text=message_text,
-            order_id=order_id,
-            message_id=message_id,
             parse_mode="Markdown"
         )
 
+        await asyncio.gather(buttons_removed, notice_sent)
+        logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
+
+        await tenant.orders.finish(order_id, ORDER_STATUS_CANCELLED)
+
     except Exception as e:
         logger.error(f"❌ خطأ أثناء معالجة إلغاء مع تقرير: {e}")
 
@@ -1449,40 +3371,39 @@ async def handle_report_cancellation_notice(update: Update, context: CallbackCon
 
 
 # ✅ استلام إلغاء الطلب من الزبون (إلغاء عادي أو بسبب التأخر)
-async def handle_standard_cancellation_notice(update: Update, context: CallbackContext):
+async def handle_standard_cancellation_notice(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
     text = message.text or ""
     logger.info(f"📩 تم استلام إشعار إلغاء: {text}")
 
-    # 🧠 استخراج رقم ومعرف الطلب باستخدام الدوال الموحدة
-    order_id = extract_order_id(text)
-    order_number = extract_order_number(text)
+    # 🧠 رقم ومعرف الطلب من تحليل الموجّه
+    order_id = parsed.order_id
+    order_number = parsed.order_number
 
-    if not order_id or not order_number:
+    if not order_id and not order_number:
         logger.warning("⚠️ لم يتم العثور على رقم الطلب أو معرف الطلب في الرسالة.")
         return
 
-    order_data = pending_orders.get(order_id)
+    # 🔎 المعرف أولاً، ثم فهرس رقم الطلب إن غاب المعرف عن الرسالة
+    order_data = await tenant.orders.get(order_id) if order_id else tenant.orders.find_by_number(order_number)
     if not order_data:
-        logger.warning(f"⚠️ الطلب غير موجود في pending_orders: {order_id}")
+        logger.warning(f"⚠️ الطلب غير موجود ضمن الطلبات الحية: {order_id or order_number}")
         return
+    order_id = order_data.order_id
+    order_number = order_number or order_data.order_number
 
-    cashier_message_id = order_data.get("message_id")
+    cashier_message_id = order_data.message_id
     if not cashier_message_id:
         logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
         return
 
     try:
         # 🧼 إزالة الأزرار من رسالة الكاشير
-        await context.bot.edit_message_reply_markup(
-            chat_id=CASHIER_CHAT_ID,
-            message_id=cashier_message_id,
-            reply_markup=None
-        )
-        logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
+        buttons_removed = dispatch_edit_reply_markup(context.bot, tenant.cashier_chat_id, cashier_message_id)
 
         # 📨 إعداد رسالة الإلغاء
         message_text = (
@@ -1493,26 +3414,22 @@ async def handle_standard_cancellation_notice(update: Update, context: CallbackC
             f"نحن سنعتذر منه وندعوه للطلب لاحقًا بسبب ضغط الطلبات."
         )
 
-        # 🧠 تتبع الرسالة
-        message_id = str(uuid.uuid4())
-        await track_sent_message(
-            message_id=message_id,
+        # 🚀 إرسال الرسالة مع تتبعها
+        notice_sent = dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            message_text,
+            priority=PRIORITY_NORMAL,
             order_id=order_id,
-            source="restaurant_bot",
             destination="cashier",
-            content=message_text
-        )
-
-        # 🚀 إرسال الرسالة
-        await send_message_with_retry(
-            bot=context.bot,
-            chat_id=CASHIER_CHAT_ID,
-            text=message_text,
-            order_id=order_id,
-            message_id=message_id,
             parse_mode="Markdown"
         )
 
+        await asyncio.gather(buttons_removed, notice_sent)
+        logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
+
+        await tenant.orders.finish(order_id, ORDER_STATUS_CANCELLED)
+
     except Exception as e:
         logger.error(f"❌ خطأ أثناء إرسال إشعار إلغاء الطلب: {e}")
 
@@ -1521,21 +3438,22 @@ async def handle_standard_cancellation_notice(update: Update, context: CallbackC
 
 
 
-async def handle_rating_message(update: Update, context: CallbackContext):
+async def handle_rating_message(update: Update, context: CallbackContext, parsed: ParsedChannelMessage):
+    tenant = tenant_of(context)
     message = update.channel_post
 
-    if not message or message.chat_id != CHANNEL_ID:
+    if not message or message.chat_id != tenant.channel_id:
         return
 
-    text = message.text or ""
-
-    if "قام بتقييمه بـ" not in text:
-        return
+    order_id = parsed.order_id
+    order_number = parsed.order_number
+    rating = parsed.rating
+    comment = parsed.comment
 
-    order_id = extract_order_id(text)
-    order_number = extract_order_number(text)
-    rating = extract_rating(text)
-    comment = extract_comment(text)
+    if not order_id and order_number:
+        # 🔎 رسالة تقييم بلا معرف: نستعين بفهرس رقم الطلب
+        order = tenant.orders.find_by_number(order_number)
+        order_id = order.order_id if order else None
 
     if not order_id:
         logger.warning("⚠️ لم يتم العثور على معرف الطلب في رسالة التقييم!")
@@ -1549,33 +3467,72 @@ async def handle_rating_message(update: Update, context: CallbackContext):
     )
 
     try:
-        message_id = str(uuid.uuid4())
-
-        await track_sent_message(
-            message_id=message_id,
+        await dispatch_message(
+            context.bot,
+            tenant.cashier_chat_id,
+            cashier_message,
+            priority=PRIORITY_INFO,
             order_id=order_id,
-            source="restaurant_bot",
             destination="cashier",
-            content=cashier_message
-        )
-
-        await send_message_with_retry(
-            bot=context.bot,
-            chat_id=CASHIER_CHAT_ID,
-            text=cashier_message,
-            order_id=order_id,
-            message_id=message_id,
             parse_mode="Markdown"
         )
 
         logger.info(f"✅ تم إرسال التقييم إلى الكاشير (order_id={order_id})")
 
+        # ⭐ استلام التقييم حالة نهائية، فلا داعي لإبقاء الطلب في الذاكرة
+        await tenant.orders.finish(order_id, ORDER_STATUS_RATED)
+
     except Exception as e:
         logger.error(f"❌ فشل في إرسال التقييم إلى الكاشير: {e}")
 
 
 
 
+# 🧭 موجّه منشورات القناة
+class ChannelPostRouter:
+    """تصنيف كل منشور مرة واحدة ثم توجيهه عبر جدول حسب النوع، مع عدّاد لكل نوع"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.counts = {}
+
+    async def dispatch(self, update: Update, context: CallbackContext):
+        message = update.channel_post
+        if not message or message.chat_id != tenant_of(context).channel_id:
+            return
+
+        if message.location:
+            parsed = ParsedChannelMessage(CHANNEL_KIND_LOCATION)
+        else:
+            parsed = parse_channel_message(message.text)
+
+        self.counts[parsed.kind] = self.counts.get(parsed.kind, 0) + 1
+
+        handler = self.routes.get(parsed.kind)
+        if handler is None:
+            logger.info(f"⛔️ تم تجاهل منشور القناة من نوع {parsed.kind}")
+            return
+
+        await handler(update, context, parsed)
+
+    def stats(self):
+        return dict(self.counts)
+
+
+channel_router = ChannelPostRouter({
+    CHANNEL_KIND_REMINDER: handle_channel_reminder,
+    CHANNEL_KIND_TIME_LEFT: handle_time_left_question,
+    CHANNEL_KIND_DELIVERED: handle_order_delivered_rating,
+    CHANNEL_KIND_CANCELLATION_REPORT: handle_report_cancellation_notice,
+    CHANNEL_KIND_CANCELLATION: handle_standard_cancellation_notice,
+    CHANNEL_KIND_RATING: handle_rating_message,
+    CHANNEL_KIND_LOCATION: handle_channel_location,
+    CHANNEL_KIND_ORDER: handle_channel_order,
+})
+
+
+
+
 async def handle_delivery_menu(update: Update, context: CallbackContext):
     context.user_data["delivery_action"] = "menu"
     reply_keyboard = [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]]
@@ -1594,6 +3551,7 @@ async def ask_add_delivery_name(update: Update, context: CallbackContext):
 
 
 async def handle_add_delivery(update: Update, context: CallbackContext):
+    tenant = tenant_of(context)
     text = update.message.text.strip()
 
     if text == "🔙 رجوع":
@@ -1614,20 +3572,14 @@ async def handle_add_delivery(update: Update, context: CallbackContext):
     elif action == "adding_phone":
         name = context.user_data.get("new_delivery_name")
         phone = text
-        restaurant_id = RESTAURANT_ID
+        restaurant_id = tenant.restaurant_id
 
         if not restaurant_id:
             await update.message.reply_text("⚠️ معرف المطعم غير معروف. أعد تشغيل البوت.")
             return
 
         try:
-            async with get_db_connection() as db:
-                async with db.cursor() as cursor:
-                    await cursor.execute(
-                        "INSERT INTO delivery_persons (restaurant_id, name, phone) VALUES (%s, %s, %s)",
-                        (restaurant_id, name, phone)
-                    )
-                await db.commit()
+            await delivery_roster.add(restaurant_id, name, phone)
 
             context.user_data.pop("delivery_action", None)
             context.user_data.pop("new_delivery_name", None)
@@ -1644,32 +3596,27 @@ async def handle_add_delivery(update: Update, context: CallbackContext):
 
 
 async def handle_delete_delivery_menu(update: Update, context: CallbackContext):
-    restaurant_id = RESTAURANT_ID
+    tenant = tenant_of(context)
+    restaurant_id = tenant.restaurant_id
 
     try:
-        async with get_db_connection() as db:
-            async with db.cursor() as cursor:
-                await cursor.execute(
-                    "SELECT name FROM delivery_persons WHERE restaurant_id = %s",
-                    (restaurant_id,)
-                )
-                rows = await cursor.fetchall()
+        roster = await delivery_roster.get(restaurant_id)
 
-        if not rows:
+        if not roster:
             await update.message.reply_text(
                 "⚠️ لا يوجد أي دليفري مسجل حالياً.",
                 reply_markup=ReplyKeyboardMarkup([["➕ إضافة دليفري"], ["🔙 رجوع"]], resize_keyboard=True)
             )
             return
 
-        if len(rows) == 1:
+        if len(roster) == 1:
             await update.message.reply_text(
                 "🚫 لا يمكنك حذف آخر دليفري.\nأضف بديلاً له أولاً قبل الحذف.",
                 reply_markup=ReplyKeyboardMarkup([["➕ إضافة دليفري"], ["🔙 رجوع"]], resize_keyboard=True)
             )
             return
 
-        names = [row[0] for row in rows]
+        names = [person["name"] for person in roster]
         context.user_data["delivery_action"] = "deleting"
         await update.message.reply_text(
             "🗑 اختر اسم الدليفري الذي تريد حذفه:",
@@ -1682,6 +3629,7 @@ async def handle_delete_delivery_menu(update: Update, context: CallbackContext):
 
 
 async def handle_delete_delivery_choice(update: Update, context: CallbackContext):
+    tenant = tenant_of(context)
     text = update.message.text.strip()
 
     if text == "🔙 رجوع":
@@ -1692,16 +3640,10 @@ async def handle_delete_delivery_choice(update: Update, context: CallbackContext
     if context.user_data.get("delivery_action") != "deleting":
         return
 
-    restaurant_id = RESTAURANT_ID
+    restaurant_id = tenant.restaurant_id
 
     try:
-        async with get_db_connection() as db:
-            async with db.cursor() as cursor:
-                await cursor.execute(
-                    "DELETE FROM delivery_persons WHERE restaurant_id = %s AND name = %s",
-                    (restaurant_id, text)
-                )
-            await db.commit()
+        await delivery_roster.remove(restaurant_id, text)
 
         context.user_data.pop("delivery_action", None)
 
@@ -1728,21 +3670,309 @@ async def unified_delivery_router(update: Update, context: CallbackContext):
 
 
 
-async def handle_yesterday_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).date()
+# 📊 ملخص الدخل اليومي: صف واحد لكل مطعم ويوم بدل مسح جدول orders عند كل زر إحصائيات
+# ⏱️ الطلبات يكتبها بوت الزبائن، فأرقام الفترات المفتوحة (اليوم، هذا الشهر...) تتأخر حتى هذه المدة
+DAILY_REVENUE_REFRESH_INTERVAL = float(os.getenv("DAILY_REVENUE_REFRESH_INTERVAL", 15))
+DAILY_REVENUE_REFRESH_DAYS = int(os.getenv("DAILY_REVENUE_REFRESH_DAYS", 2))  # اليوم وأمس
+DAILY_REVENUE_BACKFILL_CHUNK_DAYS = int(os.getenv("DAILY_REVENUE_BACKFILL_CHUNK_DAYS", 31))
+
+
+async def migrate_daily_revenue_table():
+    """إنشاء جدول الملخص اليومي وفهرس نطاق الوقت على orders"""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS daily_revenue (
+                    restaurant_id INT NOT NULL,
+                    day DATE NOT NULL,
+                    order_count INT NOT NULL DEFAULT 0,
+                    revenue BIGINT NOT NULL DEFAULT 0,
+                    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (restaurant_id, day)
+                )
+            """)
+            await ensure_column(cursor, "orders", "restaurant_id", "INT NULL")
+            # ✅ شرط على timestamp نفسه (وليس DATE(timestamp)) حتى يُستخدم هذا الفهرس
+            await ensure_index(cursor, "orders", "idx_orders_restaurant_time", "restaurant_id, timestamp")
+            await ensure_index(cursor, "orders", "idx_orders_restaurant_name_time", "restaurant, timestamp")
+
+            # ⚠️ restaurant_id عمود مُضاف لا يملؤه بوت الزبائن؛ صفوفه الفارغة تُنسب للمطعم عبر عمود restaurant (الاسم)
+            await cursor.execute("SELECT COUNT(*) FROM orders WHERE restaurant_id IS NULL")
+            (unassigned,) = await cursor.fetchone()
+            if unassigned:
+                logger.warning(
+                    f"⚠️ يوجد {unassigned} طلب في orders بلا restaurant_id؛ "
+                    f"تُحسب في ملخص الدخل حسب اسم المطعم في عمود restaurant."
+                )
+        await conn.commit()
+
+
+class StatsCache:
+    """ذاكرة مؤقتة لنتائج أزرار الإحصائيات، مفتاحها (المطعم، بداية الفترة، نهايتها)
+
+    الفترات المغلقة (أمس، الشهر الماضي، السنة الماضية) تبقى صالحة حتى تغيّر اليوم.
+    الفترات المفتوحة (اليوم، هذا الشهر، هذه السنة، الإجمالي) تُحدَّث تزايديًا بفرق صف اليوم
+    في daily_revenue كلما أعاد DailyRevenueRollup حسابه دوريًا، بدل إعادة الاستعلام.
+    """
+
+    def __init__(self):
+        self._entries = {}  # (restaurant_id, start_day, end_day) -> [order_count, revenue]
+        self._day = None
+        self._generation = 0  # يزداد مع كل تعديل، لرفض نتيجة استعلام تزامن مع تعديل
+
+        # 📊 مقاييس
+        self.hits = 0
+        self.misses = 0
+        self.incremental_updates = 0
+        self.invalidations = 0
+
+    def _roll_over(self):
+        # حدود الفترات تتحرك مع تغيّر اليوم، فنبدأ من جديد
+        today = datetime.date.today()
+        if today != self._day:
+            self._entries.clear()
+            self._day = today
+
+    async def get(self, restaurant_id, start_day, end_day, loader):
+        self._roll_over()
+        key = (restaurant_id, start_day, end_day)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return tuple(entry)
+
+        self.misses += 1
+        generation = self._generation
+        count, total = await loader()
+        if generation == self._generation:
+            self._entries[key] = [count, total]
+        return count, total
+
+    def _matching(self, restaurant_id, day):
+        for (entry_restaurant, start_day, end_day), entry in self._entries.items():
+            if entry_restaurant != restaurant_id:
+                continue
+            if start_day is None or start_day <= day <= end_day:
+                yield (entry_restaurant, start_day, end_day), entry
+
+    def apply(self, restaurant_id, day, order_count, revenue):
+        """إضافة فرق يوم واحد إلى كل الفترات المخزنة التي تشمله"""
+        self._roll_over()
+        self._generation += 1
+        for _, entry in self._matching(restaurant_id, day):
+            entry[0] += order_count
+            entry[1] += revenue
+            self.incremental_updates += 1
+
+    def invalidate(self, restaurant_id, day):
+        """حذف الفترات التي تشمل يومًا لا نعرف فرقه"""
+        self._generation += 1
+        keys = [key for key, _ in self._matching(restaurant_id, day)]
+        for key in keys:
+            del self._entries[key]
+        self.invalidations += len(keys)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "incremental_updates": self.incremental_updates,
+            "invalidations": self.invalidations,
+        }
+
+
+stats_cache = StatsCache()
+
+
+class DailyRevenueRollup:
+    """صيانة جدول daily_revenue وقراءة الإحصائيات منه بمسح نطاق صغير"""
+
+    def __init__(self, refresh_interval, refresh_days):
+        self.refresh_interval = refresh_interval
+        self.refresh_days = refresh_days
+        self.restaurants = {}  # المطاعم التي يحدّثها هذا التشغيل: restaurant_id -> اسم المطعم
+        self._task = None
+        # آخر قيم معروفة للأيام الأخيرة: (restaurant_id, day) -> (order_count, revenue)
+        self._recent = {}
+
+        # 📊 مقاييس
+        self.refreshes = 0
+        self.failures = 0
+
+    async def refresh(self, restaurant_id, restaurant_name, start_day, end_day):
+        """إعادة حساب أيام النطاق [start_day, end_day] من جدول orders"""
+        end = end_day + datetime.timedelta(days=1)
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                # الأيام التي لم يعد فيها أي طلب تُحذف، والباقي يُكتب من جديد
+                await cursor.execute(
+                    "DELETE FROM daily_revenue WHERE restaurant_id = %s AND day BETWEEN %s AND %s",
+                    (restaurant_id, start_day, end_day)
+                )
+                # طلبات المطعم: بمعرّفه، أو باسمه للصفوف التي لا تحمل restaurant_id (UNION ALL ليبقى كل شق على فهرسه)
+                await cursor.execute(
+                    "INSERT INTO daily_revenue (restaurant_id, day, order_count, revenue) "
+                    "SELECT %s, day, COUNT(*), COALESCE(SUM(total_price), 0) FROM ("
+                    "  SELECT DATE(timestamp) AS day, total_price FROM orders "
+                    "  WHERE restaurant_id = %s AND timestamp >= %s AND timestamp < %s "
+                    "  UNION ALL "
+                    "  SELECT DATE(timestamp) AS day, total_price FROM orders "
+                    "  WHERE restaurant_id IS NULL AND restaurant = %s AND timestamp >= %s AND timestamp < %s"
+                    ") AS restaurant_orders GROUP BY day",
+                    (restaurant_id, restaurant_id, start_day, end, restaurant_name, start_day, end)
+                )
+                await cursor.execute(
+                    "SELECT day, order_count, revenue FROM daily_revenue "
+                    "WHERE restaurant_id = %s AND day BETWEEN %s AND %s",
+                    (restaurant_id, start_day, end_day)
+                )
+                rows = await cursor.fetchall()
+            await conn.commit()
+        self.refreshes += 1
+        self._publish(restaurant_id, start_day, end_day, {day: (count, revenue) for day, count, revenue in rows})
+
+    def _publish(self, restaurant_id, start_day, end_day, days):
+        """تمرير فرق كل يوم مُعاد حسابه إلى ذاكرة الإحصائيات"""
+        window_start = datetime.date.today() - datetime.timedelta(days=self.refresh_days - 1)
+        day = start_day
+        while day <= end_day:
+            count, revenue = days.get(day, (0, 0))
+            previous = self._recent.get((restaurant_id, day))
+            if previous is None:
+                stats_cache.invalidate(restaurant_id, day)
+            elif previous != (count, revenue):
+                stats_cache.apply(restaurant_id, day, count - previous[0], revenue - previous[1])
+            if day >= window_start:
+                self._recent[(restaurant_id, day)] = (count, revenue)
+            day += datetime.timedelta(days=1)
+
+        for key in [key for key in self._recent if key[1] < window_start]:
+            del self._recent[key]
+
+    def record_order(self, restaurant_id, total_price):
+        """طلب سجّله create_order للتو في orders و daily_revenue: تحديث تزايدي بلا استعلام
+
+        بوت المطعم لا يُنشئ الطلبات (يكتبها بوت الزبائن)، فالمصدر الفعلي لتحديث الفترات
+        المفتوحة هو _refresh_loop كل DAILY_REVENUE_REFRESH_INTERVAL ثانية.
+        """
+        today = datetime.date.today()
+        previous = self._recent.get((restaurant_id, today))
+        if previous is not None:
+            self._recent[(restaurant_id, today)] = (previous[0] + 1, previous[1] + total_price)
+            stats_cache.apply(restaurant_id, today, 1, total_price)
+        else:
+            stats_cache.invalidate(restaurant_id, today)
+
+    async def backfill(self, restaurant_id, restaurant_name, since=None):
+        """بناء الملخص لكل الأيام السابقة على دفعات حتى لا تطول المعاملة الواحدة"""
+        if since is None:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT MIN(timestamp) FROM orders WHERE restaurant_id = %s", (restaurant_id,)
+                    )
+                    (first_by_id,) = await cursor.fetchone()
+                    await cursor.execute(
+                        "SELECT MIN(timestamp) FROM orders WHERE restaurant_id IS NULL AND restaurant = %s",
+                        (restaurant_name,)
+                    )
+                    (first_by_name,) = await cursor.fetchone()
+            firsts = [first for first in (first_by_id, first_by_name) if first is not None]
+            if not firsts:
+                return 0
+            since = min(firsts).date()
+
+        today = datetime.date.today()
+        step = datetime.timedelta(days=DAILY_REVENUE_BACKFILL_CHUNK_DAYS)
+        chunks = 0
+        start = since
+        while start <= today:
+            end = min(start + step - datetime.timedelta(days=1), today)
+            await self.refresh(restaurant_id, restaurant_name, start, end)
+            logger.info(f"📊 تم بناء ملخص الدخل من {start} إلى {end}")
+            chunks += 1
+            start = end + datetime.timedelta(days=1)
+        return chunks
+
+    async def totals(self, restaurant_id, start_day=None, end_day=None):
+        """عدد الطلبات والدخل لنطاق أيام (أو لكل الأيام إن لم يُحدد)"""
+        query = (
+            "SELECT COALESCE(SUM(order_count), 0), COALESCE(SUM(revenue), 0) "
+            "FROM daily_revenue WHERE restaurant_id = %s"
+        )
+        params = (restaurant_id,)
+        if start_day is not None:
+            query += " AND day BETWEEN %s AND %s"
+            params += (start_day, end_day)
 
-    try:
         async with get_db_connection() as conn:
             async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT COUNT(*), SUM(total_price)
-                    FROM orders
-                    WHERE DATE(timestamp) = %s
-                """, (yesterday,))
-                result = await cursor.fetchone()
+                await cursor.execute(query, params)
+                count, total = await cursor.fetchone()
+        return int(count), int(total)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {"refreshes": self.refreshes, "failures": self.failures}
+
+    async def _refresh_loop(self):
+        # الطلبات تُكتب أيضًا من بوت الزبائن، لذا نعيد حساب اليوم دوريًا،
+        # والأيام السابقة مرة واحدة فقط عند بدء كل يوم جديد
+        refreshed_day = None
+        while True:
+            today = datetime.date.today()
+            start_day = today if today == refreshed_day else today - datetime.timedelta(days=self.refresh_days - 1)
+            try:
+                for restaurant_id, restaurant_name in sorted(self.restaurants.items()):
+                    await self.refresh(restaurant_id, restaurant_name, start_day, today)
+                refreshed_day = today
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"❌ فشل تحديث ملخص الدخل اليومي: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def period_totals(self, restaurant_id, start_day=None, end_day=None):
+        """إحصائيات فترة عبر الذاكرة المؤقتة، والاستعلام فقط عند عدم وجودها"""
+        return await stats_cache.get(
+            restaurant_id, start_day, end_day,
+            lambda: self.totals(restaurant_id, start_day, end_day)
+        )
+
+
+revenue_rollup = DailyRevenueRollup(
+    refresh_interval=DAILY_REVENUE_REFRESH_INTERVAL,
+    refresh_days=DAILY_REVENUE_REFRESH_DAYS,
+)
+
+
+async def run_revenue_backfill(tenants, since=None):
+    """أمر سطر الأوامر: بناء جدول daily_revenue من كل الطلبات السابقة"""
+    await init_db_pool()
+    try:
+        await migrate_daily_revenue_table()
+        for tenant in tenants:
+            chunks = await revenue_rollup.backfill(tenant.restaurant_id, tenant.restaurant_name, since)
+            logger.info(f"✅ اكتمل بناء ملخص الدخل اليومي ({chunks} دفعة) للمطعم {tenant.restaurant_name}")
+    finally:
+        await close_db_pool()
+
+
+async def handle_yesterday_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(context)
+    yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).date()
 
-        count = result[0] or 0
-        total = result[1] or 0
+    try:
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id, yesterday, yesterday)
 
         await update.message.reply_text(
             f"📅 *إحصائيات يوم أمس:*\n\n"
@@ -1758,20 +3988,11 @@ async def handle_yesterday_stats(update: Update, context: ContextTypes.DEFAULT_T
 
 
 async def handle_today_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    tenant = tenant_of(context)
+    today = datetime.date.today()
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT COUNT(*), SUM(total_price) 
-                    FROM orders 
-                    WHERE DATE(timestamp) = %s
-                """, (today,))
-                result = await cursor.fetchone()
-
-        count = result[0] or 0
-        total = result[1] or 0
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id, today, today)
 
         await update.message.reply_text(
             f"📊 *إحصائيات اليوم*\n\n"
@@ -1784,22 +4005,13 @@ async def handle_today_stats(update: Update, context: CallbackContext):
 
 
 async def handle_current_month_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    today = datetime.datetime.now()
-    first_day = today.replace(day=1).date().isoformat()
-    last_day = today.date().isoformat()
+    tenant = tenant_of(context)
+    today = datetime.date.today()
+    first_day = today.replace(day=1)
+    last_day = today
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT COUNT(*), SUM(total_price)
-                    FROM orders
-                    WHERE DATE(timestamp) BETWEEN %s AND %s
-                """, (first_day, last_day))
-                result = await cursor.fetchone()
-
-        count = result[0] or 0
-        total = result[1] or 0
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id, first_day, last_day)
 
         await update.message.reply_text(
             f"🗓️ *إحصائيات الشهر الحالي:*\n\n"
@@ -1813,26 +4025,17 @@ async def handle_current_month_stats(update: Update, context: ContextTypes.DEFAU
 
 
 async def handle_last_month_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    today = datetime.datetime.now()
+    tenant = tenant_of(context)
+    today = datetime.date.today()
     first_day_this_month = today.replace(day=1)
     last_day_last_month = first_day_this_month - datetime.timedelta(days=1)
     first_day_last_month = last_day_last_month.replace(day=1)
 
-    start_date = first_day_last_month.date().isoformat()
-    end_date = last_day_last_month.date().isoformat()
+    start_date = first_day_last_month
+    end_date = last_day_last_month
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT COUNT(*), SUM(total_price)
-                    FROM orders
-                    WHERE DATE(timestamp) BETWEEN %s AND %s
-                """, (start_date, end_date))
-                result = await cursor.fetchone()
-
-        count = result[0] or 0
-        total = result[1] or 0
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id, start_date, end_date)
 
         await update.message.reply_text(
             f"📆 *إحصائيات الشهر الماضي:*\n\n"
@@ -1847,22 +4050,13 @@ async def handle_last_month_stats(update: Update, context: ContextTypes.DEFAULT_
 
 
 async def handle_current_year_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now()
-    start_date = today.replace(month=1, day=1).date().isoformat()
-    end_date = today.date().isoformat()
+    tenant = tenant_of(context)
+    today = datetime.date.today()
+    start_date = today.replace(month=1, day=1)
+    end_date = today
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT COUNT(*), SUM(total_price)
-                    FROM orders
-                    WHERE DATE(timestamp) BETWEEN %s AND %s
-                """, (start_date, end_date))
-                result = await cursor.fetchone()
-
-        count = result[0] or 0
-        total = result[1] or 0
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id, start_date, end_date)
 
         await update.message.reply_text(
             f"📈 *إحصائيات السنة الحالية:*\n\n"
@@ -1875,23 +4069,14 @@ async def handle_current_year_stats(update: Update, context: CallbackContext):
 
 
 async def handle_last_year_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now()
+    tenant = tenant_of(context)
+    today = datetime.date.today()
     last_year = today.year - 1
-    start_date = f"{last_year}-01-01"
-    end_date = f"{last_year}-12-31"
+    start_date = datetime.date(last_year, 1, 1)
+    end_date = datetime.date(last_year, 12, 31)
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT COUNT(*), SUM(total_price)
-                    FROM orders
-                    WHERE DATE(timestamp) BETWEEN %s AND %s
-                """, (start_date, end_date))
-                result = await cursor.fetchone()
-
-        count = result[0] or 0
-        total = result[1] or 0
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id, start_date, end_date)
 
         await update.message.reply_text(
             f"📉 *إحصائيات السنة الماضية ({last_year}):*\n\n"
@@ -1904,14 +4089,9 @@ async def handle_last_year_stats(update: Update, context: CallbackContext):
 
 
 async def handle_total_stats(update: Update, context: CallbackContext):
+    tenant = tenant_of(context)
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT COUNT(*), SUM(total_price) FROM orders")
-                result = await cursor.fetchone()
-
-        count = result[0] or 0
-        total = result[1] or 0
+        count, total = await revenue_rollup.period_totals(tenant.restaurant_id)
 
         await update.message.reply_text(
             f"📋 *إجمالي الإحصائيات:*\n\n"
@@ -1945,92 +4125,146 @@ async def handle_network_error(update, context):
         await asyncio.sleep(1)
         if hasattr(update, 'message') and update.message:
             try:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="⚠️ حدث خلل مؤقت بالشبكة. سيتم إعادة المحاولة تلقائيًا."
+                await send_message_with_rate_limit(
+                    context.bot,
+                    update.effective_chat.id,
+                    "⚠️ حدث خلل مؤقت بالشبكة. سيتم إعادة المحاولة تلقائيًا."
                 )
             except:
                 pass
 
 
-ORDER_ID_PATTERNS = [
-    r"معرف الطلب:?\s*[`\"']?([\w\-]+)[`\"']?",
-    r"🆔.*?[`\"']?([\w\-]+)[`\"']?",
-    r"order_id:?\s*[`\"']?([\w\-]+)[`\"']?"
-]
+# 🌐 وضع Webhook: خادم HTTP مدمج واحد يستقبل تحديثات كل المطاعم، لكل مطعم مساره الخاص
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # العنوان العام الذي يصل إليه Telegram (https://...)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+UPDATE_QUEUE_MAXSIZE = int(os.getenv("UPDATE_QUEUE_MAXSIZE", 1000))  # تحديثات بانتظار المعالجة لكل مطعم
 
-ORDER_NUMBER_PATTERNS = [
-    r"رقم الطلب:?\s*[`\"']?(\d+)[`\"']?",
-    r"🔢.*?[`\"']?(\d+)[`\"']?",
-    r"order_number:?\s*[`\"']?(\d+)[`\"']?",
-    r"استلم طلبه رقم (\d+)",
-    r"تحضير الطلب رقم (\d+)"
-]
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
 
+class WebhookServer:
+    """استقبال تحديثات Telegram عبر HTTP والتحقق من الرمز السري ثم وضعها في طابور تطبيق المطعم"""
 
-def extract_order_id(text):
-    for pattern in ORDER_ID_PATTERNS:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(1)
-    return None
+    def __init__(self, host, port, base_url):
+        self.host = host
+        self.port = port
+        self.base_url = base_url.rstrip("/")
+        self._routes = {}  # المسار -> (المطعم، الرمز السري)
+        self._runner = None
+        self._web = None
+        self.ready = False  # يضبطه BotLifecycle بعد اكتمال التشغيل
 
-def extract_order_number(text):
-    for pattern in ORDER_NUMBER_PATTERNS:
-        match = re.search(pattern, text)
-        if match:
-            return int(match.group(1))
-    return None
+        # 📊 مقاييس
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    @staticmethod
+    def path_for(tenant):
+        return f"/telegram/{tenant.restaurant_id}"
+
+    def add(self, tenant, secret=None):
+        # رمز جديد في كل تشغيل: يُسجَّل مع الـ webhook فلا حاجة لحفظه
+        self._routes[self.path_for(tenant)] = (tenant, secret or secrets.token_urlsafe(32))
+
+    async def handle(self, request):
+        web = self._web
+        entry = self._routes.get(request.path)
+        if entry is None:
+            return web.Response(status=404)
 
+        tenant, secret = entry
+        if not hmac.compare_digest(request.headers.get(WEBHOOK_SECRET_HEADER, ""), secret):
+            self.rejected += 1
+            logger.warning(f"⛔️ طلب webhook برمز سري خاطئ على {request.path}")
+            return web.Response(status=403)
 
+        try:
+            update = Update.de_json(await request.json(), tenant.app.bot)
+        except Exception as e:
+            self.rejected += 1
+            logger.warning(f"⚠️ تحديث webhook غير صالح على {request.path}: {e}")
+            return web.Response(status=400)
+
+        try:
+            tenant.app.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # أي رد غير 2xx يجعل Telegram يعيد إرسال التحديث لاحقًا
+            self.dropped += 1
+            return web.Response(status=503)
+
+        self.accepted += 1
+        return web.Response()
+
+    async def handle_ready(self, request):
+        """فحص الجاهزية لموزّع الحمل أثناء إعادة التشغيل المتدرجة"""
+        return self._web.Response(status=200 if self.ready else 503)
+
+    async def start(self):
+        from aiohttp import web  # مطلوبة فقط في وضع webhook
+
+        self._web = web
+        server = web.Application()
+        server.router.add_post("/telegram/{restaurant_id}", self.handle)
+        server.router.add_get("/ready", self.handle_ready)
+        self._runner = web.AppRunner(server, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"🌐 خادم webhook يستمع على {self.host}:{self.port} ({len(self._routes)} مطعم)")
+
+    async def register_webhooks(self):
+        """إبلاغ Telegram بعنوان كل مطعم ورمزه السري"""
+        for path, (tenant, secret) in self._routes.items():
+            await tenant.app.bot.set_webhook(
+                url=self.base_url + path,
+                secret_token=secret,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info(f"✅ تم تسجيل webhook للمطعم {tenant.restaurant_name}: {path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
 
-# ✅ إعداد وتشغيل البوت
-async def run_bot():
-    global app
+    def stats(self):
+        return {"accepted": self.accepted, "rejected": self.rejected, "dropped": self.dropped}
 
-    # 🧠 إعداد جلسة HTTP مخصصة لتحسين الأداء والثبات
-    request = HTTPXRequest(
-        connection_pool_size=100,
-        read_timeout=30,
-        write_timeout=30,
-        connect_timeout=30,
-        pool_timeout=30,
+
+def build_application(tenant, request, webhook=False):
+    """تطبيق PTB لمطعم واحد؛ المعالجات مشتركة وتقرأ المطعم من context.bot_data"""
+    builder = (
+        Application.builder()
+        .token(tenant.token)
+        .request(request)
+        .concurrent_updates(True)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_MAXSIZE))
     )
+    if webhook:
+        # التحديثات تصل من WebhookServer مباشرة إلى update_queue
+        builder = builder.updater(None)
+    app = builder.build()
+    app.bot_data[TENANT_KEY] = tenant
 
-    # ✅ بناء التطبيق مع إعدادات الاتصال والمعالجة المتزامنة
-    app = Application.builder().token(TOKEN).request(request).concurrent_updates(True).build()
     # ✅ أوامر البوت
     app.add_handler(CommandHandler("start", start))
 
     app.add_error_handler(handle_network_error)
 
-    # ✅ رسائل التذكير
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("تذكير من الزبون"), handle_channel_reminder))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("كم يتبقى.*الطلب رقم"), handle_time_left_question))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("استلم طلبه رقم .*معرف الطلب"), handle_order_delivered_rating))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("💬 سبب الإلغاء:"), handle_report_cancellation_notice))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("🚫 تم إلغاء الطلب رقم"), handle_standard_cancellation_notice))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("قام بتقييمه بـ"), handle_rating_message))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.LOCATION, handle_channel_location))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.TEXT, handle_channel_order))
-
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.LOCATION, handle_channel_location))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.TEXT, handle_channel_order))
+    # ✅ كل منشورات القناة (طلبات، مواقع، تذكيرات، تقييمات، إلغاءات) عبر موجّه واحد
+    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & (filters.TEXT | filters.LOCATION), channel_router.dispatch))
 
     # ✅ أزرار التفاعل
-    app.add_handler(CallbackQueryHandler(button, pattern=r"^(accept|reject|confirmreject|back|complain|ready|report_(delivery|phone|location|other))_.+"))
-    app.add_handler(CallbackQueryHandler(handle_time_selection, pattern=r"^time_\d+\+?_.+"))
-    app.add_handler(CallbackQueryHandler(button, pattern=r"^select_delivery\|.+"))
+    # 🔘 كل أزرار سير الطلب (المختصرة والقديمة) عبر موجّه واحد
+    app.add_handler(CallbackQueryHandler(callback_router.dispatch))
 
-
-   # ✅ إدارة الدليفري
+    # ✅ إدارة الدليفري
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex("🚚 الدليفري"), handle_delivery_menu))
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex("➕ إضافة دليفري"), ask_add_delivery_name))
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex("❌ حذف دليفري"), handle_delete_delivery_menu))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unified_delivery_router))
- 
-
 
     # ✅ أوامر الإحصائيات
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📊 عدد الطلبات اليوم والدخل"), handle_today_stats))
@@ -2041,21 +4275,229 @@ async def run_bot():
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📉 طلبات السنة الماضية"), handle_last_year_stats))
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📋 إجمالي الطلبات والدخل"), handle_total_stats))
 
-    # ✅ تقييمات من القناة
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.TEXT & filters.Regex("قام بتقييمه بـ"), handle_rating_message))
-
     # ✅ معالجة الأخطاء
     app.add_error_handler(error_handler)
-    asyncio.create_task(start_order_queue_processor())
-
+    return app
+
+
+# ♻️ دورة حياة البوت: تشغيل مرتب وإيقاف محدود الزمن دون فقدان الرسائل
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 10))  # إنهاء التحديثات والإرسال الجاري
+SHUTDOWN_FLUSH_TIMEOUT = float(os.getenv("SHUTDOWN_FLUSH_TIMEOUT", 10))  # حفظ الطلبات وسجلات التتبع
+READY_FILE = os.getenv("READY_FILE", "")  # ملف يُنشأ عند الجاهزية ويُحذف عند بدء الإيقاف (اختياري)
+
+
+class BotLifecycle:
+    """تشغيل مكونات البوت بترتيب ثابت، وإيقافها بالترتيب العكسي ضمن مهلة محددة"""
+
+    def __init__(self, tenants, webhook=False, drain_timeout=SHUTDOWN_DRAIN_TIMEOUT,
+                 flush_timeout=SHUTDOWN_FLUSH_TIMEOUT, ready_file=READY_FILE):
+        self.tenants = tenants
+        self.webhook = webhook
+        self.drain_timeout = drain_timeout
+        self.flush_timeout = flush_timeout
+        self.ready_file = ready_file
+        self.ready = asyncio.Event()
+        self.webhook_server = None
+        self._queue_processor = None
+        self._timings = {}
+
+    async def _step(self, name, action):
+        started = time.perf_counter()
+        await action()
+        self._timings[name] = round(time.perf_counter() - started, 3)
+
+    async def start(self):
+        """المجمع ← الترحيلات ← تهيئة الذاكرة ← المعالجات، ثم إعلان الجاهزية"""
+        started = time.perf_counter()
+        await self._step("pool", init_db_pool)
+        await self._step("migrations", self._migrate)
+        await self._step("warm_up", self._warm_up)
+        await self._step("handlers", self._start_handlers)
+
+        self.ready.set()
+        if self.webhook_server is not None:
+            self.webhook_server.ready = True
+        if self.ready_file:
+            with open(self.ready_file, "w") as f:
+                f.write(f"{os.getpid()}\n")
+
+        elapsed = time.perf_counter() - started
+        logger.info(f"🚀 البوت جاهز خلال {elapsed:.2f} ثانية ({len(self.tenants)} مطعم) | المراحل: {self._timings}")
+
+    async def _migrate(self):
+        await migrate_pending_orders_table()
+        await migrate_daily_revenue_table()
+
+    async def _warm_up(self):
+        audit_buffer.start()
+        pending_order_writer.start()
+        conversation_states.start()
+        outbound.start()
+        for tenant in self.tenants:
+            tenant.orders.seed_handles(await load_last_callback_handle(tenant.restaurant_id))
+            loaded, source = await order_snapshots.restore(tenant.orders), "اللقطة"
+            if loaded is None:
+                loaded, source = await load_pending_orders(tenant.orders), "MySQL"
+            logger.info(f"♻️ تم تحميل {loaded} طلب حي للمطعم {tenant.restaurant_name} من {source}")
+            tenant.orders.start()
+            order_snapshots.stores.append(tenant.orders)
+            revenue_rollup.restaurants[tenant.restaurant_id] = tenant.restaurant_name
+            await delivery_roster.get(tenant.restaurant_id)
+        revenue_rollup.start()
+        delivery_roster.start()
+        order_snapshots.start()
+        self._queue_processor = asyncio.create_task(start_order_queue_processor())
+
+    async def _start_handlers(self):
+        if self.webhook:
+            if not WEBHOOK_BASE_URL:
+                raise RuntimeError("❌ وضع webhook يتطلب ضبط WEBHOOK_BASE_URL")
+            self.webhook_server = WebhookServer(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_BASE_URL)
+
+        for tenant in self.tenants:
+            # 🧠 جلسة HTTP مستقلة لكل مطعم: shutdown لبوت يغلق جلسته فقط ولا يقطع إرسال بوت آخر ما زال يتوقف
+            request = HTTPXRequest(
+                connection_pool_size=100,
+                read_timeout=30,
+                write_timeout=30,
+                connect_timeout=30,
+                pool_timeout=30,
+            )
+            tenant.app = build_application(tenant, request, webhook=self.webhook)
+            if self.webhook_server is not None:
+                self.webhook_server.add(tenant)
+
+        for tenant in self.tenants:
+            await tenant.app.initialize()
+            await tenant.app.start()
+            if self.webhook_server is None:
+                await tenant.app.updater.start_polling()
+            logger.info(f"✅ بدأ استقبال التحديثات للمطعم {tenant.restaurant_name}")
+
+        if self.webhook_server is not None:
+            await self.webhook_server.start()
+            await self.webhook_server.register_webhooks()
+
+    async def stop(self):
+        """إيقاف الاستقبال ← إنهاء التحديثات والإرسال الجاري ← حفظ الحالة ← إغلاق المجمع"""
+        started = time.perf_counter()
+        self.ready.clear()
+        if self.ready_file and os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
+
+        apps = [tenant.app for tenant in self.tenants if tenant.app is not None]
+        deadline = time.monotonic() + self.drain_timeout
+
+        def remaining():
+            return max(deadline - time.monotonic(), 0.1)
+
+        # 1. إيقاف استقبال تحديثات جديدة
+        if self.webhook_server is not None:
+            self.webhook_server.ready = False
+            await self.webhook_server.stop()
+        for app in apps:
+            if app.updater is not None and app.updater.running:
+                await app.updater.stop()
+
+        # 2. معالجة ما وصل فعلاً (Telegram اعتبره مُسلَّمًا) ثم إيقاف التطبيقات
+        while any(app.running and not app.update_queue.empty() for app in apps) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for app in apps:
+            if app.running:
+                await app.stop()
+
+        # 3. المهام الخلفية (إرسال المواقع) والرسائل الصادرة ضمن المهلة المتبقية
+        for tenant in self.tenants:
+            tenant.locations.release_all()
+        if background_tasks:
+            done, pending = await asyncio.wait(list(background_tasks), timeout=remaining())
+            for task in pending:
+                task.cancel()
+        await outbound.stop(timeout=remaining())
+
+        # ⚠️ shutdown يغلق جلسة HTTP للبوت؛ لا يُستدعى إلا بعد تفريغ الإرسال وإلا ضاعت الرسائل المتبقية
+        for app in apps:
+            await app.shutdown()
+
+        if self._queue_processor is not None:
+            self._queue_processor.cancel()
+            await asyncio.gather(self._queue_processor, return_exceptions=True)
+        await revenue_rollup.stop()
+        await delivery_roster.stop()
+
+        # 4. حفظ الحالة: الطلبات الحية وسجلات التتبع، ثم إغلاق المجمع
+        try:
+            await asyncio.wait_for(self._flush(), timeout=self.flush_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"❌ انتهت مهلة حفظ الحالة عند الإيقاف ({self.flush_timeout} ثانية)")
+        await close_db_pool()
+
+        self._log_stats()
+        logger.info(f"🛑 اكتمل الإيقاف خلال {time.perf_counter() - started:.2f} ثانية")
+
+    async def _flush(self):
+        for tenant in self.tenants:
+            await tenant.orders.stop()
+        await pending_order_writer.stop()
+        await conversation_states.stop()
+        await order_snapshots.stop()
+        await audit_buffer.stop()
+
+    def _log_stats(self):
+        logger.info(f"📊 منشورات القناة حسب النوع: {channel_router.stats()}")
+        logger.info(f"📊 ذاكرة الإحصائيات: {stats_cache.stats()}")
+        logger.info(f"📊 قوالب لوحات الأزرار: {keyboard_factory.stats()}")
+        logger.info(f"📊 أزرار سير الطلب (الزمن لكل إجراء): {callback_router.stats()}")
+        logger.info(f"📊 لقطات الطلبات: {order_snapshots.stats()}")
+        logger.info(f"📊 الرسائل الصادرة: {outbound.stats()} | حدود المعدل: {telegram_limiter.stats()}")
+        if self.webhook_server is not None:
+            logger.info(f"📊 خادم webhook: {self.webhook_server.stats()}")
+        for tenant in self.tenants:
+            logger.info(f"📊 طلبات {tenant.restaurant_name}: {tenant.orders.stats()} | المواقع: {tenant.locations.stats()}")
+
+
+# ✅ تشغيل كل المطاعم على حلقة أحداث واحدة حتى وصول SIGINT/SIGTERM
+async def run_bot(tenants, webhook=False):
+    lifecycle = BotLifecycle(tenants, webhook=webhook)
+    stop_requested = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_requested.set)
+        except NotImplementedError:
+            pass  # Windows: يبقى KeyboardInterrupt الافتراضي
 
-    # ✅ تشغيل البوت
-    await app.run_polling()
+    try:
+        await lifecycle.start()
+        await stop_requested.wait()
+        logger.info("🛑 تم طلب إيقاف البوت.")
+    finally:
+        await lifecycle.stop()
 
 
 if __name__ == "__main__":
-    import nest_asyncio
-    nest_asyncio.apply()
+    # 🌐 --webhook يمكن أن يأتي في أي موضع
+    use_webhook = "--webhook" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--webhook"]
+
+    if not args:
+        print("❌ يرجى تمرير اسم ملف الإعداد: مثال ➜ python3 restaurant.py Almalek")
+        print("   أو تشغيل كل المطاعم في عملية واحدة ➜ python3 restaurant.py --all")
+        print("   ولاستقبال التحديثات عبر webhook بدل polling أضف ➜ --webhook")
+        sys.exit(1)
+
+    if args[0] == "--all":
+        tenants = load_all_restaurant_configs()
+    else:
+        tenants = [load_restaurant_config(args[0])]
+
+    # 📊 أمر بناء ملخص الدخل اليومي: python3 restaurant.py Almalek backfill-revenue [YYYY-MM-DD]
+    if len(args) > 1 and args[1] == "backfill-revenue":
+        since = datetime.date.fromisoformat(args[2]) if len(args) > 2 else None
+        asyncio.run(run_revenue_backfill(tenants, since))
+        sys.exit(0)
+
 
     
     logging.basicConfig(
@@ -2064,21 +4506,11 @@ if __name__ == "__main__":
     )
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
-    logging.info("🚀 جارٍ بدء تشغيل بوت المطعم (النسخة المعدلة للبيئات ذات الـ loop النشط).")
+    logging.info("🚀 جارٍ بدء تشغيل بوت المطعم.")
 
     try:
-        loop = asyncio.get_event_loop()
-        logging.info("📌 جدولة دالة run_bot على الـ event loop الموجود.")
-        task = loop.create_task(run_bot())
-
-        def _log_task_exception_if_any(task_future):
-            if task_future.done() and task_future.exception():
-                logging.error("❌ مهمة run_bot انتهت بخطأ:", exc_info=task_future.exception())
-
-        task.add_done_callback(_log_task_exception_if_any)
-
-        loop.run_forever()  # ⬅️ هذه تبقي البوت نشطًا للأبد
-
+        # الإيقاف عبر SIGINT/SIGTERM يمر بـ BotLifecycle.stop قبل انتهاء asyncio.run
+        asyncio.run(run_bot(tenants, webhook=use_webhook))
     except KeyboardInterrupt:
         logging.info("🛑 تم إيقاف السكربت يدويًا (KeyboardInterrupt).")
     except Exception as e: